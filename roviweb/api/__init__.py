@@ -1,33 +1,88 @@
 """Define the web application"""
-from typing import Annotated
+from concurrent.futures import CancelledError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from email.utils import formatdate
+from typing import Annotated, Awaitable, Callable, Hashable
 from pathlib import Path
-from io import StringIO
+import asyncio
 import logging
 
 import numpy as np
 import pandas as pd
-import matplotlib as mpl
-from matplotlib import pyplot as plt
 from fastapi import FastAPI, Request, HTTPException, Response, Query
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.templating import Jinja2Templates
 
-from . import db, online, prognosis
-from ..db import connect, list_batteries, get_metadata
-from ..online import list_estimators
-from roviweb.prognosis import perform_prognosis, make_load_scenario
-from roviweb.schemas import LoadSpecification
+from . import artifacts, db, online, prognosis
+from ..artifacts import configure_artifact_store
+from ..checkpoints import configure_checkpoints, restore_checkpoints, start_checkpoints, stop_checkpoints, \
+    restore_forecasters
+from ..cluster import ClusterMiddleware, configure_cluster, cluster_enabled, worker_index, start_cluster, \
+    stop_cluster, close_cluster, gather
+from ..cache import get_render_cache, configure_render_cache, configure_prognosis_cache, configure_offline_cache, \
+    make_etag
+from ..db import connect, list_batteries, get_metadata, close_database, has_battery, read_history, table_watermark, \
+    configure_database
+from ..fleet import start_fleet, stop_fleet
+from ..forecast_workers import configure_forecast_workers, close_forecast_workers
+from ..ingest import close_ingest
+from ..offline import configure_offline_estimation, close_offline_estimation
+from ..online import list_estimator_status, has_estimator
+from ..plots import configure_rendering, close_rendering, render, draw_history, draw_forecast
+from ..workers import configure_workers, close_workers
+from roviweb.prognosis import get_prognosis, make_load_scenario, forecaster_version, configure_prognosis_pool, \
+    close_prognosis_pool
+from roviweb.schemas import LoadSpecification, RenderCacheStats
 
 logger = logging.getLogger(__name__)
-mpl.use('Agg')
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Restore estimators and forecasters on start,
+    then finish writing data, save checkpoints, and release the database when the application shuts down"""
+    configure_cluster()
+    if cluster_enabled():
+        configure_database(shard=worker_index())
+    configure_artifact_store()
+    configure_workers()
+    configure_render_cache()
+    configure_prognosis_cache()
+    configure_rendering()
+    configure_prognosis_pool()
+    configure_forecast_workers()
+    configure_offline_estimation()
+    configure_offline_cache()
+    configure_checkpoints()
+    restore_checkpoints()
+    restore_forecasters()
+    start_fleet()
+    start_checkpoints()
+    await start_cluster(app)
+    yield
+    await stop_cluster()
+    close_rendering()
+    close_prognosis_pool()
+    close_forecast_workers()
+    close_ingest()
+    close_offline_estimation()
+    close_workers()
+    stop_fleet()
+    stop_checkpoints()
+    close_database()
+    close_cluster()
+
 
 # Start the RestAPI connect
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"]
 )
+app.add_middleware(ClusterMiddleware)  # Outermost, so replies from other workers are passed along as-is
+app.include_router(artifacts.router)
 app.include_router(db.router)
 app.include_router(online.router)
 app.include_router(prognosis.router)
@@ -38,24 +93,29 @@ templates = Jinja2Templates(directory=Path(__file__).parent / "templates")
 @app.get("/")
 async def home(request: Request):
     return templates.TemplateResponse(
-        request=request, name="home.html", context=dict(datasets=list_batteries())
+        request=request, name="home.html", context=dict(datasets=await gather(request, list_batteries(), '/db/stats'))
     )
 
 
+@app.get("/dashboard/render-cache")
+async def render_cache_stats() -> RenderCacheStats:
+    """Get the size and hit rate of the cache of rendered figures"""
+    return get_render_cache().stats.model_copy()
+
+
 @app.get("/dashboard/{name}")
 async def dashboard(request: Request, name: str):
     # Raise 404 if no such dataset
-    if name not in list_batteries():
+    if not has_battery(name):
         raise HTTPException(status_code=404, detail=f"No such dataset: {name}")
 
     # Get the estimator status, if available
     table = None
-    if (est := list_estimators().get(name)) is not None:
-        est_state = est.estimator.state
+    if (status := list_estimator_status().get(name)) is not None and status.is_ready:
         table = pd.DataFrame({
-            'name': est.estimator.state_names,
-            'value': est_state.get_mean(),
-            'std': np.sqrt(np.diag(est_state.get_covariance()))
+            'name': status.state_names,
+            'value': status.mean,
+            'std': np.sqrt(np.diag(status.covariance))
         })
 
     # Get the metadata
@@ -65,47 +125,106 @@ async def dashboard(request: Request, name: str):
     )
 
 
+async def _figure_response(request: Request, key: tuple, watermark: Hashable, last_modified: float,
+                           render: Callable[[], Awaitable[bytes]]) -> Response:
+    """Respond with a figure, rendering it only if neither the client nor the cache hold the latest version
+
+    Args:
+        request: Request for the figure
+        key: Description of the figure, including the parameters used to make it
+        watermark: Version of the data behind the figure
+        last_modified: Time at which the data last changed (units: s since epoch)
+        render: Coroutine function which renders the figure
+    Returns:
+        Response with the figure, or "not modified" if the client has the latest version
+    """
+    cache = get_render_cache()
+    etag = make_etag(key, watermark)
+    headers = {'ETag': etag, 'Last-Modified': formatdate(last_modified, usegmt=True), 'Cache-Control': 'no-cache'}
+
+    # Skip sending the figure if the client has this version
+    client_tags = [t.strip().removeprefix('W/') for t in request.headers.get('if-none-match', '').split(',')]
+    if etag in client_tags:
+        cache.record_not_modified()
+        return Response(status_code=304, headers=headers)
+
+    content = cache.get(key, watermark)
+    if content is None:
+        try:
+            content = await render()
+        except (TimeoutError, BrokenProcessPool, CancelledError) as e:
+            raise HTTPException(status_code=503, detail=f'Figure could not be rendered: {e}')
+        cache.put(key, watermark, content)
+    return Response(content=content, media_type='image/svg+xml', headers=headers)
+
+
 @app.get("/dashboard/{name}/img/history.svg")
-async def render_history(name):
+async def render_history(request: Request, name: str,
+                         window: float = Query(24 * 3600, gt=0), width: int = Query(800, ge=1)):
+    """Plot the voltage and current over a recent window of time
+
+    Args:
+        name: Name of the battery
+        window: Length of time to plot (units: s)
+        width: Number of points needed across the plot, such as its width in pixels
+    """
     # Raise 404 if no such dataset
-    if name not in list_batteries():  # TODO: Make faster by just checking dataset
+    if not has_battery(name):
         raise HTTPException(status_code=404, detail=f"No such dataset: {name}")
-    conn = connect()
 
-    # Get the latest time in the database
-    last_time, = conn.sql(f'SELECT MAX(test_time) from {name}').fetchone()
-    data = conn.execute(f'SELECT test_time, voltage, current FROM {name} '
-                        f'WHERE test_time > {last_time - 24 * 3600}').df()
+    async def _render():
+        since_pres, data, resolution = await asyncio.to_thread(_read_history, name, window, width)
+        return await render(draw_history, since_pres, data, resolution)
 
-    # Convert time to time since latest in hours
-    data['since_pres'] = (data['test_time'] - last_time) / 3600.
+    watermark, last_modified = table_watermark(name)
+    return await _figure_response(request, ('history', name, window, width), watermark, last_modified, _render)
 
-    # Make the figure
-    fig, axs = plt.subplots(2, 1, figsize=(3.5, 4.), sharex=True)
-    try:
 
-        axs[0].plot(data['since_pres'], data['voltage'])
-        axs[0].set_ylabel('Voltage (V)')
+def _read_history(name: str, window: float, width: int) -> tuple[np.ndarray, dict[str, np.ndarray], float | None]:
+    """Read the voltage and current to be plotted
+
+    Returns:
+        - Time relative to the latest measurement (units: hr)
+        - Voltage, current, and their ranges if summarized
+        - Resolution of the summaries (units: s), ``None`` if the data are raw
+    """
+    conn = connect()
 
-        axs[1].plot(data['since_pres'], data['current'])
-        axs[1].set_ylabel('Current (A)')
-        axs[1].set_xlabel('Time (hr)')
+    # Get the data from the coarsest resolution which has enough points
+    last_time, = conn.sql(f'SELECT MAX(test_time) from {name}').fetchone()
+    resolution, data = read_history(name, ['voltage', 'current'], last_time - window, last_time, width)
 
-        fig.tight_layout()
-        io = StringIO()
-        fig.savefig(io, format='svg', dpi=320)
-        return Response(content=io.getvalue(), media_type='image/svg+xml')
-    finally:
-        plt.close(fig)
+    # Convert time to time since latest in hours
+    since_pres = (data['test_time'] - last_time) / 3600.
+    return since_pres, data, resolution
 
 
 @app.get("/dashboard/{name}/img/forecast.svg")
-async def render_forecast(name, load: Annotated[LoadSpecification, Query()]):
+async def render_forecast(request: Request, name: str, load: Annotated[LoadSpecification, Query()]):
     # Raise 404 if no such dataset
-    if name not in list_batteries():  # TODO: Make faster by just checking dataset
+    if not has_battery(name):
         raise HTTPException(status_code=404, detail=f"No such dataset: {name}")
-    if name not in list_estimators():
+    if not has_estimator(name):
         raise HTTPException(status_code=404, detail=f"No health estimator for: {name}")
+
+    async def _render():
+        asoh_est, forecast = await asyncio.to_thread(_read_forecast, name, load)
+        return await render(draw_forecast, asoh_est, forecast)
+
+    # The figure changes if the estimates are updated or a new forecaster is registered
+    watermark, last_modified = table_watermark(f'{name}_estimates')
+    watermark = (watermark, forecaster_version(name))
+    return await _figure_response(request, ('forecast', name, tuple(load.model_dump().items())), watermark,
+                                  last_modified, _render)
+
+
+def _read_forecast(name: str, load: LoadSpecification) -> tuple[pd.DataFrame, pd.DataFrame | None]:
+    """Read the history of health estimates and forecast their future values
+
+    Returns:
+        - Health estimates over time
+        - Forecast of the health parameters, ``None`` if the forecast failed
+    """
     conn = connect()
 
     # Get the entire history of the health estimates
@@ -115,30 +234,9 @@ async def render_forecast(name, load: Annotated[LoadSpecification, Query()]):
     forecast = None
     try:
         load_scn = make_load_scenario(load)
-        forecast = perform_prognosis(name, load_scn)
+        forecast = get_prognosis(name, load)
         forecast = forecast.join(load_scn.drop(columns=['test_time']))
         forecast['test_time'] += asoh_est['test_time'].max()
     except BaseException as e:
         print(f'Failed to make forecasts due to: {e}')
-
-    # Make the figure
-    n_asoh = len(asoh_est.columns) - 1
-    fig, axs = plt.subplots(n_asoh // 2 + n_asoh % 2, 2, figsize=(6.5, 2 * n_asoh // 2), sharex=True, squeeze=False)
-    try:
-
-        for ax, col in zip(axs.flatten(), asoh_est.columns[1:]):
-            ax.plot(asoh_est['test_time'] / 3600 / 24, asoh_est[col], color='blue')
-            ax.set_title(col, fontsize=8, loc='left')
-
-            if forecast is not None and col in forecast:
-                ax.plot(forecast['test_time'] / 3600 / 24, forecast[col], color='red')
-
-        for ax in axs[-1, :]:
-            ax.set_xlabel('Time (d)')
-
-        fig.tight_layout()
-        io = StringIO()
-        fig.savefig(io, format='svg', dpi=320)
-        return Response(content=io.getvalue(), media_type='image/svg+xml')
-    finally:
-        plt.close(fig)
+    return asoh_est, forecast
@@ -0,0 +1,75 @@
+"""Endpoints related to storing the definitions of estimators and forecasters"""
+from typing import Annotated
+
+from fastapi import APIRouter, Form, UploadFile, HTTPException
+
+from roviweb.artifacts import get_artifact_store, count_references
+from roviweb.schemas import ArtifactInfo
+
+router = APIRouter()
+
+
+def resolve_bundle(definition: str | None, files: list[UploadFile], artifact: str | None) \
+        -> tuple[str, str, dict[str, bytes]]:
+    """Get the definition and files for a registration, either uploaded or from the store
+
+    Uploaded definitions are added to the store.
+
+    Args:
+        definition: Contents of a Python file, if uploaded
+        files: Files uploaded with the definition
+        artifact: Digest of a definition already in the store
+    Returns:
+        - Digest of the definition and files
+        - Contents of the Python file
+        - Map of file name to contents
+    """
+    store = get_artifact_store()
+    try:
+        if artifact is not None:
+            definition, file_contents = store.get(artifact)
+            return artifact, definition, file_contents
+        elif definition is not None:
+            file_contents = dict((file.filename, file.file.read()) for file in files)
+            return store.put(definition, file_contents), definition, file_contents
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    raise HTTPException(status_code=422, detail='Either a definition or the digest of a stored artifact is required')
+
+
+@router.post('/artifacts')
+def upload_artifact(definition: Annotated[str, Form()], files: list[UploadFile] = ()) -> ArtifactInfo:
+    """Store a definition and its files so that they can be used to register by their digest
+
+    Args:
+        definition: Contents of a Python file
+        files: Any files associated with the definition
+    Returns:
+        Description of the stored artifact, including its digest
+    """
+    digest, _, _ = resolve_bundle(definition, files, None)
+    return get_artifact(digest)
+
+
+@router.get('/artifacts/{digest}')
+def get_artifact(digest: str) -> ArtifactInfo:
+    """Describe a stored definition
+
+    Clients may compute the digest of a definition and its files (see :meth:`roviweb.artifacts.bundle_digest`)
+    and check whether it is held before uploading it.
+
+    Args:
+        digest: Digest of the definition and files
+    Returns:
+        Names and sizes of the files
+    """
+    try:
+        info = get_artifact_store().describe(digest)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    info.references = count_references(digest)
+    return info
@@ -1,16 +1,25 @@
 """API functions related to using the database"""
 from datetime import datetime
-from typing import Dict
+from typing import Dict, Annotated, Literal
+import asyncio
 import logging
 
+import duckdb
 import msgpack
+import pyarrow as pa
+from pyarrow import ipc, parquet as pq
 from battdat.schemas import BatteryMetadata
-from fastapi import APIRouter
+from fastapi import APIRouter, Query, Body, Header, HTTPException, Response, Request
 from starlette.websockets import WebSocket, WebSocketDisconnect
 
-from roviweb.db import register_data_source, write_one_record, register_battery, list_batteries, write_records
-from roviweb.schemas import BatteryStats, RecordType
-from ..online import update_estimator
+from roviweb.cluster import gather
+from roviweb.db import (register_data_source, register_battery, list_batteries, write_records,
+                        register_columnar_source, write_table, has_series, read_series)
+from roviweb.downsample import DownsampleMethod
+from roviweb.ingest import open_pipeline, get_ingest_stats
+from roviweb.schemas import BatteryStats, RecordType, IngestStats, SeriesData
+from roviweb.utils import records_to_columns, table_to_columns
+from ..online import update_estimator, flush_estimates
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -30,45 +39,75 @@ def register_data(metadata: BatteryMetadata) -> str:
 
 
 @router.websocket('/db/upload/{name}')
-async def stream_data(name: str, socket: WebSocket):
+async def stream_data(name: str,
+                      socket: WebSocket,
+                      batch_size: Annotated[int, Query(ge=1)] = 1,
+                      batch_time: Annotated[float | None, Query(gt=0)] = None,
+                      overflow: Literal['block', 'drop'] = 'block'):
     """Open a socket connection for writing data to the database
 
-    Messages are the data to be stored in `msgpack <https://pypi.org/project/msgpack/>`_ format.
+    Messages are the data to be stored in `msgpack <https://pypi.org/project/msgpack/>`_ format,
+    either a single record or a list of records sent together.
     The web service will add a timestamp and then store the data as-is.
 
+    Records are gathered into micro-batches which are queued to be written to the database
+    and then used to update the estimator once per batch.
+    The default batch size of 1 writes and updates estimates after every message.
+    Receipt of new messages pauses when the queue for the battery is full,
+    unless ``overflow`` is set to drop batches instead.
+
     Args:
         name: Name of the dataset
         socket: The websocket created for this particular session
+        batch_size: Maximum number of records to hold before writing
+        batch_time: Maximum time to hold a record before writing (units: ms). No limit if not provided
+        overflow: Whether to ``block`` the socket or ``drop`` data if writing falls behind
     """
     # Accept the connection
     await socket.accept()
-    logger.info(f'Connected to client at {socket.client.host}')
-
-    try:
-        # Retrieve the name of the dataset
-        logger.info(f'Ready to receive data for {name}')
+    host = socket.client.host if socket.client is not None else 'another worker'  # Forwarded over a Unix socket
+    logger.info(f'Connected to client at {host}')
 
-        # Retrieve data
-        msg = await socket.receive_bytes()
-        record = msgpack.unpackb(msg)
-        record['received'] = datetime.now().timestamp()
-        type_map = register_data_source(name, record)
+    loop = asyncio.get_running_loop()
+    type_map = None
+    batch: list[RecordType] = []
+    deadline = None  # Time at which the current batch must be written
+    async with open_pipeline(name) as pipeline:
+        try:
+            # Retrieve the name of the dataset
+            logger.info(f'Ready to receive data for {name} in batches of {batch_size}')
 
-        # Continue to write rows until disconnect
-        #  TODO (wardlt): Batch writes
-        while True:
-            # Write to database
-            write_one_record(name, type_map, record)
+            # Continue to write rows until disconnect
+            while True:
+                # Get next step, waiting no longer than the batch deadline
+                try:
+                    timeout = None if deadline is None else max(deadline - loop.time(), 0)
+                    msg = await asyncio.wait_for(socket.receive_bytes(), timeout)
+                except TimeoutError:
+                    pass
+                else:
+                    records = msgpack.unpackb(msg)
+                    if isinstance(records, dict):
+                        records = [records]
+                    received = datetime.now().timestamp()
+                    for record in records:
+                        record['received'] = received
+                    if type_map is None and len(records) > 0:
+                        type_map = register_data_source(name, records[0])
+                    batch.extend(records)
+                    if deadline is None and batch_time is not None and len(batch) > 0:
+                        deadline = loop.time() + batch_time / 1000
 
-            # Update the estimator
-            update_estimator(name)
-
-            # Get next step
-            msg = await socket.receive_bytes()
-            record = msgpack.unpackb(msg)
-            record['received'] = datetime.now().timestamp()
-    except WebSocketDisconnect:
-        logger.info(f'Disconnected from client at {socket.client.host}')
+                # Queue for writing if the batch is full or has waited too long
+                if len(batch) >= batch_size or (deadline is not None and loop.time() >= deadline):
+                    to_write, batch = batch, []
+                    deadline = None
+                    await pipeline.put(type_map, to_write, drop_when_full=overflow == 'drop')
+        except WebSocketDisconnect:
+            logger.info(f'Disconnected from client at {host}')
+        finally:
+            # Queue any records remaining, even if the connection was cancelled
+            pipeline.put_nowait(type_map, batch)
 
 
 @router.post('/db/upload/{name}')
@@ -89,17 +128,136 @@ def upload_data(name: str, records: list[RecordType]) -> int:
     type_map = register_data_source(name, records[0])
     write_records(name, type_map, records)
 
-    # Update the estimator
-    update_estimator(name)
+    # Update the estimator, then write the latest estimate as no more data are expected
+    update_estimator(name, new_data=records_to_columns(records))
+    flush_estimates(name)
     return len(records)
 
 
+def _read_parquet(data: bytes) -> pa.Table:
+    """Read a Parquet file"""
+    return pq.read_table(pa.BufferReader(data))
+
+
+def _read_arrow(data: bytes) -> pa.Table:
+    """Read an Arrow IPC stream"""
+    return ipc.open_stream(data).read_all()
+
+
+def _read_msgpack(data: bytes) -> pa.Table:
+    """Read a msgpack-encoded map of column name to values"""
+    return pa.table(msgpack.unpackb(data))
+
+
+_columnar_readers = {
+    'application/vnd.apache.arrow.stream': _read_arrow,
+    'application/vnd.apache.parquet': _read_parquet,
+    'application/x-parquet': _read_parquet,
+    'application/msgpack': _read_msgpack,
+    'application/x-msgpack': _read_msgpack,
+}
+"""Functions which read columnar data given the content type of a request"""
+
+
+@router.post('/db/upload/{name}/columnar')
+def upload_columnar(name: str,
+                    data: Annotated[bytes, Body(media_type='application/vnd.apache.arrow.stream')],
+                    content_type: Annotated[str, Header()] = 'application/vnd.apache.arrow.stream') -> int:
+    """Bulk upload data in a columnar format
+
+    Supported formats, selected by the content type of the request, are an
+    Arrow IPC stream (``application/vnd.apache.arrow.stream``),
+    Parquet (``application/vnd.apache.parquet``),
+    or a msgpack-encoded map of column name to list of values (``application/msgpack``).
+
+    Args:
+        name: Name of the dataset
+        data: Data to be uploaded
+        content_type: Format of the data
+    Returns:
+        Number of records processed
+    """
+
+    # Read the data as an Arrow table
+    reader = _columnar_readers.get(content_type.split(';')[0].strip())
+    if reader is None:
+        raise HTTPException(status_code=415, detail=f'Unsupported content type: {content_type}')
+    try:
+        table = reader(data)
+    except (ValueError, TypeError, msgpack.UnpackException) as e:  # Arrow errors subclass ValueError or TypeError
+        raise HTTPException(status_code=400, detail=f'Data could not be read as {content_type}: {e}')
+    if table.num_rows == 0:
+        return 0
+
+    # Register the data source then insert, rejecting columns which do not match the existing table
+    try:
+        type_map = register_columnar_source(name, table.schema)
+        write_table(name, type_map, table)
+    except (ValueError, duckdb.ConversionException) as e:
+        raise HTTPException(status_code=400, detail=f'Data do not match the table for {name}: {e}')
+
+    # Update the estimator, then write the latest estimate as no more data are expected
+    update_estimator(name, new_data=table_to_columns(table))
+    flush_estimates(name)
+    return table.num_rows
+
+
+@router.get('/db/ingest')
+async def get_ingest_status(request: Request) -> Dict[str, IngestStats]:
+    """Get the status of the data being streamed for each battery
+
+    Returns:
+        A map of battery name to the depth of the write queue and counters of data written, stalled or dropped
+    """
+
+    return await gather(request, get_ingest_stats())
+
+
 @router.get('/db/stats')
-def get_db_stats() -> Dict[str, BatteryStats]:
+async def get_db_stats(request: Request) -> Dict[str, BatteryStats]:
     """List the battery datasets available
 
     Returns:
         A map of battery name to information about what we hold about it
     """
 
-    return list_batteries()
+    return await gather(request, await asyncio.to_thread(list_batteries))
+
+
+@router.get('/series/{name}')
+def get_series(name: str,
+               columns: Annotated[list[str] | None, Query()] = None,
+               start: float | None = None,
+               end: float | None = None,
+               points: Annotated[int, Query(ge=3, le=100_000)] = 1000,
+               method: DownsampleMethod = 'lttb',
+               accept: Annotated[str, Header()] = 'application/json') -> SeriesData:
+    """Get time series reduced to a number of points suited for drawing on the client
+
+    The response is a JSON document unless msgpack (``application/msgpack``) is requested
+    in the accept header of the request.
+
+    Args:
+        name: Name of the battery, or ``{name}_estimates`` for its state estimates
+        columns: Names of the columns to read. Default is all numeric columns
+        start: Earliest test time to read (units: s). Default is the earliest available
+        end: Latest test time to read (units: s). Default is the latest available
+        points: Number of points to keep for each column, such as the width of a plot in pixels
+        method: Technique used to select points, ``lttb`` for Largest-Triangle-Three-Buckets
+            or ``minmax`` to keep the extremes of each interval
+        accept: Formats accepted by the client
+    Returns:
+        Values of each column in a columnar format
+    """
+    if not has_series(name):
+        raise HTTPException(status_code=404, detail=f'No such series: {name}')
+    try:
+        resolution, data = read_series(name, columns, start, end, points, method)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    series = {'name': name, 'resolution': resolution, 'method': method,
+              'columns': dict((k, v.tolist()) for k, v in data.items())}
+    if 'application/msgpack' in accept:
+        return Response(content=msgpack.packb(series), media_type='application/msgpack')
+    return SeriesData.model_validate(series)
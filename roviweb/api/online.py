@@ -1,79 +1,80 @@
 """Endpoints related to state estimation"""
-import shutil
-from pathlib import Path
-from tempfile import TemporaryDirectory
 from typing import Annotated
+import logging
 
-from fastapi import Form, UploadFile, APIRouter
+from fastapi import Form, UploadFile, APIRouter, Query, Request
 
-from roviweb.online import EstimatorHolder, list_estimators, register_estimator
-from roviweb.utils import load_variable
-from roviweb.schemas import EstimatorStatus
+from roviweb.api.artifacts import resolve_bundle
+from roviweb.cache import get_offline_cache
+from roviweb.checkpoints import save_checkpoint
+from roviweb.cluster import gather
+from roviweb.online import register_estimator, list_estimator_status
+from roviweb.schemas import EstimatorStatus, WritePolicy, OfflineCacheStats
+from roviweb.workers import EstimatorSpec, workers_enabled, place_estimator
 
+logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
 @router.post('/online/register')
-async def upload_estimator(name: Annotated[str, Form()],
-                           definition: Annotated[str, Form()],
-                           required_time: float = 0.,
-                           files: list[UploadFile] = ()) -> str:
+def upload_estimator(name: Annotated[str, Form()],
+                     definition: Annotated[str | None, Form()] = None,
+                     artifact: Annotated[str | None, Form()] = None,
+                     required_time: float = 0.,
+                     fleet: bool = False,
+                     write_every: Annotated[int | None, Query(ge=1)] = None,
+                     write_interval: Annotated[float | None, Query(gt=0)] = None,
+                     write_threshold: Annotated[float | None, Query(gt=0)] = None,
+                     files: list[UploadFile] = ()) -> str:
     """Register an online estimator to be used for a specific data source
 
     Args:
         name: Name of the data source
         definition: Contents of a Python file which builds the model
+        artifact: Digest of a definition and files already uploaded, used in place of the definition
         required_time: Amount of time required until we can train the estimator
+        fleet: Whether to step the estimator alongside others which share the same model.
+            Ignored if estimators run in worker processes
+        write_every: Write the state estimate after this many steps
+        write_interval: Write the state estimate once this much test time has passed since the last write
+        write_threshold: Write the state estimate when any state moves by more than this many standard deviations
         files: Any files associated with the data
     """
 
-    # Write the files to a temporary directory
-    with TemporaryDirectory() as td:
-        td = Path(td)
-        for file in files:
-            with open(td / file.filename, 'wb') as fo:
-                shutil.copyfileobj(file.file, fo)
-
-        # Execute the function to create the estimator
-        estimator_maker, offline_estimator = load_variable(
-            definition,
-            variable_name=('make_estimator', 'perform_offline_estimation'),
-            working_dir=td)
-
-        # Add it to the estimator collection
-        holder = EstimatorHolder(
-            estimator_builder=estimator_maker,
-            offline_estimator=offline_estimator,
-            start_time=required_time,
-            last_time=-1,
-        )
-
-        # Make the estimator if no data are required
-        if required_time <= 0:
-            asoh, state = holder.offline_estimator(None)
-            holder.estimator = holder.estimator_builder(asoh, state)
+    _, definition, file_contents = resolve_bundle(definition, files, artifact)
+    spec = EstimatorSpec(
+        definition=definition,
+        files=file_contents,
+        start_time=required_time,
+        fleet=fleet,
+        write_policy=WritePolicy(write_every=write_every, write_interval=write_interval,
+                                 write_threshold=write_threshold),
+    )
+
+    # Send it to a worker process if they are in use
+    if workers_enabled():
+        result = str(place_estimator(name, spec))
+    else:
+        # Otherwise, add it to the estimator collection, which starts building it if no data are required
+        holder = spec.make_holder(build=False)
         register_estimator(name, holder)
+        result = str(holder)
 
-    return str(holder)
+    # Replace any checkpoint of an earlier estimator
+    try:
+        save_checkpoint(name)
+    except Exception:
+        logger.exception(f'Failed to save a checkpoint for {name}')
+    return result
 
 
 @router.get('/online/status')
-async def status_estimator() -> dict[str, EstimatorStatus]:
+async def status_estimator(request: Request) -> dict[str, EstimatorStatus]:
     """Get the states of each estimator being evaluated"""
+    return await gather(request, list_estimator_status())
 
-    output = {}
-    for name, holder in list_estimators().items():
-        if holder.estimator is None:
-            output[name] = EstimatorStatus(is_ready=False)
-
-        names = holder.estimator.state_names
-        estimated_state = holder.estimator.state
 
-        output[name] = EstimatorStatus(
-            is_ready=True,
-            state_names=list(names),
-            latest_time=holder.last_time,
-            mean=estimated_state.get_mean().tolist(),
-            covariance=estimated_state.get_covariance().tolist(),
-        )
-    return output
+@router.get('/online/offline-cache')
+async def offline_cache_stats() -> OfflineCacheStats:
+    """Get the size and hit rate of the stored results of offline estimation"""
+    return get_offline_cache().stats.model_copy()
@@ -1,26 +1,40 @@
 """Endpoints related to registering and executing prognosis"""
-from tempfile import TemporaryDirectory
-from typing import Annotated
-from pathlib import Path
-import shutil
+from concurrent.futures import CancelledError
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import Annotated, AsyncIterator, Iterator
+import asyncio
+import logging
 
-from fastapi import Form, UploadFile, APIRouter
+import msgpack
+from fastapi import Form, UploadFile, APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from fastapi.params import Query
 
-from roviweb.utils import load_variable
-from roviweb.schemas import ForecasterInfo, LoadSpecification
-from roviweb.prognosis import register_forecaster, make_load_scenario, perform_prognosis
+from roviweb.cache import get_prognosis_cache
+from roviweb.api.artifacts import resolve_bundle
+from roviweb.checkpoints import save_forecaster
+from roviweb.cluster import is_forwarded, split_by_owner, worker_index, request_worker
+from roviweb.schemas import ForecasterInfo, LoadSpecification, PrognosisCacheStats, InputWindow, BatchPrognosisRequest
+from roviweb.prognosis import (register_forecaster, make_load_scenario, get_prognosis, perform_batch_prognosis,
+                               load_forecast_function)
 
+logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
 # TODO (wardlt): Split the query's parts into separate variables to reduce
 #  freedom of users to inject horrible/destructive queries
 @router.post('/prognosis/register')
-async def upload_forecaster(
+def upload_forecaster(
         name: Annotated[str, Form()],
-        definition: Annotated[str, Form()],
-        sql_query: Annotated[str, Form(pattern=r'SELECT[^;]+(?:from|FROM) \$TABLE_NAME\$')],
+        definition: Annotated[str | None, Form()] = None,
+        artifact: Annotated[str | None, Form()] = None,
+        sql_query: Annotated[str | None, Form(pattern=r'SELECT[^;]+(?:from|FROM) \$TABLE_NAME\$')] = None,
+        window_columns: Annotated[list[str] | None, Form()] = None,
+        window_rows: Annotated[int | None, Form()] = None,
+        window_duration: Annotated[float | None, Form()] = None,
+        vectorized: Annotated[bool, Form()] = False,
         files: list[UploadFile] = ()) -> str:
     """Register a prognosis tool to be used for a single data source
 
@@ -30,26 +44,43 @@ async def upload_forecaster(
             The file must contain a function named "forecast" which will take a dataframe of input
             observations following the format specified from :attr:`sql_query` and
             a Dataframe of the load expectations
+        artifact: Digest of a definition and files already uploaded, used in place of the definition
         sql_query: Query used against the time series database to gather inference inputs
+        window_columns: Columns of the estimates table used as inputs, if using an input window in place of a query
+        window_rows: Maximum number of recent estimates in the input window
+        window_duration: Maximum span of test time in the input window (units: s)
+        vectorized: Whether the function accepts many load scenarios at once
         files: Any files associated with the forecaster
     Returns:
         Summary of the forecaster
     """
 
-    # Write the files to a temporary directory
-    with TemporaryDirectory() as td:
-        td = Path(td)
-        for file in files:
-            with open(td / file.filename, 'wb') as fo:
-                shutil.copyfileobj(file.file, fo)
+    # Describe which estimates are used as inputs
+    try:
+        input_window = None
+        if window_columns is not None:
+            input_window = InputWindow(columns=window_columns, rows=window_rows, duration=window_duration)
+        if sql_query is None and input_window is None:
+            raise ValueError('Either a query or an input window must be provided')
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    digest, definition, file_contents = resolve_bundle(definition, files, artifact)
 
-        # Load the inference function
-        function = load_variable(definition, variable_name='forecast', working_dir=td)
+    try:
+        function = load_forecast_function(name, definition, file_contents)
+    except (TimeoutError, BrokenProcessPool, CancelledError) as e:
+        raise HTTPException(status_code=503, detail=str(e))
 
     # Register it
-    forecaster = ForecasterInfo(function=function, sql_query=sql_query)
+    forecaster = ForecasterInfo(function=function, sql_query=sql_query, input_window=input_window,
+                                vectorized=vectorized, artifact=digest)
     register_forecaster(name, forecaster)
 
+    # Store the registration so it is restored after a restart
+    try:
+        save_forecaster(name)
+    except Exception:
+        logger.exception(f'Failed to save the record of the forecaster for {name}')
     return str(forecaster)
 
 
@@ -65,5 +96,82 @@ def run_prognosis(name: str, data: Annotated[LoadSpecification, Query()]) -> dic
     """
 
     load = make_load_scenario(data)
-    forecast = perform_prognosis(name, load)
+    try:
+        forecast = get_prognosis(name, data)
+    except (TimeoutError, BrokenProcessPool, CancelledError) as e:
+        raise HTTPException(status_code=503, detail=f'Forecast could not be completed: {e}')
     return {**load.to_dict(orient='list'), **forecast.to_dict(orient='list')}
+
+
+def _batch_messages(names: list[str], loads: list[LoadSpecification]) -> Iterator[dict]:
+    """Run batch prognosis and describe each result as a message"""
+    for name, result in perform_batch_prognosis(names, loads):
+        if isinstance(result, Exception):
+            yield {'name': name, 'error': str(result)}
+        else:
+            yield {'name': name, 'columns': dict((k, v.tolist()) for k, v in result.items())}
+
+
+def _pack_batch(names: list[str], loads: list[LoadSpecification]) -> Iterator[bytes]:
+    """Run batch prognosis and encode each result as a message"""
+    for message in _batch_messages(names, loads):
+        yield msgpack.packb(message)
+
+
+async def _gather_batch(request: BatchPrognosisRequest, groups: dict[int, list[str]]) -> AsyncIterator[bytes]:
+    """Run batch prognosis for the systems of each worker at once, then yield the messages in the order requested
+
+    Systems without a result, such as those of a worker which failed, receive a message with an ``error``.
+    """
+
+    async def _run_group(index: int, names: list[str]) -> dict[str, dict]:
+        try:
+            if index == worker_index():
+                messages = await asyncio.to_thread(list, _batch_messages(names, request.loads))
+            else:
+                sub_request = BatchPrognosisRequest(names=names, loads=request.loads)
+                reply = await request_worker(index, 'POST', '/prognosis/batch', content=sub_request.model_dump_json(),
+                                             headers={'content-type': 'application/json'})
+                reply.raise_for_status()
+                messages = list(msgpack.Unpacker(BytesIO(reply.content), raw=False))
+        except Exception as e:
+            logger.warning(f'Batch prognosis failed on worker {index}: {e}')
+            return dict((name, {'name': name, 'error': f'Prognosis failed on worker {index}: {e}'}) for name in names)
+        return dict((message['name'], message) for message in messages)
+
+    results = await asyncio.gather(*[_run_group(i, names) for i, names in groups.items()])
+    messages = {}
+    for result in results:
+        messages.update(result)
+    for name in request.names:
+        yield msgpack.packb(messages.get(name, {'name': name, 'error': 'No forecast was returned'}))
+
+
+@router.post('/prognosis/batch')
+async def run_batch_prognosis(request: BatchPrognosisRequest, raw_request: Request) -> StreamingResponse:
+    """Run prognosis for many systems, each under many load conditions
+
+    The response is a stream of msgpack messages, one per system in the order requested.
+    Each message contains the ``name`` of the system and either the ``columns`` of the forecasts
+    for all load scenarios, where ``scenario`` is the index of the load specification for each row,
+    or an ``error`` describing why the forecast failed.
+
+    Systems owned by other workers, if batteries are shared between workers,
+    are forecast by those workers and streamed once all have finished.
+
+    Args:
+        request: Names of the systems and the load specifications
+        raw_request: Request as received, used to determine whether it was forwarded from another worker
+    Returns:
+        Stream of forecasts
+    """
+    groups = split_by_owner(request.names)
+    if not is_forwarded(raw_request) and set(groups) - {worker_index()}:
+        return StreamingResponse(_gather_batch(request, groups), media_type='application/msgpack')
+    return StreamingResponse(_pack_batch(request.names, request.loads), media_type='application/msgpack')
+
+
+@router.get('/prognosis/cache')
+def get_prognosis_cache_stats() -> PrognosisCacheStats:
+    """Get the size and hit rate of the cache of forecasts"""
+    return get_prognosis_cache().stats.model_copy()
@@ -0,0 +1,229 @@
+"""Store of the definitions and files used to create estimators and forecasters
+
+Each definition and its associated files form a bundle identified by a hash of their contents,
+so that a bundle used for many batteries is stored once and can be referred to by its hash
+rather than uploaded again.
+The objects created by executing a definition are held in memory while any estimator or forecaster uses them.
+"""
+from dataclasses import dataclass
+from hashlib import sha256
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Lock
+from typing import Any, Mapping, Sequence
+import os
+
+from roviweb.schemas import ArtifactInfo
+from roviweb.utils import load_variable
+
+
+def bundle_digest(definition: str, files: Mapping[str, bytes]) -> str:
+    """Compute the identifier of a definition and its files
+
+    Args:
+        definition: Contents of a Python file
+        files: Files associated with the definition, as a map of file name to contents
+    Returns:
+        Hex digest which changes if the definition, the name of any file, or the contents of any file change
+    """
+    hasher = sha256(b'definition\0' + sha256(definition.encode()).digest())
+    for filename in sorted(files):
+        hasher.update(filename.encode() + b'\0' + sha256(files[filename]).digest())
+    return hasher.hexdigest()
+
+
+def _check_filename(filename: str):
+    if filename in ('', '.', '..') or Path(filename).name != filename:
+        raise ValueError(f'File names must not include directories: {filename}')
+
+
+class ArtifactStore:
+    """Bundles of definitions and files held in a directory, each in a subdirectory named by its digest
+
+    Args:
+        root: Directory holding the bundles
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def path(self, digest: str) -> Path:
+        """Directory holding a bundle"""
+        if len(digest) != 64 or any(c not in '0123456789abcdef' for c in digest):
+            raise ValueError(f'Not a valid digest: {digest}')
+        return self.root / digest
+
+    def has(self, digest: str) -> bool:
+        """Whether a bundle is in the store"""
+        return self.path(digest).is_dir()
+
+    def put(self, definition: str, files: Mapping[str, bytes]) -> str:
+        """Add a bundle to the store if it is not already present
+
+        Args:
+            definition: Contents of a Python file
+            files: Files associated with the definition, as a map of file name to contents
+        Returns:
+            Digest of the bundle
+        """
+        for filename in files:
+            _check_filename(filename)
+        digest = bundle_digest(definition, files)
+        if self.has(digest):
+            return digest
+
+        # Write to a temporary directory then move into place so partial bundles are never visible
+        self.root.mkdir(parents=True, exist_ok=True)
+        with TemporaryDirectory(dir=self.root, prefix='.incoming-') as td:
+            staged = Path(td) / digest
+            (staged / 'files').mkdir(parents=True)
+            (staged / 'definition.py').write_text(definition)
+            for filename, content in files.items():
+                (staged / 'files' / filename).write_bytes(content)
+            try:
+                staged.rename(self.path(digest))
+            except OSError:
+                if not self.has(digest):  # Fails if another thread wrote the same bundle first
+                    raise
+        return digest
+
+    def get(self, digest: str) -> tuple[str, dict[str, bytes]]:
+        """Read a bundle
+
+        Args:
+            digest: Digest of the bundle
+        Returns:
+            - Contents of the Python file
+            - Map of file name to contents
+        """
+        path = self.path(digest)
+        if not path.is_dir():
+            raise KeyError(f'No such artifact: {digest}')
+        definition = (path / 'definition.py').read_text()
+        files = dict((f.name, f.read_bytes()) for f in (path / 'files').iterdir())
+        return definition, files
+
+    def describe(self, digest: str) -> ArtifactInfo:
+        """Summarize the contents of a bundle
+
+        Args:
+            digest: Digest of the bundle
+        Returns:
+            Names and sizes of the files
+        """
+        path = self.path(digest)
+        if not path.is_dir():
+            raise KeyError(f'No such artifact: {digest}')
+        return ArtifactInfo(
+            digest=digest,
+            definition_size=(path / 'definition.py').stat().st_size,
+            files=dict((f.name, f.stat().st_size) for f in (path / 'files').iterdir())
+        )
+
+
+artifact_store: ArtifactStore | None = None
+
+
+def configure_artifact_store(data_dir: str | Path | None = None):
+    """Set where bundles are stored
+
+    Args:
+        data_dir: Directory holding the data of the web service, in which bundles are stored in ``artifacts``.
+            Read from the ``ROVIWEB_DATA_DIR`` environment variable if not provided, default of ``roviweb-data``
+    """
+    global artifact_store
+    data_dir = data_dir or os.environ.get('ROVIWEB_DATA_DIR', 'roviweb-data')
+    artifact_store = ArtifactStore(Path(data_dir) / 'artifacts')
+
+
+def get_artifact_store() -> ArtifactStore:
+    """Get the store of bundles, creating it if needed"""
+    if artifact_store is None:
+        configure_artifact_store()
+    return artifact_store
+
+
+@dataclass
+class _Loaded:
+    """Objects created by executing a definition and the number of users"""
+
+    objects: Any
+    """Variables retrieved after executing the definition"""
+    references: int = 0
+    """Number of estimators or forecasters using the objects"""
+
+
+_loaded: dict[tuple[str, tuple[str, ...]], _Loaded] = {}
+_loaded_lock = Lock()  # Guards the map of loaded objects
+_execute_lock = Lock()  # Held while executing a definition, which changes the working directory of the process
+
+
+def _execute(definition: str, files: Mapping[str, bytes], variable_names: Sequence[str]) -> Any:
+    """Execute a definition in a directory holding its files and retrieve variables"""
+    with TemporaryDirectory() as td:
+        td = Path(td)
+        for filename, content in files.items():
+            _check_filename(filename)
+            (td / filename).write_bytes(content)
+        return load_variable(definition, list(variable_names), working_dir=td)
+
+
+def acquire_objects(definition: str, files: Mapping[str, bytes], variable_names: Sequence[str]) -> tuple[str, Any]:
+    """Get the variables defined by executing a definition, executing it only if no other user holds them
+
+    Call :meth:`release_objects` once the variables are no longer used.
+
+    Args:
+        definition: Contents of a Python file
+        files: Files needed when executing the definition, as a map of file name to contents
+        variable_names: Names of the variables to retrieve
+    Returns:
+        - Digest of the definition and files
+        - Values of the variables
+    """
+    digest = bundle_digest(definition, files)
+    key = (digest, tuple(variable_names))
+    with _loaded_lock:
+        if (loaded := _loaded.get(key)) is not None:
+            loaded.references += 1
+            return digest, loaded.objects
+
+    # Execute the definition without blocking users of objects which are already loaded
+    with _execute_lock:
+        with _loaded_lock:
+            if (loaded := _loaded.get(key)) is not None:  # Loaded by another thread while waiting
+                loaded.references += 1
+                return digest, loaded.objects
+        objects = _execute(definition, files, variable_names)
+        with _loaded_lock:
+            _loaded[key] = _Loaded(objects=objects, references=1)
+        return digest, objects
+
+
+def release_objects(digest: str, variable_names: Sequence[str]):
+    """Mark that a user no longer needs the variables from a definition, freeing them if no users remain
+
+    Args:
+        digest: Digest of the definition and files
+        variable_names: Names of the variables which were retrieved
+    """
+    key = (digest, tuple(variable_names))
+    with _loaded_lock:
+        loaded = _loaded.get(key)
+        if loaded is None:
+            return
+        loaded.references -= 1
+        if loaded.references <= 0:
+            _loaded.pop(key)
+
+
+def count_references(digest: str) -> int:
+    """Count the estimators and forecasters using the objects from a bundle
+
+    Args:
+        digest: Digest of the bundle
+    Returns:
+        Number of users
+    """
+    with _loaded_lock:
+        return sum(v.references for (d, _), v in _loaded.items() if d == digest)
@@ -0,0 +1,398 @@
+"""Caches of rendered figures, forecasts, and offline estimates which are reused until the data behind them change"""
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from hashlib import sha1
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Hashable
+import logging
+import os
+import pickle
+
+from roviweb.schemas import RenderCacheStats, PrognosisCacheStats, OfflineCacheStats
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Entry:
+    """Rendered content and the version of the data used to make it"""
+
+    watermark: Hashable
+    """Version of the data used to render the content"""
+    content: bytes
+    """Rendered content"""
+
+
+def make_etag(key: Hashable, watermark: Hashable) -> str:
+    """Make an entity tag which changes whenever the request or the data behind it change
+
+    Args:
+        key: Description of what was rendered
+        watermark: Version of the data used to render it
+    Returns:
+        Quoted entity tag
+    """
+    return '"' + sha1(repr((key, watermark)).encode()).hexdigest() + '"'
+
+
+class RenderCache:
+    """Least-recently-used cache of rendered content
+
+    Holds a single version of the content for each key, which is replaced when the watermark changes.
+
+    Args:
+        max_bytes: Maximum total size of the content held
+        max_entries: Maximum number of entries
+    """
+
+    def __init__(self, max_bytes: int, max_entries: int):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.stats = RenderCacheStats(max_bytes=max_bytes, max_entries=max_entries)
+        self._entries: OrderedDict[Hashable, _Entry] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable, watermark: Hashable) -> bytes | None:
+        """Get the content rendered for a certain version of the data
+
+        Args:
+            key: Description of what was rendered
+            watermark: Version of the data
+        Returns:
+            The content, if available
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.watermark != watermark:
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return entry.content
+
+    def put(self, key: Hashable, watermark: Hashable, content: bytes):
+        """Store newly-rendered content, replacing any for older versions of the data
+
+        Args:
+            key: Description of what was rendered
+            watermark: Version of the data
+            content: Rendered content
+        """
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            if (old := self._entries.pop(key, None)) is not None:
+                self.stats.bytes -= len(old.content)
+            self._entries[key] = _Entry(watermark=watermark, content=content)
+            self.stats.bytes += len(content)
+
+            # Remove the least-recently used until within limits
+            while len(self._entries) > self.max_entries or self.stats.bytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self.stats.bytes -= len(old.content)
+                self.stats.evictions += 1
+            self.stats.entries = len(self._entries)
+
+    def record_not_modified(self):
+        """Count a request answered without sending content because the client's copy is current"""
+        with self._lock:
+            self.stats.not_modified += 1
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._entries.clear()
+            self.stats.entries = self.stats.bytes = 0
+
+
+render_cache: RenderCache | None = None
+
+
+def configure_render_cache(max_bytes: int | None = None, max_entries: int | None = None):
+    """Set the limits of the render cache, clearing its contents
+
+    Args:
+        max_bytes: Maximum total size of the figures held. Read from the ``ROVIWEB_RENDER_CACHE_BYTES``
+            environment variable if not provided, default of 64 MB
+        max_entries: Maximum number of figures held. Read from the ``ROVIWEB_RENDER_CACHE_ENTRIES``
+            environment variable if not provided, default of 1024
+    """
+    global render_cache
+    max_bytes = max_bytes or int(os.environ.get('ROVIWEB_RENDER_CACHE_BYTES', 64 * 1024 * 1024))
+    max_entries = max_entries or int(os.environ.get('ROVIWEB_RENDER_CACHE_ENTRIES', 1024))
+    render_cache = RenderCache(max_bytes, max_entries)
+
+
+def get_render_cache() -> RenderCache:
+    """Get the cache of rendered figures, creating it if needed"""
+    if render_cache is None:
+        configure_render_cache()
+    return render_cache
+
+
+@dataclass
+class _Result:
+    """Result of a computation and the state of the data when it was made"""
+
+    latest_time: float
+    """Latest test time in the data used to compute the result (units: s)"""
+    created: float
+    """Monotonic time at which the result was computed (units: s)"""
+    value: Any
+    """Result of the computation"""
+
+
+class PrognosisCache:
+    """Least-recently-used cache of forecasts which expire after a fixed time or once newer data arrive
+
+    Requests for a forecast which is already being computed wait for that computation
+    rather than starting another.
+
+    Args:
+        max_entries: Maximum number of forecasts held
+        ttl: Time after which a forecast is recomputed (units: s)
+        tolerance: How far the latest data may advance past those used
+            for a forecast before it is recomputed (units: s of test time)
+    """
+
+    def __init__(self, max_entries: int, ttl: float, tolerance: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.tolerance = tolerance
+        self.stats = PrognosisCacheStats(max_entries=max_entries, ttl=ttl, tolerance=tolerance)
+        self._entries: OrderedDict[Hashable, _Result] = OrderedDict()
+        self._in_flight: dict[Hashable, tuple[float, Future]] = {}
+        self._lock = Lock()
+
+    def _is_current(self, latest_time: float, result_time: float) -> bool:
+        # Also false if either time is NaN, such as when no data are available
+        return latest_time - result_time <= self.tolerance
+
+    def get_or_compute(self, key: Hashable, latest_time: float, compute: Callable[[], Any]) -> Any:
+        """Get a stored result or compute a new one
+
+        Args:
+            key: Description of the computation
+            latest_time: Latest test time in the data available now (units: s)
+            compute: Function which performs the computation
+        Returns:
+            Result of the computation
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if monotonic() - entry.created > self.ttl:
+                    self._remove(key)
+                    self.stats.expirations += 1
+                elif not self._is_current(latest_time, entry.latest_time):
+                    self._remove(key)
+                    self.stats.invalidations += 1
+                else:
+                    self._entries.move_to_end(key)
+                    self.stats.hits += 1
+                    return entry.value
+
+            # Wait for an identical computation if one is running using recent enough data
+            in_flight = self._in_flight.get(key)
+            if in_flight is not None and self._is_current(latest_time, in_flight[0]):
+                self.stats.coalesced += 1
+                future = in_flight[1]
+                owner = False
+            else:
+                self.stats.misses += 1
+                future = Future()
+                self._in_flight[key] = (latest_time, future)
+                owner = True
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = compute()
+        except BaseException as e:
+            with self._lock:
+                self._finish(key, future)
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._finish(key, future)
+            self._entries[key] = _Result(latest_time=latest_time, created=monotonic(), value=value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+            self.stats.entries = len(self._entries)
+        future.set_result(value)
+        return value
+
+    def _remove(self, key: Hashable):
+        self._entries.pop(key, None)
+        self.stats.entries = len(self._entries)
+
+    def _finish(self, key: Hashable, future: Future):
+        """Mark a computation as complete unless it was since replaced by a newer one"""
+        if (in_flight := self._in_flight.get(key)) is not None and in_flight[1] is future:
+            self._in_flight.pop(key)
+
+    def invalidate(self, matches: Callable[[Hashable], bool]):
+        """Remove the results for certain computations
+
+        Args:
+            matches: Function which returns whether the result for a key should be removed
+        """
+        with self._lock:
+            for key in [k for k in self._entries if matches(k)]:
+                self._remove(key)
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._entries.clear()
+            self.stats.entries = 0
+
+
+prognosis_cache: PrognosisCache | None = None
+
+
+def configure_prognosis_cache(max_entries: int | None = None, ttl: float | None = None,
+                              tolerance: float | None = None):
+    """Set the limits of the prognosis cache, clearing its contents
+
+    Args:
+        max_entries: Maximum number of forecasts held. Read from the ``ROVIWEB_PROGNOSIS_CACHE_ENTRIES``
+            environment variable if not provided, default of 256
+        ttl: Time after which a forecast is recomputed (units: s). Read from the ``ROVIWEB_PROGNOSIS_CACHE_TTL``
+            environment variable if not provided, default of 600 s
+        tolerance: How far new state estimates may advance past those used in a forecast
+            before it is recomputed (units: s of test time). Read from the ``ROVIWEB_PROGNOSIS_TOLERANCE``
+            environment variable if not provided, default of 0 s
+    """
+    global prognosis_cache
+    max_entries = max_entries or int(os.environ.get('ROVIWEB_PROGNOSIS_CACHE_ENTRIES', 256))
+    ttl = ttl or float(os.environ.get('ROVIWEB_PROGNOSIS_CACHE_TTL', 600.))
+    tolerance = tolerance if tolerance is not None else float(os.environ.get('ROVIWEB_PROGNOSIS_TOLERANCE', 0.))
+    prognosis_cache = PrognosisCache(max_entries, ttl, tolerance)
+
+
+def get_prognosis_cache() -> PrognosisCache:
+    """Get the cache of forecasts, creating it if needed"""
+    if prognosis_cache is None:
+        configure_prognosis_cache()
+    return prognosis_cache
+
+
+class OfflineResultCache:
+    """Results of offline estimation stored on disk, so they persist across restarts
+
+    Each result is a file named by its key.
+    The least-recently-used results are removed once the total size exceeds a limit.
+
+    Args:
+        directory: Directory holding the results
+        max_bytes: Maximum total size of the results held
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.stats = OfflineCacheStats(max_bytes=max_bytes)
+        self._lock = Lock()
+        self._update_size()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f'{key}.pkl'
+
+    def _update_size(self):
+        """Measure the results held. Requires the lock unless called during initialization"""
+        files = list(self.directory.glob('*.pkl')) if self.directory.is_dir() else []
+        self.stats.entries = len(files)
+        self.stats.bytes = sum(f.stat().st_size for f in files)
+
+    def get(self, key: str) -> Any | None:
+        """Retrieve a stored result
+
+        Args:
+            key: Description of the inputs to offline estimation (see :meth:`roviweb.offline.offline_cache_key`)
+        Returns:
+            The result, if available
+        """
+        path = self._path(key)
+        with self._lock:
+            try:
+                result = pickle.loads(path.read_bytes())
+                path.touch()  # Mark as recently used
+            except FileNotFoundError:
+                self.stats.misses += 1
+                return None
+            except Exception:
+                logger.warning(f'Removing unreadable offline estimate: {path}')
+                path.unlink(missing_ok=True)
+                self._update_size()
+                self.stats.misses += 1
+                return None
+            self.stats.hits += 1
+            return result
+
+    def put(self, key: str, result: Any):
+        """Store a result, removing the least-recently used results if the cache is too large
+
+        Args:
+            key: Description of the inputs to offline estimation
+            result: Output of offline estimation
+        """
+        content = pickle.dumps(result)
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            # Write to a temporary file then move into place so partial results are never read
+            self.directory.mkdir(parents=True, exist_ok=True)
+            staged = self.directory / f'.{key}.incoming'
+            staged.write_bytes(content)
+            staged.replace(self._path(key))
+
+            # Remove the least-recently used until within limits
+            files = sorted(((f.stat(), f) for f in self.directory.glob('*.pkl')), key=lambda x: x[0].st_mtime)
+            total = sum(s.st_size for s, _ in files)
+            for stat, path in files:
+                if total <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total -= stat.st_size
+                self.stats.evictions += 1
+            self._update_size()
+
+    def clear(self):
+        """Remove all results"""
+        with self._lock:
+            for path in self.directory.glob('*.pkl'):
+                path.unlink(missing_ok=True)
+            self._update_size()
+
+
+offline_cache: OfflineResultCache | None = None
+
+
+def configure_offline_cache(data_dir: str | Path | None = None, max_bytes: int | None = None):
+    """Set where results of offline estimation are stored and the limit on their size
+
+    Args:
+        data_dir: Directory holding the data of the web service, in which results are stored in ``offline-cache``.
+            Read from the ``ROVIWEB_DATA_DIR`` environment variable if not provided, default of ``roviweb-data``
+        max_bytes: Maximum total size of the results held. Read from the ``ROVIWEB_OFFLINE_CACHE_BYTES``
+            environment variable if not provided, default of 256 MB
+    """
+    global offline_cache
+    data_dir = data_dir or os.environ.get('ROVIWEB_DATA_DIR', 'roviweb-data')
+    max_bytes = max_bytes or int(os.environ.get('ROVIWEB_OFFLINE_CACHE_BYTES', 256 * 1024 * 1024))
+    offline_cache = OfflineResultCache(Path(data_dir) / 'offline-cache', max_bytes)
+
+
+def get_offline_cache() -> OfflineResultCache:
+    """Get the store of offline estimation results, creating it if needed"""
+    if offline_cache is None:
+        configure_offline_cache()
+    return offline_cache
@@ -0,0 +1,295 @@
+"""Save the state of each online estimator so that a restart resumes where it stopped
+
+A checkpoint holds the parts of an estimator which change as it is stepped
+(the estimator with its mean and covariance, the time of the last row, and the inputs from that row)
+and the digest of the definition which built it, as kept in the artifact store (see :mod:`roviweb.artifacts`).
+Checkpoints are written on a timer and when the web service stops.
+On start, each estimator is rebuilt from its definition, given the saved state,
+and stepped through only the rows written after the checkpoint.
+Any estimates written after the checkpoint are removed first, as they are written again.
+
+The registration of each forecaster is also stored, as a record which is written when it is registered.
+
+Each worker only restores the estimators and forecasters of the batteries it owns
+when batteries are shared between several workers (see :mod:`roviweb.cluster`).
+"""
+from copy import deepcopy
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Event, Thread
+from typing import Any
+import logging
+import os
+import pickle
+
+from roviweb.artifacts import get_artifact_store
+from roviweb.cluster import is_local
+from roviweb.db import table_watermark, delete_rows_after
+from roviweb.online import estimators, register_estimator, update_estimator, EstimatorHolder
+from roviweb.prognosis import list_forecasters, register_forecaster, load_forecast_function
+from roviweb.schemas import WritePolicy, InputWindow, ForecasterInfo
+from roviweb.workers import (EstimatorSpec, list_remote_status, save_remote_state, workers_enabled,
+                             place_estimator, save_state, restore_state)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Checkpoint:
+    """Everything needed to recreate an estimator after a restart"""
+
+    artifact: str
+    """Digest of the definition and files which build the estimator"""
+    start_time: float
+    """Amount of time required until we can train the estimator (units: s)"""
+    fleet: bool
+    """Whether to step the estimator alongside others which share the same model"""
+    write_policy: WritePolicy
+    """Conditions under which state estimates are written to the database"""
+    state: dict[str, Any]
+    """Attributes of the holder which change as the estimator is stepped"""
+
+
+@dataclass
+class ForecasterRecord:
+    """Everything needed to recreate a forecaster after a restart"""
+
+    artifact: str
+    """Digest of the definition and files which create the forecast function"""
+    sql_query: str | None
+    """Query used against the time series database to gather inference inputs"""
+    input_window: InputWindow | None
+    """Recent estimates used as inputs"""
+    vectorized: bool
+    """Whether the function accepts many load scenarios at once"""
+
+
+_directory: Path | None = None
+_forecaster_directory: Path | None = None
+_interval: float = 300.
+_ticker: Thread | None = None
+_stop = Event()
+
+
+def configure_checkpoints(data_dir: str | Path | None = None, interval: float | None = None):
+    """Set where and how often checkpoints are written
+
+    Args:
+        data_dir: Directory holding the data of the web service, in which checkpoints are stored in ``checkpoints``
+            and the records of forecasters in ``forecasters``.
+            Read from the ``ROVIWEB_DATA_DIR`` environment variable if not provided, default of ``roviweb-data``
+        interval: Time between checkpoints (units: s). Read from the ``ROVIWEB_CHECKPOINT_INTERVAL``
+            environment variable if not provided, default of 300 s. Checkpoints are only written
+            at shutdown if zero
+    """
+    global _directory, _forecaster_directory, _interval
+    data_dir = data_dir or os.environ.get('ROVIWEB_DATA_DIR', 'roviweb-data')
+    _directory = Path(data_dir) / 'checkpoints'
+    _forecaster_directory = Path(data_dir) / 'forecasters'
+    _interval = float(interval if interval is not None else os.environ.get('ROVIWEB_CHECKPOINT_INTERVAL', 300.))
+
+
+def _get_directory() -> Path:
+    if _directory is None:
+        configure_checkpoints()
+    return _directory
+
+
+def _write_atomic(path: Path, data: bytes):
+    """Write to a temporary file then move it into place so a failure never leaves a partial file"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    staged = path.with_name(f'.{path.name}.incoming')
+    staged.write_bytes(data)
+    staged.replace(path)
+
+
+def _make_checkpoint(name: str) -> Checkpoint | None:
+    """Copy the state of the estimator for a battery, ``None`` if there is no estimator"""
+    # Copy the state from the worker which holds it
+    if (remote := save_remote_state(name)) is not None:
+        spec, state = remote
+        digest = get_artifact_store().put(spec.definition, spec.files)
+        return Checkpoint(artifact=digest, start_time=spec.start_time, fleet=spec.fleet,
+                          write_policy=spec.write_policy, state=state)
+
+    holder: EstimatorHolder | None = estimators.get(name)
+    if holder is None:
+        return None
+    if holder.artifact is None or not get_artifact_store().has(holder.artifact):
+        raise ValueError(f'The definition of the estimator for {name} is not in the artifact store')
+
+    # Ensure the estimator is not stepped while copying
+    if holder.fleet:
+        from roviweb.fleet import get_fleet_engine
+        with get_fleet_engine().paused():
+            state = deepcopy(save_state(holder))
+    else:
+        with holder._lock:
+            state = deepcopy(save_state(holder))
+    return Checkpoint(artifact=holder.artifact, start_time=holder.start_time, fleet=holder.fleet,
+                      write_policy=holder.write_policy, state=state)
+
+
+def save_checkpoint(name: str):
+    """Write the checkpoint for a single battery, removing any earlier checkpoint if it has no estimator
+
+    Args:
+        name: Name of the battery
+    """
+    directory = _get_directory()
+    path = directory / f'{name}.pkl'
+    checkpoint = _make_checkpoint(name)
+    if checkpoint is None:
+        path.unlink(missing_ok=True)
+        return
+
+    _write_atomic(path, pickle.dumps(checkpoint))
+
+
+def save_checkpoints() -> int:
+    """Write a checkpoint for every estimator and remove those of estimators no longer registered
+
+    Returns:
+        Number of checkpoints written
+    """
+    names = set(estimators.keys()).union(list_remote_status().keys())
+    count = 0
+    for name in sorted(names):
+        try:
+            save_checkpoint(name)
+            count += 1
+        except Exception:
+            logger.exception(f'Failed to save a checkpoint for {name}')
+
+    # Remove checkpoints of removed estimators, leaving those of batteries owned by other workers
+    directory = _get_directory()
+    if directory.is_dir():
+        for path in directory.glob('*.pkl'):
+            if path.stem not in names and is_local(path.stem):
+                path.unlink(missing_ok=True)
+    return count
+
+
+def restore_checkpoints() -> list[str]:
+    """Recreate the estimators from their checkpoints and step them through any data written since
+
+    Returns:
+        Names of the batteries whose estimators were restored
+    """
+    directory = _get_directory()
+    if not directory.is_dir():
+        return []
+
+    restored = []
+    for path in sorted(directory.glob('*.pkl')):
+        name = path.stem
+        if not is_local(name):
+            continue
+        try:
+            checkpoint: Checkpoint = pickle.loads(path.read_bytes())
+            definition, files = get_artifact_store().get(checkpoint.artifact)
+            spec = EstimatorSpec(definition=definition, files=files, start_time=checkpoint.start_time,
+                                 fleet=checkpoint.fleet, write_policy=checkpoint.write_policy)
+
+            # Remove estimates from after the checkpoint, which are written again when stepping through the rows
+            removed = delete_rows_after(f'{name}_estimates', checkpoint.state['last_time'])
+            if removed > 0:
+                logger.info(f'Removed {removed} estimates for {name} written after its checkpoint')
+
+            if workers_enabled():
+                place_estimator(name, spec, checkpoint.state)
+            else:
+                holder = spec.make_holder(build=False)
+                restore_state(holder, checkpoint.state)
+                register_estimator(name, holder)
+        except Exception:
+            logger.exception(f'Failed to restore the estimator for {name} from {path}')
+            continue
+        restored.append(name)
+
+        # Step through the rows written after the checkpoint, if any data are available
+        (_, rows), _ = table_watermark(name)
+        if rows > 0:
+            try:
+                update_estimator(name)
+            except Exception:
+                logger.exception(f'Failed to update the restored estimator for {name}')
+    logger.info(f'Restored {len(restored)} estimators from checkpoints')
+    return restored
+
+
+def save_forecaster(name: str):
+    """Write the record of the forecaster for a battery
+
+    Args:
+        name: Name of the battery
+    """
+    forecaster: ForecasterInfo = list_forecasters()[name]
+    if forecaster.artifact is None or not get_artifact_store().has(forecaster.artifact):
+        raise ValueError(f'The definition of the forecaster for {name} is not in the artifact store')
+    if _forecaster_directory is None:
+        configure_checkpoints()
+    record = ForecasterRecord(artifact=forecaster.artifact, sql_query=forecaster.sql_query,
+                              input_window=forecaster.input_window, vectorized=forecaster.vectorized)
+    _write_atomic(_forecaster_directory / f'{name}.pkl', pickle.dumps(record))
+
+
+def restore_forecasters() -> list[str]:
+    """Recreate the forecasters from their records
+
+    Returns:
+        Names of the batteries whose forecasters were restored
+    """
+    if _forecaster_directory is None:
+        configure_checkpoints()
+    if not _forecaster_directory.is_dir():
+        return []
+
+    restored = []
+    for path in sorted(_forecaster_directory.glob('*.pkl')):
+        name = path.stem
+        if not is_local(name):
+            continue
+        try:
+            record: ForecasterRecord = pickle.loads(path.read_bytes())
+            definition, files = get_artifact_store().get(record.artifact)
+            function = load_forecast_function(name, definition, files)
+            register_forecaster(name, ForecasterInfo(function=function, sql_query=record.sql_query,
+                                                     input_window=record.input_window,
+                                                     vectorized=record.vectorized, artifact=record.artifact))
+        except Exception:
+            logger.exception(f'Failed to restore the forecaster for {name} from {path}')
+            continue
+        restored.append(name)
+    logger.info(f'Restored {len(restored)} forecasters')
+    return restored
+
+
+def is_checkpointing() -> bool:
+    """Whether checkpoints are being written on a timer"""
+    return _ticker is not None and _ticker.is_alive()
+
+
+def start_checkpoints():
+    """Begin writing checkpoints on a timer, if an interval is set"""
+    global _ticker
+    if is_checkpointing() or _interval <= 0:
+        return
+
+    def _run():
+        while not _stop.wait(_interval):
+            save_checkpoints()
+
+    _stop.clear()
+    _ticker = Thread(target=_run, daemon=True, name='checkpoints')
+    _ticker.start()
+
+
+def stop_checkpoints():
+    """Stop the timer and write a final checkpoint for every estimator"""
+    global _ticker
+    if _ticker is not None:
+        _stop.set()
+        _ticker.join()
+        _ticker = None
+    save_checkpoints()
@@ -1,52 +1,72 @@
 """Command line utility for interacting with the web service"""
-import time
 from argparse import ArgumentParser
+from contextlib import AsyncExitStack
+from dataclasses import dataclass
 from pathlib import Path
+from threading import Lock
+from typing import Iterator
+import asyncio
+import json
 
 import msgpack
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pyarrow import ipc, parquet as pq
 from battdat.data import BatteryDataset
 from pydantic import TypeAdapter
-from httpx_ws import connect_ws
+from httpx_ws import aconnect_ws, AsyncWebSocketSession
 import httpx
+import tables
 
+from roviweb.artifacts import bundle_digest
 from roviweb.schemas import EstimatorStatus, BatteryStats
 
 
 def upload_function(args, functionality: str, **kwargs):
     """Upload a function to the web service
 
-    Keyword args are added as arguments to the form data
+    Keyword args are added as arguments to the form data.
+    The definition and files are only sent if the web service does not already hold them.
 
     Args:
         args: Arguments passed to the CLI
         functionality: Name of the functionality
     """
-    pointers = []  # Holds pointers to files being sent
-    try:
-        # Open pointers to all files
-        context_files = []
-        for file in args.context_file:
-            file = Path(file)
-            fp = open(file, 'rb')
-            pointers.append(fp)
-            context_files.append(('files', (file.name, fp)))
-
-        # Read the in the definition file
-        definition = Path(args.py_file).read_text()
-
-        # Push to the web service
-        reply = httpx.post(f'{args.url}/{functionality}/register',
-                           data={'name': args.name, 'definition': definition, **kwargs},
-                           files=context_files)
-        if reply.status_code != 200:
-            raise ValueError(f'Upload failed status_code={reply.status_code}. {reply.text}')
-        response = reply.text
-        print(f'Uploaded a {functionality} tool for data_source={args.name}. Response={response}')
-    finally:
-        for pt in pointers:
-            pt.close()
+    # Read the definition and context files
+    definition = Path(args.py_file).read_text()
+    context_files = dict((Path(file).name, Path(file).read_bytes()) for file in args.context_file)
+
+    # Refer to the files by their digest if the web service has them already
+    digest = bundle_digest(definition, context_files)
+    if httpx.get(f'{args.url}/artifacts/{digest}').status_code == 200:
+        data, files = {'artifact': digest}, []
+    else:
+        data, files = {'definition': definition}, [('files', item) for item in context_files.items()]
+
+    # Push to the web service
+    reply = httpx.post(f'{args.url}/{functionality}/register',
+                       data={'name': args.name, **data, **kwargs},
+                       files=files)
+    if reply.status_code != 200:
+        raise ValueError(f'Upload failed status_code={reply.status_code}. {reply.text}')
+    response = reply.text
+    print(f'Uploaded a {functionality} tool for data_source={args.name}. Response={response}')
+
+
+def _prognosis_inputs(args) -> dict:
+    """Gather the form data describing the inputs to a forecaster"""
+    inputs = {}
+    if args.sql_query:
+        inputs['sql_query'] = args.sql_query
+    if args.vectorized:
+        inputs['vectorized'] = True
+    if args.window_columns is not None:
+        inputs['window_columns'] = args.window_columns
+        for key in ['window_rows', 'window_duration']:
+            if (value := getattr(args, key)) is not None:
+                inputs[key] = value
+    return inputs
 
 
 def get_status(args):
@@ -76,12 +96,11 @@ def get_status(args):
         print(f'  Latest time: {info.latest_time:.2f} s')
 
 
-def print_status(args):
-    # Pull status from the service
-    est_status = httpx.get(f'{args.url}/online/status').json()
-    if args.name not in est_status:
+def _print_estimator(est_status: dict, name: str):
+    """Print the state of the estimator for a battery, if there is one"""
+    if name not in est_status:
         return
-    est_status = EstimatorStatus.model_validate(est_status[args.name])
+    est_status = EstimatorStatus.model_validate(est_status[name])
 
     print(f'Estimator status at test_time: {est_status.latest_time:.1f} s:')
     state = pd.DataFrame({
@@ -92,44 +111,261 @@ def print_status(args):
     print(state.to_string(index=False))
 
 
-def stream_data(args):
-    dataset = BatteryDataset.from_hdf(args.path)
-    print(f'Beginning to stream data for {args.name}')
+def iter_raw_data(path: str | Path, chunk_size: int, max_rows: int | None = None) -> Iterator[pa.Table]:
+    """Read the raw data from a battdat HDF5 file in chunks, holding only one chunk in memory at a time
+
+    Args:
+        path: Path to the HDF5 file
+        chunk_size: Maximum number of rows per chunk
+        max_rows: Maximum number of rows to read, all rows if not provided
+    Yields:
+        Chunks of the raw data in order
+    """
+    with tables.File(path, mode='r') as file:
+        table = file.get_node('/raw_data')
+        stop = table.nrows if max_rows is None else min(table.nrows, max_rows)
+        for start in range(0, stop, chunk_size):
+            rows = table.read(start, min(start + chunk_size, stop))
+            yield pa.table({c: rows[c] for c in rows.dtype.names})
 
-    with connect_ws(f'{args.url}/db/upload/{args.name}') as ws:
-        # Start sending data
-        last_time = None
-        for i, row in dataset.tables['raw_data'].iterrows():
-            # Pause to simulate data being acquired at known rates
-            if args.clock_factor is not None and last_time is not None:
-                sleep_time = (row['test_time'] - last_time) / args.clock_factor
-                time.sleep(sleep_time)
-            last_time = row['test_time']
 
-            # Send a row
-            if args.max_to_upload is not None and i >= args.max_to_upload:
-                break
-            ws.send_bytes(msgpack.dumps(row.to_dict()))
+def encode_chunk(chunk: pa.Table | pd.DataFrame, upload_format: str) -> tuple[bytes, str]:
+    """Encode a chunk of data in a columnar format
+
+    Arrow streams are compressed with Zstandard.
+
+    Args:
+        chunk: Data to be encoded
+        upload_format: Name of the format: arrow, parquet, msgpack, or json
+    Returns:
+        - Encoded data
+        - Content type of the encoded data
+    """
+
+    if isinstance(chunk, pd.DataFrame):
+        chunk = pa.Table.from_pandas(chunk, preserve_index=False)
+
+    if upload_format == 'msgpack':
+        return msgpack.packb(chunk.to_pydict()), 'application/msgpack'
+    elif upload_format == 'json':
+        return json.dumps(chunk.to_pylist()).encode(), 'application/json'
+
+    sink = pa.BufferOutputStream()
+    if upload_format == 'arrow':
+        with ipc.new_stream(sink, chunk.schema, options=ipc.IpcWriteOptions(compression='zstd')) as writer:
+            writer.write_table(chunk)
+        content_type = 'application/vnd.apache.arrow.stream'
+    elif upload_format == 'parquet':
+        pq.write_table(chunk, sink)
+        content_type = 'application/vnd.apache.parquet'
+    else:
+        raise ValueError(f'Unsupported format: {upload_format}')
+    return sink.getvalue().to_pybytes(), content_type
 
-            # Print estimator status if we hit a marker
-            if args.report_freq is not None and int(str(i)) % args.report_freq == 0:
-                print_status(args)
+
+def make_client(url: str, max_connections: int = 1) -> httpx.AsyncClient:
+    """Make a client which reuses connections to the web service
+
+    Args:
+        url: URL of the web service
+        max_connections: Maximum number of connections held open at once
+    Returns:
+        Client for the web service
+    """
+    return httpx.AsyncClient(base_url=url, limits=httpx.Limits(max_connections=max_connections), timeout=None)
+
+
+async def _report_status(client: httpx.AsyncClient, name: str, interval: float):
+    """Print the state of the estimator on a timer"""
+    while True:
+        await asyncio.sleep(interval)
+        _print_estimator((await client.get('/online/status')).json(), name)
+
+
+async def _upload_chunks(args):
+    """Read, encode, and send chunks of data, keeping several requests in flight"""
+    path = f'/db/upload/{args.name}' + ('' if args.upload_format == 'json' else '/columnar')
+    chunks = iter_raw_data(args.path, args.chunk_size, args.max_to_upload)
+    async with make_client(args.url, max_connections=args.in_flight) as client:
+        # Rows must reach an estimator in order, which is only certain if chunks are written one at a time
+        in_flight = args.in_flight
+        if in_flight > 1 and args.name in (await client.get('/online/status')).json():
+            print(f'Sending one chunk at a time so the estimator for {args.name} receives rows in order')
+            in_flight = 1
+        slots = asyncio.Semaphore(in_flight)
+
+        async def _send(content: bytes, content_type: str, num_rows: int):
+            try:
+                reply = await client.post(path, content=content, headers={'content-type': content_type})
+            finally:
+                slots.release()
+            if reply.status_code != 200 or reply.json() != num_rows:
+                raise ValueError(f'Upload failed: {reply.text}')
+
+        reporter = None
+        if args.report_interval is not None:
+            reporter = asyncio.create_task(_report_status(client, args.name, args.report_interval))
+        sends, total = [], 0
+        try:
+            # Read and encode the next chunk while others are being sent
+            while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+                content, content_type = await asyncio.to_thread(encode_chunk, chunk, args.upload_format)
+                await slots.acquire()
+                for finished in [s for s in sends if s.done()]:
+                    sends.remove(finished)
+                    finished.result()  # Stop if an upload failed
+                sends.append(asyncio.create_task(_send(content, content_type, chunk.num_rows)))
+                total += chunk.num_rows
+            await asyncio.gather(*sends)
+        finally:
+            for task in sends + ([reporter] if reporter is not None else []):
+                task.cancel()
+            chunks.close()
+
+        print(f'Uploaded {total} rows for {args.name}')
+        _print_estimator((await client.get('/online/status')).json(), args.name)
 
 
 def upload_data(args):
-    # Load the data to be uploaded
-    dataset = BatteryDataset.from_hdf(args.path)
-    to_upload = dataset.tables['raw_data']
-    if args.max_to_upload is not None:
-        to_upload = to_upload.head(args.max_to_upload)
+    asyncio.run(_upload_chunks(args))
+
+
+_hdf5_lock = Lock()  # PyTables is not safe to use from several threads at once
+
+
+def _next_rows(chunks: Iterator[pa.Table]) -> tuple[list[dict], np.ndarray] | None:
+    """Read the next chunk of a file as a list of records and their test times, ``None`` if there are no more"""
+    with _hdf5_lock:
+        chunk = next(chunks, None)
+    if chunk is None:
+        return None
+    return chunk.to_pylist(), chunk['test_time'].to_numpy()
+
+
+@dataclass
+class ReplayProgress:
+    """Progress of replaying the data from one file"""
+
+    name: str
+    """Name of the battery receiving the data"""
+    start: float | None = None
+    """Time the first row was due (units: s, event loop clock)"""
+    first_time: float | None = None
+    """Test time of the first row (units: s)"""
+    last_time: float | None = None
+    """Test time of the latest row sent (units: s)"""
+    last_sent: float | None = None
+    """Time the latest row was sent (units: s, event loop clock)"""
+    rows: int = 0
+    """Number of rows sent"""
+    frames: int = 0
+    """Number of messages sent"""
+    max_lag: float = 0.
+    """Longest time between when a row was due and when it was sent (units: s)"""
+
+
+async def _replay_file(client: httpx.AsyncClient, ws: AsyncWebSocketSession, path: str | Path,
+                       progress: ReplayProgress, ready: asyncio.Barrier, args):
+    """Send the rows of one file over a websocket at the rate they were acquired
+
+    Each row is due at a fixed offset from the start of the replay, so delays in sending one row
+    do not push back those after it. All rows which are due are sent together in one message.
+    The next chunk of the file is read while sending the current one.
+    """
+    loop = asyncio.get_running_loop()
+    chunks = iter_raw_data(path, args.chunk_size, args.max_to_upload)
+    next_chunk = asyncio.create_task(asyncio.to_thread(_next_rows, chunks))
+    try:
+        # Start the clock once the first chunk of every file has been read
+        await asyncio.wait([next_chunk])
+        await ready.wait()
+        progress.start = loop.time()
+
+        while (chunk := await next_chunk) is not None:
+            next_chunk = asyncio.create_task(asyncio.to_thread(_next_rows, chunks))
+            rows, times = chunk
+            if progress.first_time is None:
+                progress.first_time = float(times[0])
+            deadlines = progress.start + (times - progress.first_time) / args.clock_factor
+
+            i = 0
+            while i < len(rows):
+                # Wait until the next row is due
+                now = loop.time()
+                if deadlines[i] > now:
+                    await asyncio.sleep(deadlines[i] - now)
+                    now = loop.time()
+
+                # Send every row which is due
+                end = max(i + 1, min(int(np.searchsorted(deadlines, now, side='right')), i + args.max_frame_rows))
+                await ws.send_bytes(msgpack.packb(rows[i] if end == i + 1 else rows[i:end]))
+                progress.max_lag = max(progress.max_lag, now - deadlines[i])
+                progress.last_time, progress.last_sent = float(times[end - 1]), now
+                progress.frames += 1
+
+                # Print estimator state after every `report_freq` rows
+                before, progress.rows = progress.rows, progress.rows + end - i
+                if args.report_freq is not None and before // args.report_freq != progress.rows // args.report_freq:
+                    _print_estimator((await client.get('/online/status')).json(), progress.name)
+                i = end
+    finally:
+        await asyncio.wait([next_chunk])  # Finish reading before closing the file
+        with _hdf5_lock:
+            chunks.close()
+
+
+def _print_replay(sources: list[ReplayProgress], clock_factor: float):
+    """Print the rate at which data have been sent compared to the requested rate"""
+    started = [s for s in sources if s.last_sent is not None]
+    if len(started) == 0:
+        return
+    elapsed = max(max(s.last_sent for s in started) - min(s.start for s in started), 1e-6)
+    rows = sum(s.rows for s in sources)
+    speedup = sum(s.last_time - s.first_time for s in started) / sum(max(s.last_sent - s.start, 1e-6) for s in started)
+    print(f'Replayed {rows} rows in {sum(s.frames for s in sources)} messages to {len(started)} batteries'
+          f' over {elapsed:.1f} s ({rows / elapsed:.1f} rows/s).'
+          f' Achieved {speedup:.3g}x real time of {clock_factor:.3g}x requested.'
+          f' Longest delay: {max(s.max_lag for s in started) * 1000:.1f} ms')
+
+
+async def _report_replay(sources: list[ReplayProgress], clock_factor: float, interval: float):
+    """Print the replay rate on a timer"""
+    while True:
+        await asyncio.sleep(interval)
+        _print_replay(sources, clock_factor)
+
+
+async def _replay(args):
+    """Replay data from one or more files to many batteries at once"""
+    files = [(args.name, args.path)] + [tuple(s) for s in args.source or ()]
+    if args.copies > 1:
+        files = [(f'{name}_{i}', path) for name, path in files for i in range(args.copies)]
+    print(f'Beginning to stream data for {", ".join(name for name, _ in files)}')
+
+    async with make_client(args.url, max_connections=len(files) + 1) as client, AsyncExitStack() as stack:
+        # Open every connection before starting the clock so that connecting does not delay the first rows
+        sockets = []
+        for name, _ in files:
+            socket = aconnect_ws(f'/db/upload/{name}', client, keepalive_ping_interval_seconds=None)
+            sockets.append(await stack.enter_async_context(socket))
+        sources = [ReplayProgress(name=name) for name, _ in files]
+        ready = asyncio.Barrier(len(files))
+
+        reporter = None
+        if args.report_interval is not None:
+            reporter = asyncio.create_task(_report_replay(sources, args.clock_factor, args.report_interval))
+        try:
+            async with asyncio.TaskGroup() as group:
+                for (_, path), ws, progress in zip(files, sockets, sources):
+                    group.create_task(_replay_file(client, ws, path, progress, ready, args))
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+    _print_replay(sources, args.clock_factor)
+
 
-    # Send it in chunks based on the report freq
-    num_chunks = len(to_upload) // args.report_freq + 1
-    for chunk in np.array_split(to_upload, num_chunks):
-        reply = httpx.post(f'{args.url}/db/upload/{args.name}', data=chunk.to_json(orient='records'))
-        if reply.json() != len(chunk):
-            raise ValueError(f'Upload failed: {reply.text}')
-        print_status(args)
+def stream_data(args):
+    asyncio.run(_replay(args))
 
 
 def register_metadata(args):
@@ -168,9 +404,17 @@ def main(args=None):
     subparser = prog_subparsers.add_parser('register', help='Register a health forecaster')
     subparser.add_argument('name', help='Name of the data source associated with this estimator')
     subparser.add_argument('py_file', help='Path to the python file containing forecast function definition')
-    subparser.add_argument('sql_query', help='Query used to get history used for prognosis')
+    subparser.add_argument('--window-columns', nargs='+', default=None,
+                           help='Columns of the health estimates held in memory as inputs, used in place of the query')
+    subparser.add_argument('--window-rows', type=int, default=None, help='Number of recent estimates to hold')
+    subparser.add_argument('--window-duration', type=float, default=None,
+                           help='Span of test time of recent estimates to hold (units: s)')
+    subparser.add_argument('--vectorized', action='store_true',
+                           help='Whether the forecast function accepts many load scenarios at once')
+    subparser.add_argument('sql_query', help='Query used to get history used for prognosis. '
+                                             'Pass an empty string if using an input window')
     subparser.add_argument('context_file', nargs='*', help='Paths to additional files needed for forecaster')
-    subparser.set_defaults(action=lambda x: upload_function(x, 'prognosis', sql_query=x.sql_query))
+    subparser.set_defaults(action=lambda x: upload_function(x, 'prognosis', **_prognosis_inputs(x)))
 
     # Actions associated with metadata
     subparser = subparsers.add_parser('register', help='Register metadata for a cell')
@@ -181,11 +425,26 @@ def main(args=None):
     subparser = subparsers.add_parser('upload', help='Upload data from a battdat HDF5 file')
     subparser.add_argument('--max-to-upload', help='Maximum number of rows to upload',
                            default=None, type=int)
-    subparser.add_argument('--report-freq', help='After how many data uploads to print estimator state',
+    subparser.add_argument('--report-freq', help='After how many rows streamed to print estimator state',
                            default=None, type=int)
+    subparser.add_argument('--report-interval', help='Time between printing progress (units: s)',
+                           default=5., type=float)
+    subparser.add_argument('--upload-format', help='Format used when uploading data in bulk',
+                           default='arrow', choices=['arrow', 'parquet', 'msgpack', 'json'])
+    subparser.add_argument('--chunk-size', help='Number of rows read from the file at once,'
+                                                ' and sent at once when uploading in bulk',
+                           default=65536, type=int)
+    subparser.add_argument('--in-flight', help='Number of chunks being sent at once when uploading in bulk',
+                           default=4, type=int)
     subparser.add_argument('--clock-factor',
                            help='How much to accelerate uploading compared to rate data were collected.'
                                 ' Uploads as fast as possible as the default', default=None, type=float)
+    subparser.add_argument('--max-frame-rows', help='Maximum number of rows sent in one message when streaming',
+                           default=1024, type=int)
+    subparser.add_argument('--source', nargs=2, action='append', metavar=('NAME', 'PATH'),
+                           help='Another data source to stream at the same time')
+    subparser.add_argument('--copies', help='Number of batteries which receive each file when streaming,'
+                                            ' named by appending the copy number', default=1, type=int)
     subparser.add_argument('name', help='Name of the data source to create')
     subparser.add_argument('path', help='Path to the HDF5 file')
     subparser.set_defaults(action=lambda x: upload_data(x) if x.clock_factor is None else stream_data(x))
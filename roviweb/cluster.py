@@ -0,0 +1,485 @@
+"""Share the batteries between several web service processes
+
+Running more than one worker process (``uvicorn --workers N``) requires setting ``ROVIWEB_WORKERS`` to the same ``N``.
+Each battery is owned by exactly one worker, chosen from a hash of its name,
+which holds its data in a database file of its own, runs its estimator and forecaster,
+and answers every request about it.
+The workers listen on Unix sockets in the data directory and forward requests about batteries
+they do not own to the owner through that socket.
+Requests which cover every battery, such as the status of all estimators, are answered by
+gathering the replies of all workers (see :meth:`gather`).
+
+Workers take the first free index from ``0`` to ``N - 1`` by locking a file in the data directory,
+so a worker which restarts takes the place, and batteries, of the one it replaces.
+Registrations are stored in the data directory (see :mod:`roviweb.checkpoints`) so that the new worker recovers them.
+"""
+from contextlib import asynccontextmanager
+from hashlib import sha256
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, AsyncIterator, Mapping, TextIO
+from uuid import uuid4
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import re
+
+import httpx
+from httpx_ws import aconnect_ws, HTTPXWSException, WebSocketDisconnect
+from starlette.requests import Request
+from starlette.types import ASGIApp, Receive, Scope, Send
+from wsproto.events import BytesMessage, TextMessage
+
+if TYPE_CHECKING:
+    import uvicorn
+
+logger = logging.getLogger(__name__)
+
+FORWARDED_HEADER = 'x-roviweb-worker'
+"""Header marking a request forwarded from another worker, which holds the index of the sender.
+Only trusted on requests received through the socket which listens to other workers"""
+_from_worker_key = 'roviweb.from_worker'
+"""Key added to the scope of requests received through the socket which listens to other workers"""
+
+_num_workers: int = 1
+_index: int = 0
+_directory: Path | None = None
+_lock_file: TextIO | None = None
+_server: 'uvicorn.Server | None' = None
+
+_battery_routes = tuple(re.compile(p) for p in [
+    r'^/db/upload/(?P<name>[^/]+)(?:/columnar)?$',
+    r'^/series/(?P<name>[^/]+?)(?:_estimates)?$',  # Estimates are held by the owner of the battery
+    r'^/prognosis/(?P<name>[^/]+)/run$',
+    r'^/dashboard/(?!render-cache$)(?P<name>[^/]+)(?:/img/[^/]+)?$',
+])
+"""Patterns of the paths of requests about a single battery"""
+_form_routes = ('/online/register', '/prognosis/register')
+"""Routes which give the name of the battery in a form"""
+
+
+def configure_cluster(num_workers: int | None = None, data_dir: str | Path | None = None):
+    """Set the number of worker processes and claim the index of this one
+
+    Args:
+        num_workers: Number of worker processes serving the web service.
+            Read from the ``ROVIWEB_WORKERS`` environment variable if not provided, default of 1
+        data_dir: Directory holding the data of the web service, in which the sockets are stored in ``cluster``.
+            Read from the ``ROVIWEB_DATA_DIR`` environment variable if not provided, default of ``roviweb-data``
+    """
+    global _num_workers, _index, _directory, _lock_file
+    close_cluster()
+    _num_workers = int(num_workers if num_workers is not None else os.environ.get('ROVIWEB_WORKERS', 1))
+    _index = 0
+    if _num_workers <= 1:
+        return
+
+    # Take the first index not held by another process
+    data_dir = data_dir or os.environ.get('ROVIWEB_DATA_DIR', 'roviweb-data')
+    _directory = Path(data_dir) / 'cluster'
+    _directory.mkdir(parents=True, exist_ok=True)
+    for index in range(_num_workers):
+        lock_file = _directory.joinpath(f'{index}.lock').open('w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            continue
+        _index, _lock_file = index, lock_file
+        logger.info(f'Serving as worker {index} of {_num_workers}')
+        return
+    raise RuntimeError(f'All {_num_workers} worker indices are taken. '
+                       'Is ROVIWEB_WORKERS less than the number of workers?')
+
+
+def close_cluster():
+    """Release the index of this worker"""
+    global _lock_file, _num_workers
+    if _lock_file is not None:
+        _lock_file.close()  # Also releases the lock
+        _lock_file = None
+    _num_workers = 1
+
+
+def cluster_enabled() -> bool:
+    """Whether the batteries are shared between several workers"""
+    return _num_workers > 1
+
+
+def worker_index() -> int:
+    """Index of this worker"""
+    return _index
+
+
+def socket_path(index: int) -> Path:
+    """Path to the socket on which a worker listens
+
+    Args:
+        index: Index of the worker
+    Returns:
+        Path to the Unix socket
+    """
+    return _directory / f'{index}.sock'
+
+
+def owner_of(name: str) -> int:
+    """Index of the worker which owns a battery
+
+    Args:
+        name: Name of the battery
+    Returns:
+        Index of the worker
+    """
+    if not cluster_enabled():
+        return _index
+    return int.from_bytes(sha256(name.encode()).digest()[:8], 'big') % _num_workers
+
+
+def is_local(name: str) -> bool:
+    """Whether a battery is owned by this worker
+
+    Args:
+        name: Name of the battery
+    """
+    return owner_of(name) == _index
+
+
+def split_by_owner(names: list[str]) -> dict[int, list[str]]:
+    """Group batteries by the worker which owns them
+
+    Args:
+        names: Names of the batteries
+    Returns:
+        Map of worker index to the names of the batteries it owns, in their original order
+    """
+    groups: dict[int, list[str]] = {}
+    for name in names:
+        groups.setdefault(owner_of(name), []).append(name)
+    return groups
+
+
+def is_forwarded(request: Request) -> bool:
+    """Whether a request was forwarded from another worker
+
+    Args:
+        request: Request being served
+    """
+    return FORWARDED_HEADER in request.headers
+
+
+@asynccontextmanager
+async def _connect(index: int) -> AsyncIterator[httpx.AsyncClient]:
+    """Open a client which sends requests to another worker"""
+    transport = httpx.AsyncHTTPTransport(uds=str(socket_path(index)))
+    # Requests, such as registering an estimator, may run longer than the default timeouts
+    async with httpx.AsyncClient(transport=transport, base_url=f'http://worker-{index}',
+                                 headers={FORWARDED_HEADER: str(_index)},
+                                 timeout=httpx.Timeout(None, connect=5.)) as client:
+        yield client
+
+
+async def request_worker(index: int, method: str, url: str, **kwargs) -> httpx.Response:
+    """Send a request to another worker
+
+    Args:
+        index: Index of the worker
+        method: HTTP method
+        url: Path and query of the request
+        kwargs: Passed to :meth:`httpx.AsyncClient.request`
+    Returns:
+        Reply from the worker
+    """
+    async with _connect(index) as client:
+        return await client.request(method, url, **kwargs)
+
+
+async def gather(request: Request, local: Mapping[str, Any], url: str | None = None) -> dict[str, Any]:
+    """Combine a map of battery name to details from this worker with those from every other worker
+
+    Workers which cannot be reached or whose replies are errors are skipped.
+
+    Args:
+        request: Request being served, which is not sent to other workers if it was forwarded
+        local: Details of the batteries owned by this worker
+        url: Path and query of the request which gives those details, default is that of the request being served
+    Returns:
+        Details from all workers
+    """
+    merged = dict(local)
+    if not cluster_enabled() or is_forwarded(request):
+        return merged
+
+    if url is None:
+        url = request.url.path + (f'?{request.url.query}' if request.url.query else '')
+    others = [i for i in range(_num_workers) if i != _index]
+    replies = await asyncio.gather(*[request_worker(i, 'GET', url) for i in others], return_exceptions=True)
+    for index, reply in zip(others, replies):
+        if isinstance(reply, httpx.TransportError):
+            logger.warning(f'Worker {index} could not be reached: {reply}')
+            continue
+        elif isinstance(reply, Exception):
+            logger.warning(f'Request to worker {index} failed: {reply}')
+            continue
+        elif isinstance(reply, BaseException):
+            raise reply
+
+        try:
+            reply.raise_for_status()
+            merged.update(reply.json())
+        except (httpx.HTTPStatusError, ValueError) as e:
+            logger.warning(f'Worker {index} gave a bad reply: {e}')
+    return merged
+
+
+async def start_cluster(app: ASGIApp):
+    """Listen for requests from other workers, if sharing batteries between workers
+
+    Args:
+        app: Application which serves the forwarded requests
+    """
+    global _server
+    if not cluster_enabled() or _server is not None:
+        return
+    import uvicorn  # Only needed when serving several workers
+
+    async def _from_worker(scope: Scope, receive: Receive, send: Send):
+        await app({**scope, _from_worker_key: True}, receive, send)
+
+    # Start only the listener, leaving lifespan, signal handling, and logging to the server which launched this worker
+    config = uvicorn.Config(_from_worker, uds=str(socket_path(_index)), lifespan='off',
+                            log_config=None, access_log=False)
+    config.load()
+    server = uvicorn.Server(config)
+    server.lifespan = config.lifespan_class(config)
+    await server.startup()
+    _server = server
+
+
+async def stop_cluster():
+    """Stop listening for requests from other workers"""
+    global _server
+    if _server is not None:
+        server, _server = _server, None
+        await server.shutdown()
+        socket_path(_index).unlink(missing_ok=True)
+
+
+def _replay(body: bytes, receive: Receive) -> Receive:
+    """Make a receive function which gives a body which has already been read, then any later messages"""
+    sent = False
+
+    async def _receive():
+        nonlocal sent
+        if sent:
+            return await receive()  # Such as a disconnect, which ends streaming responses
+        sent = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    return _receive
+
+
+async def _read_request(receive: Receive) -> bytes | AsyncIterator[bytes] | None:
+    """Read the body of a request if it arrives in one message, or prepare to stream it otherwise
+
+    Returns:
+        The whole body, an iterator over its parts, or ``None`` if the client disconnected
+    """
+    message = await receive()
+    if message['type'] == 'http.disconnect':
+        return None
+    if not message.get('more_body', False):
+        return message.get('body', b'')
+
+    async def _stream():
+        yield message.get('body', b'')
+        while True:
+            part = await receive()
+            if part['type'] == 'http.disconnect':
+                raise ConnectionError('Client disconnected while sending the request')
+            yield part.get('body', b'')
+            if not part.get('more_body', False):
+                return
+
+    return _stream()
+
+
+async def _send_error(send: Send, status: int, detail: str):
+    """Reply with an error in the same format as the application"""
+    content = json.dumps({'detail': detail}).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(content)).encode())]})
+    await send({'type': 'http.response.body', 'body': content})
+
+
+class ClusterMiddleware:
+    """Forward requests about a battery to the worker which owns it
+
+    The battery is found from the path of the request,
+    the form used to register estimators and forecasters, or the metadata used to register a battery.
+    Requests which do not name a battery are served by the worker which receives them.
+    Bodies are only read in full when the name is held within them, and are otherwise streamed to the owner.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if not cluster_enabled() or scope['type'] not in ('http', 'websocket') or scope.get(_from_worker_key):
+            return await self.app(scope, receive, send)
+
+        # Only other workers may mark a request as forwarded
+        header = FORWARDED_HEADER.encode()
+        if any(k == header for k, _ in scope['headers']):
+            scope = {**scope, 'headers': [(k, v) for k, v in scope['headers'] if k != header]}
+
+        if scope['type'] == 'websocket':
+            name = self._name_from_path(scope)
+            if name is None or is_local(name):
+                return await self.app(scope, receive, send)
+            return await self._forward_websocket(scope, receive, send, owner_of(name))
+
+        # Route by the path unless the name is only given in the body
+        if scope['method'] != 'POST' or (scope['path'] not in _form_routes and scope['path'] != '/db/register'):
+            name = self._name_from_path(scope)
+            if name is None or is_local(name):
+                return await self.app(scope, receive, send)
+            content = await _read_request(receive)
+            if content is None:
+                return
+            return await self._forward_http(scope, content, send, owner_of(name))
+
+        # Read the whole body, which is needed to find the name in forms
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        body = b''.join(chunks)
+
+        scope, body, name = await self._find_battery(scope, body, receive)
+        if name is None or is_local(name):
+            return await self.app(scope, _replay(body, receive), send)
+        await self._forward_http(scope, body, send, owner_of(name))
+
+    @staticmethod
+    def _name_from_path(scope: Scope) -> str | None:
+        """Get the name of the battery from the path of a request"""
+        for pattern in _battery_routes:
+            if (match := pattern.match(scope['path'])) is not None:
+                return match.group('name')
+        return None
+
+    async def _find_battery(self, scope: Scope, body: bytes, receive: Receive) -> tuple[Scope, bytes, str | None]:
+        """Find the name of the battery named in the body of a registration
+
+        Returns:
+            - Scope of the request, updated if the body was altered
+            - Body of the request
+            - Name of the battery, ``None`` if the request is not about a single battery
+        """
+        if scope['path'] in _form_routes:
+            form = await Request(scope, _replay(body, receive)).form()
+            name = form.get('name')
+            await form.close()
+            return scope, body, name if isinstance(name, str) else None
+
+        if scope['path'] == '/db/register':
+            # Assign the name of a battery which lacks one here, so that the owner is known
+            try:
+                metadata = json.loads(body)
+            except ValueError:
+                return scope, body, None  # Leave the application to reject it
+            if not isinstance(metadata, dict):
+                return scope, body, None
+            if not metadata.get('name'):
+                metadata['name'] = str(uuid4())
+                body = json.dumps(metadata).encode()
+                headers = [(k, v) for k, v in scope['headers'] if k != b'content-length']
+                scope = {**scope, 'headers': headers + [(b'content-length', str(len(body)).encode())]}
+            return scope, body, str(metadata['name'])
+        return scope, body, None
+
+    @staticmethod
+    def _target(scope: Scope) -> str:
+        """Path and query of a request"""
+        path = scope.get('raw_path') or scope['path'].encode()
+        query = scope.get('query_string', b'')
+        return (path + (b'?' + query if query else b'')).decode()
+
+    async def _forward_http(self, scope: Scope, content: bytes | AsyncIterator[bytes], send: Send, owner: int):
+        """Send a request to its owner and relay the reply
+
+        Args:
+            scope: Scope of the request
+            content: Whole body of the request, or an iterator over its parts if it is streamed to the owner
+            send: Function which sends the reply
+            owner: Index of the worker which owns the battery
+        """
+        # Keep the length of streamed bodies, which is that of the original request
+        dropped = (b'host', b'content-length') if isinstance(content, bytes) else (b'host',)
+        headers = [(k, v) for k, v in scope['headers'] if k not in dropped]
+        async with _connect(owner) as client:
+            request = client.build_request(scope['method'], self._target(scope), headers=headers, content=content)
+            try:
+                response = await client.send(request, stream=True)
+            except httpx.TransportError as e:
+                await _send_error(send, 503, f'Worker {owner}, which holds this battery, is not available: {e}')
+                return
+
+            try:
+                # Pass the body as received, leaving any compression in place
+                await send({'type': 'http.response.start', 'status': response.status_code,
+                            'headers': response.headers.raw})
+                async for chunk in response.aiter_raw():
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                await send({'type': 'http.response.body', 'body': b''})
+            finally:
+                await response.aclose()
+
+    async def _forward_websocket(self, scope: Scope, receive: Receive, send: Send, owner: int):
+        """Connect a socket to its owner and relay messages in both directions until either side closes"""
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+
+        async with _connect(owner) as client:
+            try:
+                async with aconnect_ws(self._target(scope), client, keepalive_ping_interval_seconds=None) as upstream:
+                    await send({'type': 'websocket.accept'})
+
+                    async def _to_owner():
+                        while True:
+                            message = await receive()
+                            if message['type'] == 'websocket.disconnect':
+                                return
+                            if message.get('bytes') is not None:
+                                await upstream.send_bytes(message['bytes'])
+                            elif message.get('text') is not None:
+                                await upstream.send_text(message['text'])
+
+                    async def _from_owner():
+                        while True:
+                            try:
+                                event = await upstream.receive()
+                            except WebSocketDisconnect as e:
+                                await send({'type': 'websocket.close', 'code': e.code})
+                                return
+                            if isinstance(event, BytesMessage):
+                                await send({'type': 'websocket.send', 'bytes': bytes(event.data)})
+                            elif isinstance(event, TextMessage):
+                                await send({'type': 'websocket.send', 'text': event.data})
+
+                    # Stop relaying once either side finishes, which closes the connection to the owner
+                    tasks = [asyncio.create_task(_to_owner()), asyncio.create_task(_from_owner())]
+                    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    for task in pending:
+                        task.cancel()
+                    for task in done:
+                        task.result()
+            except* (httpx.TransportError, HTTPXWSException) as e:
+                logger.warning(f'Could not connect to worker {owner}: {e}')
+                await send({'type': 'websocket.close', 'code': 1013})  # "Try again later"
@@ -1,14 +1,23 @@
 """Utility operations for working with the DuckDB"""
+import os
 import re
+from itertools import count
+from time import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import Lock, Thread, current_thread
 from uuid import uuid4
-from typing import Dict, Optional
+from typing import Dict, Optional, Iterable, Hashable
 
 from battdat.schemas import BatteryMetadata
 from duckdb import DuckDBPyConnection
 import duckdb
 
 import numpy as np
+import pyarrow as pa
 
+from roviweb.downsample import DownsampleMethod, downsample
 from roviweb.schemas import TableStats, BatteryStats, RecordType
 
 _data_types_to_sql = {
@@ -17,18 +26,186 @@ _data_types_to_sql = {
 }
 _name_re = re.compile(r'\w+$')
 
+ROLLUP_RESOLUTIONS = (10., 60., 900., 3600.)
+"""Widths of the time buckets held in the rollup tables of each battery (units: s)"""
+_rollup_stats = ('min', 'max', 'sum', 'count', 'last')
+_numeric_types = ('FLOAT', 'DOUBLE', 'REAL', 'INTEGER', 'BIGINT', 'SMALLINT', 'TINYINT', 'HUGEINT', 'DECIMAL')
+
+# Process-wide database handle and the cursors handed out to each thread
+_db_lock = Lock()
+_db_path: Path | None = None
+_db_config: dict[str, str | int] = {}
+_db_conn: DuckDBPyConnection | None = None
+_db_cursors: dict[Thread, DuckDBPyConnection] = {}
+
+# Locks which ensure only one batch is written to each table at a time, as concurrent writes race on the rollups
+_write_locks: dict[str, Lock] = {}
+_write_locks_lock = Lock()
+
+
+@dataclass
+class _Catalog:
+    """Description of the tables held in the database, kept current as tables are created and written"""
+
+    tables: dict[str, TableStats] = field(default_factory=dict)
+    """Column types and row count of each table"""
+    batteries: dict[str, bool] = field(default_factory=dict)
+    """Names of each battery and whether metadata are available"""
+    rollups: dict[str, list[str]] = field(default_factory=dict)
+    """Names of the columns held in the rollup tables of each battery"""
+    modified: dict[str, float] = field(default_factory=dict)
+    """Time each table was last written to (units: s since epoch)"""
+    deletions: dict[str, int] = field(default_factory=dict)
+    """Number of times rows were removed from each table"""
+    version: int = field(default_factory=lambda: next(_catalog_versions))
+    """Number which changes each time the catalog is read from the database"""
+    loaded: float = field(default_factory=time)
+    """Time the catalog was read from the database (units: s since epoch)"""
+    lock: Lock = field(default_factory=Lock)
+    """Lock used when altering the catalog"""
+
+
+_catalog: _Catalog | None = None
+_catalog_versions = count()
+
+
+def _load_catalog(conn: DuckDBPyConnection) -> _Catalog:
+    """Read the description of all tables from the database
+
+    Args:
+        conn: Connection to the database
+    Returns:
+        Catalog of all tables
+    """
+    catalog = _Catalog()
+    for name, has_metadata in conn.execute('SELECT name, metadata IS NOT NULL FROM battery_metadata').fetchall():
+        catalog.batteries[name] = has_metadata
+
+    for name, rows in conn.execute(
+            "SELECT table_name, estimated_size FROM duckdb_tables() "
+            "WHERE database_name = current_database() AND table_name != 'battery_metadata'"
+    ).fetchall():
+        catalog.tables[name] = TableStats(rows=rows, columns={})
+    for name, column, data_type in conn.execute(
+            'SELECT table_name, column_name, data_type FROM duckdb_columns() '
+            'WHERE database_name = current_database() ORDER BY table_name, column_index'
+    ).fetchall():
+        if name in catalog.tables:
+            catalog.tables[name].columns[column] = data_type
+
+    # Find which batteries have rollups
+    for name in catalog.batteries:
+        rollups = [catalog.tables.get(rollup_table(name, res)) for res in ROLLUP_RESOLUTIONS]
+        if all(r is not None for r in rollups):
+            catalog.rollups[name] = [c[:-4] for c in rollups[0].columns if c.endswith('_min')]
+    return catalog
+
+
+def _fill_missing_rollups(conn: DuckDBPyConnection, catalog: _Catalog):
+    """Create rollup tables for any battery which lacks them, such as those written by older versions"""
+    with catalog.lock:
+        for name in catalog.batteries:
+            if name not in catalog.rollups and (table_stats := catalog.tables.get(name)) is not None:
+                _create_rollups(conn, catalog, name, table_stats.columns)
+
+
+def _get_catalog() -> _Catalog:
+    """Get the catalog, opening the database if needed"""
+    if _catalog is None:
+        connect()
+    return _catalog
+
+
+def reload_catalog():
+    """Re-read the description of the tables from the database
+
+    Only needed if the database is altered without using the functions in this module.
+    """
+    global _catalog
+    conn = connect()
+    _catalog = _load_catalog(conn)
+    _fill_missing_rollups(conn, _catalog)
+
+
+def configure_database(path: str | Path | None = None, threads: int | None = None, memory_limit: str | None = None,
+                       shard: int | None = None):
+    """Set the location and settings of the database
+
+    Settings which are not provided are read from the ``ROVIWEB_DB_PATH``, ``ROVIWEB_DB_THREADS``,
+    and ``ROVIWEB_DB_MEMORY_LIMIT`` environment variables, or left at the DuckDB defaults.
+    Closes any open database so that the next call to :meth:`connect` uses the new settings.
+    Each worker process holds a database of its own when batteries are shared between workers
+    (see :mod:`roviweb.cluster`), named by adding the index of the worker to the path.
+
+    Args:
+        path: Path to the database file
+        threads: Number of threads used by DuckDB
+        memory_limit: Maximum memory used by DuckDB (e.g., "4GB")
+        shard: Index of the worker process which holds this database, if batteries are shared between workers
+    """
+    global _db_path, _db_config
+    close_database()
+
+    path = Path(path or os.environ.get('ROVIWEB_DB_PATH', 'duck.db'))
+    if shard is not None:
+        path = path.with_stem(f'{path.stem}-{shard}')
+    threads = threads or os.environ.get('ROVIWEB_DB_THREADS')
+    memory_limit = memory_limit or os.environ.get('ROVIWEB_DB_MEMORY_LIMIT')
+    with _db_lock:
+        _db_path = path
+        _db_config = {}
+        if threads is not None:
+            _db_config['threads'] = int(threads)
+        if memory_limit is not None:
+            _db_config['memory_limit'] = memory_limit
+
+
+def close_database():
+    """Close the database handle and all cursors to it"""
+    global _db_conn, _catalog
+    with _db_lock:
+        for cursor in _db_cursors.values():
+            cursor.close()
+        _db_cursors.clear()
+        if _db_conn is not None:
+            _db_conn.close()
+            _db_conn = None
+            _catalog = None
+
 
 def connect() -> DuckDBPyConnection:
-    """Establish a connection to the data services"""
-    conn = duckdb.connect("duck.db")  # For now, just memory. No persistence between runs
+    """Get a connection to the data services
 
-    # Establish the database if the table does not exist
-    conn.execute((
-        'CREATE TABLE IF NOT EXISTS battery_metadata('
-        'name VARCHAR PRIMARY KEY,'
-        'metadata VARCHAR)'
-    ))
-    return conn
+    The database is opened once per process. Each thread receives its own cursor to that database.
+
+    Returns:
+        Cursor for use by the current thread
+    """
+    thread = current_thread()
+    if (cursor := _db_cursors.get(thread)) is not None:
+        return cursor
+
+    global _db_conn, _catalog
+    if _db_path is None:
+        configure_database()
+    with _db_lock:
+        # Establish the database if it is not yet open, then read what it contains
+        if _db_conn is None:
+            _db_conn = duckdb.connect(str(_db_path), config=_db_config)
+            _db_conn.execute((
+                'CREATE TABLE IF NOT EXISTS battery_metadata('
+                'name VARCHAR PRIMARY KEY,'
+                'metadata VARCHAR)'
+            ))
+            _catalog = _load_catalog(_db_conn)
+            _fill_missing_rollups(_db_conn, _catalog)
+
+        # Close cursors from threads which have exited, then make one for this thread
+        for dead in [t for t in _db_cursors if not t.is_alive()]:
+            _db_cursors.pop(dead).close()
+        cursor = _db_conn.cursor()
+        _db_cursors[thread] = cursor
+    return cursor
 
 
 def register_battery(metadata: BatteryMetadata, name: Optional[str] = None) -> str:
@@ -43,14 +220,17 @@ def register_battery(metadata: BatteryMetadata, name: Optional[str] = None) -> s
 
     # Insert the metadata as a JSON object
     if name is None:
-        name = metadata.name or uuid4()
+        name = metadata.name or str(uuid4())
     conn = connect()
 
     # Insert the data
-    conn.execute(
-        'INSERT OR REPLACE INTO battery_metadata VALUES (?, ?)',
-        [name, metadata.model_dump_json()]
-    )
+    catalog = _get_catalog()
+    with catalog.lock:
+        conn.execute(
+            'INSERT OR REPLACE INTO battery_metadata VALUES (?, ?)',
+            [name, metadata.model_dump_json()]
+        )
+        catalog.batteries[name] = True
     return name
 
 
@@ -70,38 +250,48 @@ def get_metadata(name: str) -> BatteryMetadata:
     return BatteryMetadata.model_validate_json(as_json)
 
 
-def list_batteries() -> dict[str, TableStats]:
-    """Retrieve information about what data are stored"""
-    conn = connect()
+def has_battery(name: str) -> bool:
+    """Whether a battery is known to the database
+
+    Args:
+        name: Name of the data source
+    Returns:
+        Whether either data or metadata are available
+    """
+    return name in _get_catalog().batteries
 
-    # List the cells in the metadata datable
-    all_batteries = conn.sql('SELECT name FROM battery_metadata').fetchall()
-    no_metadata = conn.sql('SELECT name FROM battery_metadata WHERE metadata IS NULL').fetchall()
+
+def table_columns(name: str) -> Dict[str, str] | None:
+    """Get the columns of a table from the catalog
+
+    Args:
+        name: Name of the table
+    Returns:
+        Map of column names to SQL types, ``None`` if the table does not exist
+    """
+    table_stats = _get_catalog().tables.get(name)
+    return None if table_stats is None else table_stats.columns.copy()
+
+
+def list_batteries() -> dict[str, BatteryStats]:
+    """Retrieve information about what data are stored"""
+    catalog = _get_catalog()
 
     # Get the stats for each dataset
-    from roviweb.online import list_estimators  # TODO (wardlt) Deal with this circular dep
+    from roviweb.online import has_estimator  # TODO (wardlt) Deal with this circular dep
+    from roviweb.prognosis import forecasters
     output = {}
-    estimators = list_estimators()
-    for name, in all_batteries:
-        # Get size information
-        rows = conn.execute(
-            'SELECT estimated_size FROM duckdb_tables() WHERE table_name = ?', [name]
-        ).fetchone()
-        if rows is not None:
-            rows = rows[0]
-
-            # Get column information
-            columns = conn.execute('SELECT * FROM duckdb_columns() WHERE table_name = ?', [name]).df()
-            columns = dict(zip(columns['column_name'], columns['data_type']))
-            table_stats = TableStats(rows=rows, columns=columns)
-        else:
-            table_stats = None
+    for name, has_metadata in list(catalog.batteries.items()):
+        table_stats = catalog.tables.get(name)
+        if table_stats is not None:
+            table_stats = table_stats.model_copy(deep=True)
 
         # Make the summary
         output[name] = BatteryStats(
-            has_metadata=(name,) not in no_metadata,
+            has_metadata=has_metadata,
             has_data=table_stats is not None,
-            has_estimator=name in estimators,
+            has_estimator=has_estimator(name),
+            has_forecaster=name in forecasters,
             data_stats=table_stats
         )
 
@@ -118,35 +308,372 @@ def register_data_source(name: str, first_record: RecordType, exists_ok=True) ->
     Returns:
         Map of column names to SQL types
     """
-    conn = connect()
 
-    # Insert metadata into table if not present
-    if not name.endswith('_estimates'):
-        conn.execute('INSERT INTO battery_metadata VALUES (?, NULL) ON CONFLICT DO NOTHING;', [name])
-
-    # Check if the DB exists
-    if not _name_re.match(name):
-        raise ValueError(f'Database name ("{name}") contains bad characters.')
-    exists = conn.execute(
-        'SELECT table_name FROM duckdb_tables() WHERE table_name = ?', [name]
-    ).fetchone() is not None
-    if exists and not exists_ok:
-        raise ValueError(f'Table already exists: {name}')
+    # Use the known types if the table exists
+    if (known := _get_catalog().tables.get(name)) is not None:
+        return _existing_table(name, known.columns, first_record.keys(), exists_ok)
 
     # Determine the data types
     col_types = {}
     for key, value in first_record.items():
+        col_types[key] = _data_types_to_sql.get(np.array(value).dtype.kind, 'VARCHAR')
+    return _create_table(name, col_types, exists_ok)
+
+
+def register_columnar_source(name: str, schema: pa.Schema, exists_ok=True) -> Dict[str, str]:
+    """Create a new table in the database given the schema of an Arrow table
+
+    Args:
+        name: Name used for the table
+        schema: Schema of the data to be stored
+        exists_ok: Whether to exit cleanly if the DB exists
+    Returns:
+        Map of column names to SQL types
+    """
+
+    # Use the known types if the table exists
+    if (known := _get_catalog().tables.get(name)) is not None:
+        return _existing_table(name, known.columns, schema.names, exists_ok)
+
+    col_types = {}
+    for column in schema:
+        if pa.types.is_floating(column.type):
+            col_types[column.name] = 'FLOAT'
+        elif pa.types.is_integer(column.type):
+            col_types[column.name] = 'INTEGER'
+        else:
+            col_types[column.name] = 'VARCHAR'
+    return _create_table(name, col_types, exists_ok)
+
+
+def _existing_table(name: str, columns: Dict[str, str], keys: Iterable[str], exists_ok: bool) -> Dict[str, str]:
+    """Get the types of columns to be written to a table which already exists
+
+    Args:
+        name: Name of the table
+        columns: Map of column names to SQL types for the table
+        keys: Names of the columns to be written
+        exists_ok: Whether to exit cleanly if the DB exists
+    Returns:
+        Map of column names to SQL types for the columns to be written
+    """
+    if not exists_ok:
+        raise ValueError(f'Table already exists: {name}')
+    try:
+        return {key: columns[key] for key in keys}
+    except KeyError as e:
+        raise ValueError(f'Column {e} is not in table: {name}')
+
+
+def _create_table(name: str, col_types: Dict[str, str], exists_ok: bool) -> Dict[str, str]:
+    """Create a table with a certain set of columns if it does not exist yet
+
+    Args:
+        name: Name used for the table
+        col_types: Map of column names to SQL types
+        exists_ok: Whether to exit cleanly if the DB exists
+    Returns:
+        Map of column names to SQL types
+    """
+    conn = connect()
+    catalog = _get_catalog()
+
+    # Check the names
+    if not _name_re.match(name):
+        raise ValueError(f'Database name ("{name}") contains bad characters.')
+    for key in col_types:
         if not _name_re.match(key):
             raise ValueError(f'Column name ("{key}") contains bad characters!')
-        col_types[key] = _data_types_to_sql.get(np.array(value).dtype.kind, 'VARCHAR')
 
-    # Make the table if it doesn't exist yet
-    if not exists:
+    with catalog.lock:
+        # Insert metadata into table if not present
+        if not name.endswith('_estimates') and name not in catalog.batteries:
+            conn.execute('INSERT INTO battery_metadata VALUES (?, NULL) ON CONFLICT DO NOTHING;', [name])
+            catalog.batteries[name] = False
+
+        # Check if the DB exists, as another thread may have made it
+        if (known := catalog.tables.get(name)) is not None:
+            return _existing_table(name, known.columns, col_types.keys(), exists_ok)
+
+        # Make the table
         col_section = ",\n   ".join(f'{k} {v}' for k, v in col_types.items())
         conn.execute(f'CREATE TABLE {name}( {col_section} );')
+        catalog.tables[name] = TableStats(rows=0, columns=col_types.copy())
+        if name in catalog.batteries:
+            _create_rollups(conn, catalog, name, col_types, replace=True)
     return col_types
 
 
+def rollup_table(name: str, resolution: float) -> str:
+    """Get the name of the table holding a battery's data summarized into buckets of a certain width
+
+    Args:
+        name: Name of the battery
+        resolution: Width of the time buckets (units: s)
+    Returns:
+        Name of the table
+    """
+    return f'{name}_rollup_{int(resolution)}'
+
+
+def _rollup_select(source: str, resolution: float, columns: list[str], present: Iterable[str] | None = None) -> str:
+    """Make a query which summarizes data from a table or view into time buckets
+
+    Columns which are not ``present`` in the source are summarized as if all values were missing
+    """
+    present = set(columns if present is None else present)
+    stats = []
+    for c in columns:
+        if c in present:
+            stats.append(f'min({c}) AS {c}_min, max({c}) AS {c}_max, sum({c}) AS {c}_sum, '
+                         f'count({c}) AS {c}_count, arg_max({c}, test_time) AS {c}_last')
+        else:
+            stats.append(f'NULL::DOUBLE AS {c}_min, NULL::DOUBLE AS {c}_max, NULL::DOUBLE AS {c}_sum, '
+                         f'0 AS {c}_count, NULL::DOUBLE AS {c}_last')
+    return (f'SELECT floor(test_time / {resolution}) * {resolution} AS bucket, '
+            f'count(*) AS num_rows, max(test_time) AS last_time{"".join(", " + s for s in stats)} '
+            f'FROM {source} GROUP BY bucket')
+
+
+def _create_rollups(conn: DuckDBPyConnection, catalog: _Catalog, name: str, col_types: Dict[str, str],
+                    replace: bool = False):
+    """Create the rollup tables for a battery then fill them using any data already in its table
+
+    Requires the catalog lock.
+
+    Args:
+        conn: Connection to the database
+        catalog: Catalog to be updated
+        name: Name of the battery
+        col_types: Map of column names to SQL types for the battery's table
+        replace: Whether to replace any existing rollup tables
+    """
+    if 'test_time' not in col_types:
+        return
+    columns = [c for c, t in col_types.items() if c != 'test_time' and t.upper().startswith(_numeric_types)]
+
+    for resolution in ROLLUP_RESOLUTIONS:
+        table = rollup_table(name, resolution)
+        rollup_types = {'bucket': 'DOUBLE', 'num_rows': 'BIGINT', 'last_time': 'DOUBLE'}
+        for c in columns:
+            rollup_types.update((f'{c}_{s}', 'BIGINT' if s == 'count' else 'DOUBLE') for s in _rollup_stats)
+        col_section = ", ".join(f'{k} {v}' for k, v in rollup_types.items())
+        conn.execute(f'CREATE {"OR REPLACE " if replace else ""}TABLE {table}( {col_section}, PRIMARY KEY (bucket) );')
+        conn.execute(f'INSERT INTO {table} {_rollup_select(name, resolution, columns)}')
+        catalog.tables[table] = TableStats(rows=0, columns=rollup_types)
+    catalog.rollups[name] = columns
+
+
+def _merge_rollups(conn: DuckDBPyConnection, name: str, source: str, present: Iterable[str]):
+    """Add newly written data to the rollup tables of a battery
+
+    Args:
+        conn: Connection to the database
+        name: Name of the battery
+        source: Name of a table or view holding only the new data
+        present: Names of the columns held in the new data
+    """
+    columns = _get_catalog().rollups.get(name)
+    present = set(present)
+    if columns is None or 'test_time' not in present:
+        return
+
+    updates = ['num_rows = num_rows + EXCLUDED.num_rows', 'last_time = greatest(last_time, EXCLUDED.last_time)']
+    for c in columns:
+        updates.extend([
+            f'{c}_min = least({c}_min, EXCLUDED.{c}_min)',
+            f'{c}_max = greatest({c}_max, EXCLUDED.{c}_max)',
+            f'{c}_sum = coalesce({c}_sum + EXCLUDED.{c}_sum, {c}_sum, EXCLUDED.{c}_sum)',
+            f'{c}_count = {c}_count + EXCLUDED.{c}_count',
+            f'{c}_last = CASE WHEN EXCLUDED.last_time >= last_time '
+            f'THEN coalesce(EXCLUDED.{c}_last, {c}_last) ELSE {c}_last END',
+        ])
+    for resolution in ROLLUP_RESOLUTIONS:
+        query = _rollup_select(source, resolution, columns, present)
+        conn.execute(f'INSERT INTO {rollup_table(name, resolution)} {query} '
+                     f'ON CONFLICT (bucket) DO UPDATE SET {", ".join(updates)}')
+
+
+def select_resolution(window: float, points: int) -> float | None:
+    """Pick the coarsest rollup which still provides a certain number of buckets over a window of time
+
+    Args:
+        window: Length of time to be shown (units: s)
+        points: Minimum number of points needed, such as the width of a plot in pixels
+    Returns:
+        Width of the buckets (units: s), ``None`` if the raw data are needed
+    """
+    for resolution in sorted(ROLLUP_RESOLUTIONS, reverse=True):
+        if window / resolution >= points:
+            return resolution
+    return None
+
+
+def read_history(name: str, columns: list[str], start: float, end: float,
+                 points: int) -> tuple[float | None, dict[str, np.ndarray]]:
+    """Read data over a window of time at the coarsest resolution which provides enough points
+
+    Summarized data include the mean, minimum, and maximum of each column in each bucket,
+    as ``{column}``, ``{column}_min``, and ``{column}_max``, and the center of each bucket as ``test_time``.
+
+    Args:
+        name: Name of the battery
+        columns: Names of the columns to read
+        start: Earliest test time to read (units: s)
+        end: Latest test time to read (units: s)
+        points: Minimum number of points needed, such as the width of a plot in pixels
+    Returns:
+        - Width of the buckets (units: s), ``None`` if raw data were read
+        - Map of column name to values, sorted by test time
+    """
+    catalog = _get_catalog()
+    known = catalog.tables[name].columns
+    for c in columns:
+        if c not in known:
+            raise ValueError(f'No such column in {name}: {c}')
+
+    conn = connect()
+    resolution = select_resolution(end - start, points)
+    rolled = catalog.rollups.get(name, [])
+    if resolution is None or any(c not in rolled for c in columns):
+        return None, conn.execute(
+            f'SELECT test_time{"".join(", " + c for c in columns)} FROM {name} '
+            'WHERE test_time >= $1 AND test_time <= $2 ORDER BY test_time', [start, end]
+        ).fetchnumpy()
+
+    stats = "".join(f', {c}_sum / {c}_count AS {c}, {c}_min, {c}_max' for c in columns)
+    return resolution, conn.execute(
+        f'SELECT bucket + {resolution / 2} AS test_time{stats} FROM {rollup_table(name, resolution)} '
+        'WHERE bucket + $3 >= $1 AND bucket <= $2 ORDER BY bucket', [start, end, resolution]
+    ).fetchnumpy()
+
+
+def has_series(name: str) -> bool:
+    """Whether a table holds time series for a battery, either its raw data or its state estimates
+
+    Args:
+        name: Name of the table
+    Returns:
+        Whether the table exists and belongs to a battery
+    """
+    catalog = _get_catalog()
+    if name not in catalog.tables:
+        return False
+    return name in catalog.batteries or (name.endswith('_estimates') and name[:-10] in catalog.batteries)
+
+
+def read_series(name: str, columns: list[str] | None = None, start: float | None = None, end: float | None = None,
+                points: int = 1000, method: DownsampleMethod = 'lttb') -> tuple[float | None, dict[str, np.ndarray]]:
+    """Read time series reduced to no more than a certain number of points per column
+
+    Reads from the coarsest rollup which provides enough points, as in :meth:`read_history`,
+    then selects the points which best depict each column.
+
+    Args:
+        name: Name of the table, either a battery or the estimates for a battery
+        columns: Names of the columns to read. Default is all numeric columns
+        start: Earliest test time to read (units: s). Default is the earliest available
+        end: Latest test time to read (units: s). Default is the latest available
+        points: Number of points to keep for each column
+        method: Technique used to select points
+    Returns:
+        - Width of the buckets (units: s), ``None`` if raw data were read
+        - Map of column name to values, sorted by test time
+    """
+    if columns is None:
+        columns = [c for c, t in _get_catalog().tables[name].columns.items()
+                   if c != 'test_time' and t.upper().startswith(_numeric_types)]
+    if len(columns) == 0:
+        raise ValueError(f'No numeric columns to read in {name}')
+
+    # Fill in the range using the available data
+    if start is None or end is None:
+        first_time, last_time = connect().execute(f'SELECT MIN(test_time), MAX(test_time) FROM {name}').fetchone()
+        if last_time is None:
+            return None, dict((c, np.array([])) for c in ['test_time'] + columns)
+        start = first_time if start is None else start
+        end = last_time if end is None else end
+
+    resolution, data = read_history(name, columns, start, end, points)
+    return resolution, downsample(data, columns, points, method)
+
+
+def _count_insert(name: str, rows: int):
+    """Update the catalog after inserting rows to a table
+
+    Args:
+        name: Name of the table
+        rows: Number of rows added
+    """
+    catalog = _get_catalog()
+    with catalog.lock:
+        catalog.tables[name].rows += rows
+        catalog.modified[name] = time()
+
+
+def table_watermark(name: str) -> tuple[Hashable, float]:
+    """Get a version identifier for the contents of a table and when it last changed
+
+    The version changes whenever rows are written or removed using the functions in this module
+    or the catalog is re-read from the database.
+
+    Args:
+        name: Name of the table
+    Returns:
+        - Version identifier for the contents of the table
+        - Time the table was last written to, or the catalog read if not since (units: s since epoch)
+    """
+    catalog = _get_catalog()
+    table_stats = catalog.tables.get(name)
+    rows = -1 if table_stats is None else table_stats.rows
+    return ((catalog.version, catalog.deletions.get(name, 0)), rows), catalog.modified.get(name, catalog.loaded)
+
+
+def delete_rows_after(name: str, test_time: float) -> int:
+    """Remove the rows of a table which are later than a certain test time
+
+    Only for tables without rollups, such as those holding state estimates.
+
+    Args:
+        name: Name of the table
+        test_time: Latest test time to keep
+    Returns:
+        Number of rows removed
+    """
+    catalog = _get_catalog()
+    if name not in catalog.tables:
+        return 0
+    if name in catalog.rollups:
+        raise ValueError(f'Rows cannot be removed from a table with rollups: {name}')
+
+    conn = connect()
+    with _write_lock(name):
+        removed, = conn.execute(f'DELETE FROM {name} WHERE test_time > $1', [test_time]).fetchone()
+        with catalog.lock:
+            catalog.tables[name].rows -= removed
+            catalog.deletions[name] = catalog.deletions.get(name, 0) + 1
+            catalog.modified[name] = time()
+    return removed
+
+
+def _write_lock(name: str) -> Lock:
+    """Get the lock held while writing to a certain table"""
+    with _write_locks_lock:
+        return _write_locks.setdefault(name, Lock())
+
+
+@contextmanager
+def _transaction(conn: DuckDBPyConnection):
+    """Commit the statements run within the context together, or none if any fail"""
+    conn.begin()
+    try:
+        yield
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
 def write_one_record(name: str, type_map: Dict[str, str], record: RecordType):
     """Write a series of records to a certain table
 
@@ -174,7 +701,43 @@ def write_records(name: str, type_map: Dict[str, str], records: list[RecordType]
         to_insert.append([record[k] if not v == "VARCHAR" else str(record[k]) for k, v in type_map.items()])
     if len(records) == 0:
         return
-    conn.executemany(
-        f'INSERT INTO {name} ({", ".join(type_map.keys())}) VALUES ({", ".join("?" * len(type_map))})',
-        to_insert
-    )
+    with _write_lock(name):
+        with _transaction(conn):
+            conn.executemany(
+                f'INSERT INTO {name} ({", ".join(type_map.keys())}) VALUES ({", ".join("?" * len(type_map))})',
+                to_insert
+            )
+
+            # Update the rollups using only the new records
+            if name in _get_catalog().rollups:
+                new_data = pa.table(dict((k, list(v)) for k, v in zip(type_map.keys(), zip(*to_insert))))
+                conn.register('_upload', new_data)
+                try:
+                    _merge_rollups(conn, name, '_upload', type_map.keys())
+                finally:
+                    conn.unregister('_upload')
+        _count_insert(name, len(to_insert))
+
+
+def write_table(name: str, type_map: Dict[str, str], table: pa.Table):
+    """Write an Arrow table to a certain table without converting it to rows
+
+    Args:
+        name: Name used for the table
+        type_map: Map of column name to expected type
+        table: Data to be written
+    """
+
+    if table.num_rows == 0:
+        return
+    conn = connect()
+    columns = ", ".join(type_map.keys())
+    with _write_lock(name):
+        conn.register('_upload', table)
+        try:
+            with _transaction(conn):
+                conn.execute(f'INSERT INTO {name} ({columns}) SELECT {columns} FROM _upload')
+                _merge_rollups(conn, name, '_upload', type_map.keys())
+        finally:
+            conn.unregister('_upload')
+        _count_insert(name, table.num_rows)
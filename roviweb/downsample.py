@@ -0,0 +1,96 @@
+"""Reduce time series to a number of points which can be drawn on a screen"""
+from typing import Literal
+
+import numpy as np
+
+DownsampleMethod = Literal['lttb', 'minmax']
+
+
+def lttb(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """Select the points which best preserve the shape of a series using Largest-Triangle-Three-Buckets
+
+    The first and last points are always kept. The others are split into equal-sized buckets,
+    and the point kept from each bucket forms the largest triangle with the point kept
+    from the previous bucket and the average of the next bucket.
+
+    Args:
+        x: Horizontal coordinate of each point, sorted
+        y: Vertical coordinate of each point
+        points: Number of points to keep
+    Returns:
+        Indices of the points to keep, sorted
+    """
+    n = len(x)
+    if points >= n or points < 3:
+        return np.arange(n)
+
+    # Bucket i spans edges[i] to edges[i + 1], excluding the first and last points
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+    selected = np.empty(points, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = (end, edges[i + 2]) if i < points - 3 else (n - 1, n)
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + np.argmax(np.nan_to_num(area, nan=-np.inf))
+        selected[i + 1] = a
+    return selected
+
+
+def min_max(y: np.ndarray, points: int) -> np.ndarray:
+    """Select the smallest and largest value from each of equal-sized buckets
+
+    Keeps the extremes of noisy signals which are lost when picking representative points.
+
+    Args:
+        y: Values of the series
+        points: Number of points to keep
+    Returns:
+        Indices of the points to keep, sorted
+    """
+    n = len(y)
+    if points >= n or points < 2:
+        return np.arange(n)
+
+    # Ignore missing values when finding either extreme
+    low = np.nan_to_num(y, nan=np.inf)
+    high = np.nan_to_num(y, nan=-np.inf)
+
+    edges = np.linspace(0, n, points // 2 + 1).astype(int)
+    selected = set()
+    for start, end in zip(edges[:-1], edges[1:]):
+        if start < end:
+            selected.add(start + int(np.argmin(low[start:end])))
+            selected.add(start + int(np.argmax(high[start:end])))
+    return np.array(sorted(selected), dtype=int)
+
+
+def downsample(data: dict[str, np.ndarray], columns: list[str], points: int,
+               method: DownsampleMethod = 'lttb') -> dict[str, np.ndarray]:
+    """Reduce the number of rows in a table to those which best depict each column
+
+    Rows are selected for each column separately and then merged,
+    so that all columns share the same ``test_time``.
+
+    Args:
+        data: Map of column name to values, including ``test_time``
+        columns: Columns used to select rows
+        points: Number of rows to keep for each column
+        method: Technique used to select rows
+    Returns:
+        The selected rows of every column in ``data``
+    """
+    if len(data['test_time']) <= points:
+        return data
+
+    x = np.asarray(data['test_time'], dtype=float)
+    selected = set()
+    for col in columns:
+        y = np.ma.filled(np.ma.asarray(data[col], dtype=float), np.nan)  # Missing values become NaN
+        selected.update(lttb(x, y, points) if method == 'lttb' else min_max(y, points))
+    rows = np.array(sorted(selected), dtype=int)
+    return dict((k, v[rows]) for k, v in data.items())
@@ -0,0 +1,427 @@
+"""Advance many online estimators which share the same model in a single vectorized step
+
+Estimators built using an unscented Kalman filter (e.g., from :meth:`JointEstimator.initialize_unscented_kalman_filter`)
+propagate a set of sigma points through the cell model at each step.
+The fleet engine stacks the sigma points of every battery which has a new sample
+and shares the same model, state shape, and values of the health parameters which are not estimated,
+then evaluates the model once for all of them.
+
+The engine reads the state, noise terms, and model from the filter held by each estimator.
+It confirms that its update matches that of the estimator on the first sample for each battery,
+and steps any estimator which does not match (or does not use an unscented Kalman filter) on its own.
+"""
+from collections import deque
+from contextlib import contextmanager, ExitStack
+from copy import deepcopy
+from dataclasses import dataclass
+from threading import Lock, Thread, Event
+from typing import Any, Mapping, Hashable
+from hashlib import sha256
+import logging
+import pickle
+import os
+
+import numpy as np
+from moirae.estimators.online.filters.kalman.unscented import UnscentedKalmanFilter
+from moirae.interface import row_to_inputs
+
+from roviweb.online import EstimatorHolder, write_estimates
+
+logger = logging.getLogger(__name__)
+
+
+def _model_key(model: Any) -> Hashable:
+    """Key which is the same for models that produce the same outputs for the same hidden states
+
+    The hidden states of a joint estimator include only the learnable health parameters,
+    so the key captures the values of the fixed health parameters held by the model.
+
+    Args:
+        model: Model used by a filter
+    Returns:
+        Key describing the parameters of the model, which is unique to the model if they cannot be read
+    """
+    try:
+        digest = sha256(pickle.dumps(getattr(model, 'cell_model', None)))
+        asoh = getattr(model, 'asoh', None)
+        if asoh is None:
+            digest.update(pickle.dumps(model))
+        else:
+            updatable = set(asoh.updatable_names)
+            fixed = [n for n in asoh.all_names if n not in updatable]
+            digest.update(repr(fixed).encode())
+            if len(fixed) > 0:
+                digest.update(np.asarray(asoh.get_parameters(fixed), dtype=float).tobytes())
+            digest.update(repr(type(getattr(model, 'transients', None))).encode())
+        return digest.hexdigest()
+    except Exception:
+        return id(model)
+
+
+@dataclass
+class _FilterView:
+    """Arrays and functions of an unscented Kalman filter needed to step it alongside others"""
+
+    filter: Any
+    """Filter being stepped"""
+    mean_weights: np.ndarray
+    """Weights of each sigma point when computing means"""
+    cov_weights: np.ndarray
+    """Weights of each sigma point when computing covariances"""
+    gamma: float
+    """Scaling factor for the spread of sigma points"""
+    process_noise: np.ndarray
+    """Covariance of the process noise"""
+    sensor_noise: np.ndarray
+    """Covariance of the sensor noise"""
+
+    @classmethod
+    def from_estimator(cls, estimator: Any) -> '_FilterView | None':
+        """Gather the arrays used by the filter of an estimator
+
+        Args:
+            estimator: Estimator to be stepped
+        Returns:
+            View of the filter, ``None`` if the estimator does not use an unscented Kalman filter
+        Raises:
+            ValueError: If the filter lacks the arrays used by the fleet engine
+        """
+        ukf = getattr(estimator, 'filter', None)
+        if not isinstance(ukf, UnscentedKalmanFilter):
+            return None
+
+        try:
+            return cls(
+                filter=ukf,
+                mean_weights=np.asarray(ukf.mean_weights, dtype=float).flatten(),
+                cov_weights=np.asarray(ukf.cov_weights, dtype=float).flatten(),
+                gamma=float(ukf.gamma_param),
+                process_noise=np.asarray(ukf.cov_Q, dtype=float),
+                sensor_noise=np.asarray(ukf.cov_R, dtype=float),
+            )
+        except AttributeError as e:
+            raise ValueError(f'{type(ukf).__name__} lacks an attribute used by the fleet engine: {e}') from e
+
+    @property
+    def signature(self) -> Hashable:
+        """Key which is the same for filters which can be stepped together"""
+        return (
+            type(self.filter.model),
+            type(getattr(self.filter.model, 'cell_model', None)),
+            _model_key(self.filter.model),
+            self.process_noise.shape,
+            self.sensor_noise.shape,
+            tuple(np.round(self.mean_weights, 12)),
+            tuple(np.round(self.cov_weights, 12)),
+            round(self.gamma, 12),
+        )
+
+    def set_state(self, mean: np.ndarray, covariance: np.ndarray, controls: np.ndarray):
+        """Store the results of a step in the filter"""
+        self.filter.hidden.mean[...] = mean.reshape(self.filter.hidden.mean.shape)
+        self.filter.hidden.covariance[...] = covariance
+        self.filter.controls.mean[...] = controls.reshape(self.filter.controls.mean.shape)
+
+
+def step_filters(views: list[_FilterView], new_controls: np.ndarray, measurements: np.ndarray):
+    """Advance several unscented Kalman filters which share the same model by one step
+
+    The sigma points of every filter are propagated through the model of the first,
+    so all filters must have the same :attr:`_FilterView.signature`.
+
+    Args:
+        views: Filters to be advanced
+        new_controls: Control inputs for each filter (shape: num_filters x num_controls)
+        measurements: Measurements for each filter (shape: num_filters x num_outputs)
+    """
+    ref = views[0]
+    model = ref.filter.model
+    num_filters = len(views)
+    mean = np.array([v.filter.hidden.get_mean().flatten() for v in views])
+    cov = np.array([v.filter.hidden.get_covariance() for v in views])
+    prev_controls = np.array([v.filter.controls.get_mean().flatten() for v in views])
+    num_hidden = mean.shape[1]
+    num_points = 2 * num_hidden + 1
+
+    # Make the sigma points for every filter (shape: num_filters x num_points x num_hidden)
+    chol = np.linalg.cholesky(cov)
+    offsets = ref.gamma * np.transpose(chol, (0, 2, 1))
+    sigma = np.concatenate([mean[:, None, :], mean[:, None, :] + offsets, mean[:, None, :] - offsets], axis=1)
+
+    # Propagate all points through the model at once
+    flat_prev = np.repeat(prev_controls, num_points, axis=0)
+    flat_new = np.repeat(new_controls, num_points, axis=0)
+    hidden = model.update_hidden_states(
+        hidden_states=sigma.reshape(-1, num_hidden), previous_controls=flat_prev, new_controls=flat_new
+    ).reshape(num_filters, num_points, num_hidden)
+    outputs = model.predict_measurement(hidden_states=hidden.reshape(-1, num_hidden), controls=flat_new)
+    outputs = np.asarray(outputs).reshape(num_filters, num_points, -1)
+
+    # Compute the predicted means and covariances
+    hidden_mean = np.einsum('p,fph->fh', ref.mean_weights, hidden)
+    output_mean = np.einsum('p,fpo->fo', ref.mean_weights, outputs)
+    hidden_diff = hidden - hidden_mean[:, None, :]
+    output_diff = outputs - output_mean[:, None, :]
+    hidden_cov = np.einsum('p,fpi,fpj->fij', ref.cov_weights, hidden_diff, hidden_diff)
+    hidden_cov += np.array([v.process_noise for v in views])
+    output_cov = np.einsum('p,fpi,fpj->fij', ref.cov_weights, output_diff, output_diff)
+    output_cov += np.array([v.sensor_noise for v in views])
+    cross_cov = np.einsum('p,fpi,fpj->fij', ref.cov_weights, hidden_diff, output_diff)
+
+    # Apply the Kalman update
+    gain = np.transpose(np.linalg.solve(np.transpose(output_cov, (0, 2, 1)), np.transpose(cross_cov, (0, 2, 1))),
+                        (0, 2, 1))
+    new_mean = hidden_mean + np.einsum('fho,fo->fh', gain, measurements - output_mean)
+    new_cov = hidden_cov - np.einsum('fho,fop,fkp->fhk', gain, output_cov, gain)
+    new_cov = (new_cov + np.transpose(new_cov, (0, 2, 1))) / 2
+
+    for i, view in enumerate(views):
+        view.set_state(new_mean[i], new_cov[i], new_controls[i])
+
+
+@dataclass
+class _Member:
+    """Estimator tracked by the fleet engine and the samples waiting to be used"""
+
+    holder: EstimatorHolder
+    """Holder of the estimator"""
+    pending: deque
+    """Samples which have yet to be used"""
+    last_submitted: float
+    """Test time of the latest sample submitted"""
+    view: _FilterView | None = None
+    """View of the filter, if it can be stepped with others"""
+    compatible: bool | None = None
+    """Whether the fleet update matches that of the estimator. ``None`` if not yet checked"""
+
+
+class FleetEngine:
+    """Steps many estimators, stacking those which share the same model into a single update"""
+
+    def __init__(self):
+        self._members: dict[str, _Member] = {}
+        self._lock = Lock()  # Guards the list of members and the pending samples
+        self._step_lock = Lock()  # Ensures only one thread advances the estimators
+
+    def submit(self, name: str, holder: EstimatorHolder, new_data: Mapping[str, np.ndarray]):
+        """Add new data for an estimator
+
+        Args:
+            name: Name of the battery
+            holder: Holder of the estimator
+            new_data: New data as a map of column name to values
+        """
+        columns = [c for c in ('test_time', 'current', 'voltage', 'temperature') if c in new_data]
+        with self._lock:
+            member = self._members.get(name)
+            if member is None or member.holder is not holder:
+                member = self._members[name] = _Member(holder=holder, pending=deque(), last_submitted=holder.last_time)
+            for values in zip(*(new_data[c] for c in columns)):
+                row = dict(zip(columns, values))
+                if row['test_time'] >= member.last_submitted:
+                    member.pending.append(row)
+                    member.last_submitted = row['test_time']
+
+    def remove(self, name: str):
+        """Stop tracking an estimator
+
+        Args:
+            name: Name of the battery
+        """
+        with self._lock:
+            self._members.pop(name, None)
+
+    @property
+    def num_pending(self) -> int:
+        """Number of samples waiting to be used"""
+        with self._lock:
+            return sum(len(m.pending) for m in self._members.values())
+
+    @contextmanager
+    def paused(self):
+        """Prevent the estimators from being stepped, such as while their states are copied"""
+        with self._step_lock:
+            yield
+
+    def advance(self):
+        """Step every estimator through all pending samples and write the estimates
+
+        A failure to step one estimator or group does not prevent the others from being stepped and written.
+        Members of a group which fails are stepped individually and checked again before rejoining the fleet.
+        """
+        with self._step_lock:
+            results: dict[str, tuple[EstimatorHolder, list[float], list[np.ndarray], list[np.ndarray]]] = {}
+
+            def _record(name: str, member: _Member, row: dict):
+                _, times, means, covs = results.setdefault(name, (member.holder, [], [], []))
+                state = member.holder.estimator.state
+                times.append(row['test_time'])
+                means.append(state.get_mean())
+                if member.holder.write_policy.write_threshold is not None:
+                    covs.append(state.get_covariance())
+
+            def _step_alone(name: str, member: _Member, row: dict):
+                with member.holder._lock:
+                    try:
+                        if not self._verify(member, row):
+                            member.holder.step(row)
+                    except Exception:
+                        logger.exception(f'Failed to step the estimator for {name} at test_time={row["test_time"]}')
+                        return
+                    _record(name, member, row)
+
+            while True:
+                # Get the next sample for each estimator
+                with self._lock:
+                    work = [(name, m, m.pending.popleft()) for name, m in self._members.items() if len(m.pending) > 0]
+                if len(work) == 0:
+                    break
+
+                # Group those which can be stepped together, and step the others individually
+                groups: dict[Hashable, list[tuple[str, _Member, dict]]] = {}
+                for name, member, row in work:
+                    if member.compatible and member.holder._last_inputs is not None:
+                        groups.setdefault(member.view.signature, []).append((name, member, row))
+                    else:
+                        _step_alone(name, member, row)
+
+                for group in groups.values():
+                    with ExitStack() as stack:
+                        for _, member, _ in sorted(group, key=lambda x: x[0]):
+                            stack.enter_context(member.holder._lock)
+                        try:
+                            self._step_group(group)
+                        except Exception:
+                            logger.exception(f'Failed to step a group of {len(group)} estimators together')
+                        else:
+                            for name, member, row in group:
+                                _record(name, member, row)
+                            continue
+
+                    # Fall back to stepping the members of a failed group on their own
+                    for name, member, row in group:
+                        member.compatible = None
+                        _step_alone(name, member, row)
+
+            # Write the estimates for each battery
+            for name, (holder, times, means, covs) in results.items():
+                try:
+                    with holder._lock:
+                        selected = holder.select_writes(np.array(times), np.array(means),
+                                                        np.array(covs) if covs else None)
+                        write_estimates(name, holder.state_columns, *selected)
+                except Exception:
+                    logger.exception(f'Failed to write the estimates for {name}')
+
+    @staticmethod
+    def _verify(member: _Member, row: dict) -> bool:
+        """Check whether the fleet update matches that of the estimator, stepping the estimator if so
+
+        Args:
+            member: Estimator to be checked
+            row: Sample to be used in the next step
+        Returns:
+            Whether the estimator was stepped
+        """
+        holder = member.holder
+        if member.compatible is not None or holder._last_inputs is None:
+            return False
+        try:
+            view = _FilterView.from_estimator(holder.estimator)
+        except ValueError:
+            logger.exception('Filter cannot be read by the fleet engine. Its estimator will be stepped individually')
+            view = None
+        if view is None:
+            member.compatible = False
+            return False
+
+        # Compare the fleet update to that of the estimator using copies
+        inputs, outputs = row_to_inputs(row)
+        reference = deepcopy(holder.estimator)
+        reference.step(inputs, outputs)
+        trial = deepcopy(holder.estimator)
+        try:
+            step_filters([_FilterView.from_estimator(trial)],
+                         inputs.to_numpy().reshape(1, -1), outputs.to_numpy().reshape(1, -1))
+            ref_state, trial_state = reference.state, trial.state
+            member.compatible = bool(
+                np.allclose(trial_state.get_mean(), ref_state.get_mean(), rtol=1e-6, atol=1e-10)
+                and np.allclose(trial_state.get_covariance(), ref_state.get_covariance(), rtol=1e-6, atol=1e-12)
+            )
+        except Exception as e:
+            logger.info(f'Estimator cannot be stepped by the fleet engine: {e}')
+            member.compatible = False
+        if not member.compatible:
+            logger.info(f'Estimator of type {type(view.filter).__name__} will be stepped individually')
+            return False
+
+        # Use the reference as the stepped estimator
+        holder.estimator = reference
+        holder._last_inputs = inputs
+        holder.last_time = row['test_time']
+        member.view = _FilterView.from_estimator(reference)
+        return True
+
+    @staticmethod
+    def _step_group(group: list[tuple[str, _Member, dict]]):
+        """Step a group of estimators which share the same model"""
+        inputs = [row_to_inputs(row) for _, _, row in group]
+        step_filters(
+            [member.view for _, member, _ in group],
+            np.array([i.to_numpy().flatten() for i, _ in inputs]),
+            np.array([o.to_numpy().flatten() for _, o in inputs])
+        )
+        for (_, member, row), (new_inputs, _) in zip(group, inputs):
+            member.holder._last_inputs = new_inputs
+            member.holder.last_time = row['test_time']
+
+
+_engine = FleetEngine()
+_ticker: Thread | None = None
+_stop = Event()
+
+
+def get_fleet_engine() -> FleetEngine:
+    """Get the engine used for all estimators which opted in"""
+    return _engine
+
+
+def is_fleet_running() -> bool:
+    """Whether the engine is being advanced on a timer"""
+    return _ticker is not None and _ticker.is_alive()
+
+
+def start_fleet(interval: float | None = None):
+    """Begin advancing the fleet engine on a timer
+
+    Estimators in the fleet are stepped as soon as data arrive if the timer is not running.
+
+    Args:
+        interval: Time between steps of the engine (units: s).
+            Read from the ``ROVIWEB_FLEET_INTERVAL`` environment variable if not provided, default of 1 s
+    """
+    global _ticker
+    if is_fleet_running():
+        return
+    interval = float(interval or os.environ.get('ROVIWEB_FLEET_INTERVAL', 1.))
+
+    def _run():
+        while not _stop.wait(interval):
+            try:
+                _engine.advance()
+            except Exception:
+                logger.exception('Failed to advance fleet engine')
+
+    _stop.clear()
+    _ticker = Thread(target=_run, daemon=True, name='fleet-engine')
+    _ticker.start()
+
+
+def stop_fleet():
+    """Stop the timer and use all remaining samples"""
+    global _ticker
+    if _ticker is not None:
+        _stop.set()
+        _ticker.join()
+        _ticker = None
+    _engine.advance()
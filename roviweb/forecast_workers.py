@@ -0,0 +1,194 @@
+"""Pool of processes which run the forecasters
+
+Each forecaster is loaded from its bundle in the artifact store (see :mod:`roviweb.artifacts`)
+the first time a worker uses it, then kept so that models (e.g., pickled weights) are read once per worker
+rather than held in the web service.
+Forecasters of different batteries which use the same bundle share the function loaded by each worker.
+The web service gathers the inputs for a forecast, sends them to any free worker,
+and waits no longer than a time limit for the result.
+A worker which exceeds the limit or fails is stopped and the pool replaced.
+Forecasts interrupted because another forecast caused the pool to be replaced are run again in the new pool.
+"""
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from multiprocessing import get_context
+from pathlib import Path
+from threading import Lock
+import logging
+import os
+
+import pandas as pd
+
+from roviweb.artifacts import get_artifact_store
+from roviweb.schemas import PrognosticsFunction
+from roviweb.utils import load_variable, terminate_executor
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ForecasterSpec:
+    """Everything needed to load a forecaster in another process"""
+
+    name: str
+    """Name of the associated dataset"""
+    digest: str
+    """Digest of the definition and files in the artifact store"""
+    definition: str
+    """Contents of a Python file which defines the forecast function"""
+    directory: Path
+    """Directory holding the files associated with the definition"""
+
+
+# Functions which run in the worker processes
+_local_functions: dict[str, PrognosticsFunction] = {}
+
+
+def _worker_load(spec: ForecasterSpec) -> PrognosticsFunction:
+    """Load a forecaster if it is not already held by this worker"""
+    function = _local_functions.get(spec.digest)
+    if function is None:
+        function = _local_functions[spec.digest] = load_variable(spec.definition, 'forecast', spec.directory)
+    return function
+
+
+def _worker_check(spec: ForecasterSpec):
+    """Ensure a forecaster can be loaded"""
+    _worker_load(spec)
+
+
+def _worker_forecast(spec: ForecasterSpec, input_data: pd.DataFrame, load_scenario: pd.DataFrame) -> pd.DataFrame:
+    """Run a forecast"""
+    return _worker_load(spec)(input_data, load_scenario)
+
+
+# Functions which run in the web service
+_executor: ProcessPoolExecutor | None = None
+_num_workers: int = 0
+_timeout: float = 60.
+_pool_lock = Lock()
+
+
+def configure_forecast_workers(num_workers: int | None = None, timeout: float | None = None):
+    """Set the number of worker processes used to run forecasters and the time limit for each forecast
+
+    Forecasters registered while no workers are configured run in the web service process.
+
+    Args:
+        num_workers: Number of worker processes. Read from the ``ROVIWEB_FORECAST_WORKERS``
+            environment variable if not provided, default of zero
+        timeout: Maximum time for a single forecast (units: s). Read from the ``ROVIWEB_FORECAST_TIMEOUT``
+            environment variable if not provided, default of 60 s
+    """
+    global _num_workers, _timeout
+    close_forecast_workers()
+    _num_workers = num_workers if num_workers is not None else int(os.environ.get('ROVIWEB_FORECAST_WORKERS', 0))
+    _timeout = timeout or float(os.environ.get('ROVIWEB_FORECAST_TIMEOUT', 60.))
+
+
+def close_forecast_workers():
+    """Stop the worker processes"""
+    global _executor
+    with _pool_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True, cancel_futures=True)
+            _executor = None
+
+
+def forecast_workers_enabled() -> bool:
+    """Whether new forecasters are run in worker processes"""
+    return _num_workers > 0
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _pool_lock:
+        if _executor is None:
+            # Avoid copying the database connection and threads into the workers
+            _executor = ProcessPoolExecutor(max_workers=_num_workers, mp_context=get_context('spawn'))
+        return _executor
+
+
+def _replace_executor(executor: ProcessPoolExecutor):
+    """Stop the workers immediately, such as when one has exceeded the time limit"""
+    global _executor
+    with _pool_lock:
+        if _executor is executor:
+            _executor = None
+    terminate_executor(executor)
+
+
+def _was_replaced(executor: ProcessPoolExecutor) -> bool:
+    """Whether a pool has been stopped and replaced"""
+    with _pool_lock:
+        return _executor is not executor
+
+
+def _run(function, *args):
+    """Run a function in the pool, replacing the pool if the function exceeds the time limit or a worker dies
+
+    Functions which are interrupted because another function caused the pool to be replaced
+    are run again in the new pool.
+    """
+    while True:
+        executor = _get_executor()
+        try:
+            future = executor.submit(function, *args)
+        except RuntimeError:
+            # Raised if another thread shut down the pool since it was retrieved
+            if _was_replaced(executor):
+                continue
+            raise
+
+        try:
+            return future.result(timeout=_timeout)
+        except TimeoutError:
+            logger.warning(f'Forecast exceeded {_timeout:.1f} s. Restarting forecast workers')
+            _replace_executor(executor)
+            raise TimeoutError(f'Forecast took longer than {_timeout:.1f} s')
+        except (BrokenProcessPool, CancelledError) as e:
+            if _was_replaced(executor):
+                logger.info('Forecast interrupted by a restart of the forecast workers. Running it again')
+                continue
+            logger.warning('A forecast worker failed. Restarting forecast workers')
+            _replace_executor(executor)
+            raise BrokenProcessPool('A forecast worker failed') from e
+
+
+class RemoteForecast:
+    """Forecast function which runs in the worker processes
+
+    Args:
+        spec: Description of the forecaster
+    """
+
+    def __init__(self, spec: ForecasterSpec):
+        self.spec = spec
+
+    def __call__(self, input_data: pd.DataFrame, load_scenario: pd.DataFrame) -> pd.DataFrame:
+        return _run(_worker_forecast, self.spec, input_data, load_scenario)
+
+    def __repr__(self):
+        return f'RemoteForecast(name={self.spec.name})'
+
+
+def make_remote_forecast(name: str, definition: str, files: dict[str, bytes]) -> RemoteForecast:
+    """Make a forecaster which is loaded by the workers from the artifact store
+
+    Args:
+        name: Name of the associated dataset
+        definition: Contents of a Python file which defines a function named "forecast"
+        files: Files needed by the definition, as a map of file name to contents
+    Returns:
+        Function which runs the forecaster in a worker
+    """
+    store = get_artifact_store()
+    digest = store.put(definition, files)  # Already stored if uploaded through the web service
+    spec = ForecasterSpec(name=name, digest=digest, definition=definition,
+                          directory=store.path(digest).absolute() / 'files')
+    function = RemoteForecast(spec)
+
+    # Load it once to report errors in the definition at registration
+    _run(_worker_check, spec)
+    return function
@@ -0,0 +1,257 @@
+"""Pipeline which receives data on the event loop and writes it from a pool of threads
+
+Each battery has a queue of batches waiting to be written.
+A single task per battery pulls batches from the queue and runs the database write
+and estimator update in a thread pool, so batches for one battery are handled in order
+while the event loop remains free to receive data for others.
+"""
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from contextlib import asynccontextmanager
+from threading import Lock
+from typing import AsyncIterator
+import asyncio
+import logging
+
+from roviweb.db import write_records
+from roviweb.online import update_estimator, flush_estimates
+from roviweb.schemas import IngestStats, RecordType
+from roviweb.utils import records_to_columns
+
+logger = logging.getLogger(__name__)
+
+_executor: ThreadPoolExecutor | None = None
+_max_workers: int | None = None
+_queue_size: int = 16
+
+ingest_stats: dict[str, IngestStats] = {}
+"""Counters describing the data received for each battery"""
+
+
+def configure_ingest(max_workers: int | None = None, queue_size: int = 16):
+    """Set the resources available to the ingest pipeline
+
+    Args:
+        max_workers: Number of threads used to write data. Defaults to that of :class:`ThreadPoolExecutor`
+        queue_size: Maximum number of batches waiting to be written for each battery
+    """
+    global _max_workers, _queue_size
+    close_ingest()
+    _max_workers = max_workers
+    _queue_size = queue_size
+
+
+def close_ingest():
+    """Wait for all writes to finish then stop the thread pool"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=_max_workers, thread_name_prefix='ingest')
+    return _executor
+
+
+class IngestPipeline:
+    """Queue of batches to be written for a single battery and the task which writes them
+
+    Args:
+        name: Name of the battery
+        queue_size: Maximum number of batches to hold before pausing receipt of more data
+        previous: Pipeline for the same battery which is still closing, and must finish writing before this one starts
+    """
+
+    def __init__(self, name: str, queue_size: int, previous: 'IngestPipeline | None' = None):
+        self.name = name
+        self.queue_size = queue_size
+        self.connections = 0
+        self.loop = asyncio.get_running_loop()
+        self.stats = ingest_stats.setdefault(name, IngestStats())
+        self.closed = asyncio.Event()
+        """Set once all batches have been written and the pipeline stopped"""
+        self.previous = previous
+
+        self._queue: asyncio.Queue[tuple[dict[str, str], list[RecordType]]] = asyncio.Queue()
+        self._space = asyncio.Event()  # Set when a batch is removed from the queue
+        self._write_lock = Lock()  # Ensures only one batch is written at a time
+        self._in_flight: Future | None = None  # Batch being written by the thread pool
+        self._worker = asyncio.create_task(self._run())
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of batches waiting to be written"""
+        return self._queue.qsize()
+
+    async def put(self, type_map: dict[str, str], batch: list[RecordType], drop_when_full: bool = False):
+        """Add a batch to the queue, waiting for space if the queue is full
+
+        Args:
+            type_map: Map of column name to expected type
+            batch: Records to be written
+            drop_when_full: Whether to discard the batch rather than wait if the queue is full
+        """
+        if len(batch) == 0:
+            return
+        if self._queue.qsize() >= self.queue_size:
+            if drop_when_full:
+                self.stats.dropped += len(batch)
+                return
+            self.stats.stalls += 1
+            while self._queue.qsize() >= self.queue_size:
+                self._space.clear()
+                await self._space.wait()
+        self._queue.put_nowait((type_map, batch))
+
+    def put_nowait(self, type_map: dict[str, str] | None, batch: list[RecordType]):
+        """Add a batch to the queue even if the queue is full
+
+        Used for the last batch from a connection, which must not be lost.
+
+        Args:
+            type_map: Map of column name to expected type
+            batch: Records to be written
+        """
+        if len(batch) > 0:
+            self._queue.put_nowait((type_map, batch))
+
+    async def join(self):
+        """Wait until all batches have been written"""
+        await self._queue.join()
+
+    async def close(self):
+        """Stop the worker task, write any remaining batches, then the latest estimate
+
+        Writes run in the thread pool unless the calling task is cancelled,
+        in which case they are completed from the current thread so that no data are lost.
+        """
+        self._worker.cancel()
+        try:
+            while self._in_flight is not None or not self._queue.empty():
+                if self._in_flight is None:
+                    self._in_flight = _get_executor().submit(self._write, *self._queue.get_nowait())
+                    self._queue.task_done()
+                await asyncio.wait([asyncio.wrap_future(self._in_flight)])
+                if (error := self._in_flight.exception()) is not None:
+                    logger.error(f'Failed to write a batch for {self.name}', exc_info=error)
+                self._in_flight = None
+            await asyncio.to_thread(self._flush)
+        except asyncio.CancelledError:
+            self._close_now()
+            raise
+        finally:
+            self.closed.set()
+
+    def _close_now(self):
+        """Write any remaining batches then the latest estimate from the current thread"""
+        if self._in_flight is not None:
+            wait([self._in_flight])
+        while not self._queue.empty():
+            try:
+                self._write(*self._queue.get_nowait())
+            except Exception:
+                logger.exception(f'Failed to write a batch for {self.name}')
+            finally:
+                self._queue.task_done()
+        self._flush()
+
+    def _flush(self):
+        """Write the latest estimate"""
+        try:
+            flush_estimates(self.name)
+        except Exception:
+            logger.exception(f'Failed to write the latest estimate for {self.name}')
+
+    async def _run(self):
+        """Write batches from the queue until cancelled"""
+        if self.previous is not None:
+            await self.previous.closed.wait()
+            self.previous = None
+        while True:
+            type_map, batch = await self._queue.get()
+            self._space.set()
+            self._in_flight = _get_executor().submit(self._write, type_map, batch)
+            try:
+                # Shielded so that the write completes even if the worker is cancelled
+                await asyncio.shield(asyncio.wrap_future(self._in_flight))
+            except Exception:
+                logger.exception(f'Failed to write a batch for {self.name}')
+            finally:
+                self._queue.task_done()
+            self._in_flight = None  # Left in place if cancelled, so that closing waits for it
+
+    def _write(self, type_map: dict[str, str], batch: list[RecordType]):
+        """Write a batch of records then update the estimator"""
+        with self._write_lock:
+            try:
+                write_records(self.name, type_map, batch)
+                update_estimator(self.name, new_data=records_to_columns(batch))
+            except Exception:
+                self.stats.failures += 1
+                raise
+            self.stats.batches_written += 1
+            self.stats.records_written += len(batch)
+
+
+_pipelines: dict[str, IngestPipeline] = {}
+_closing: dict[str, IngestPipeline] = {}
+
+
+@asynccontextmanager
+async def open_pipeline(name: str) -> AsyncIterator[IngestPipeline]:
+    """Get the pipeline for a battery, creating one if needed
+
+    The pipeline is closed once all connections using it have exited
+    and the queue has been written.
+    Connections which open while it is closing receive a new pipeline,
+    which waits for the old one to finish writing before it starts.
+
+    Args:
+        name: Name of the battery
+    Yields:
+        Pipeline for that battery
+    """
+    pipeline = _pipelines.get(name)
+    if pipeline is None or pipeline.loop is not asyncio.get_running_loop():
+        previous = _closing.get(name)
+        if previous is not None and previous.loop is not asyncio.get_running_loop():
+            previous = None
+        pipeline = _pipelines[name] = IngestPipeline(name, _queue_size, previous)
+    pipeline.connections += 1
+    pipeline.stats.connections += 1
+    try:
+        yield pipeline
+    finally:
+        pipeline.connections -= 1
+        pipeline.stats.connections -= 1
+        if pipeline.connections == 0:
+            try:
+                await pipeline.join()
+            finally:
+                # Leave the pipeline open for any connections which arrived while waiting
+                if pipeline.connections == 0:
+                    if _pipelines.get(name) is pipeline:
+                        _pipelines.pop(name)
+                    _closing[name] = pipeline
+                    try:
+                        await pipeline.close()
+                    finally:
+                        if _closing.get(name) is pipeline:
+                            _closing.pop(name)
+
+
+def get_ingest_stats() -> dict[str, IngestStats]:
+    """Get the status of the ingest pipeline for each battery
+
+    Returns:
+        Map of battery name to counters and queue depth
+    """
+    output = {}
+    for name, stats in list(ingest_stats.items()):
+        stats = stats.model_copy()
+        if (pipeline := _pipelines.get(name)) is not None:
+            stats.queue_depth = pipeline.queue_depth
+        output[name] = stats
+    return output
@@ -0,0 +1,284 @@
+"""Run offline estimation in a pool of processes so that building an estimator does not block data ingest
+
+Offline estimation fits the initial health of a battery to the data gathered so far,
+which may take minutes for optimizers such as Nelder-Mead.
+Each job is sent the definition of the estimator and the training data,
+and returns the initial health and state estimates used to build the online estimator.
+Offline estimation runs in a background thread of the web service until :meth:`configure_offline_estimation`
+is called with a number of workers, or when only an already-loaded function is available.
+
+Results are stored (see :class:`~roviweb.cache.OfflineResultCache`) and reused when the same
+offline estimation function is given the same data, such as when an estimator is registered again.
+"""
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from hashlib import sha256
+from multiprocessing import get_context
+from threading import Lock
+from typing import Any, Callable, Mapping
+import ast
+import json
+import logging
+import os
+
+from battdat.data import BatteryDataset, CellDataset
+from moirae.models.base import HealthVariable, GeneralContainer
+
+from roviweb.artifacts import acquire_objects, release_objects
+from roviweb.cache import get_offline_cache
+from roviweb.db import connect, get_metadata
+from roviweb.utils import terminate_executor
+
+logger = logging.getLogger(__name__)
+
+OfflineEstimator = Callable[[BatteryDataset | None], tuple[HealthVariable, GeneralContainer]]
+"""Function which generates initial health and state estimates"""
+
+_executor: ProcessPoolExecutor | None = None
+_thread_executor: ThreadPoolExecutor | None = None
+_num_workers: int = 0
+_window: float | None = None
+_pool_lock = Lock()
+
+
+def _estimate(dataset: BatteryDataset | None, definition: str,
+              files: Mapping[str, bytes]) -> tuple[HealthVariable, GeneralContainer]:
+    """Run the offline estimator from a definition"""
+    digest, (offline_estimator,) = acquire_objects(definition, files, ('perform_offline_estimation',))
+    try:
+        return offline_estimator(dataset)
+    finally:
+        release_objects(digest, ('perform_offline_estimation',))
+
+
+def configure_offline_estimation(num_workers: int | None = None, window: float | None = None):
+    """Set the number of processes used for offline estimation and how much data they are given
+
+    Args:
+        num_workers: Number of worker processes, zero to run in a thread of the web service.
+            Read from the ``ROVIWEB_OFFLINE_WORKERS`` environment variable if not provided, default of 1
+        window: Span of test time of the most recent data used for offline estimation (units: s).
+            Read from the ``ROVIWEB_OFFLINE_WINDOW`` environment variable if not provided, default of all data
+    """
+    global _num_workers, _window
+    close_offline_estimation()
+    _num_workers = num_workers if num_workers is not None else int(os.environ.get('ROVIWEB_OFFLINE_WORKERS', 1))
+    if window is None and 'ROVIWEB_OFFLINE_WINDOW' in os.environ:
+        window = float(os.environ['ROVIWEB_OFFLINE_WINDOW'])
+    _window = window
+
+
+def close_offline_estimation():
+    """Stop the worker processes, abandoning any jobs in progress"""
+    global _executor, _thread_executor
+    with _pool_lock:
+        executor, _executor = _executor, None
+        thread_executor, _thread_executor = _thread_executor, None
+    if executor is not None:
+        # Jobs may run for minutes, so stop them rather than wait
+        terminate_executor(executor)
+    if thread_executor is not None:
+        # Threads cannot be stopped, so only cancel those which have yet to start
+        thread_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _pool_lock:
+        if _executor is None:
+            # Avoid copying the database connection and threads into the workers
+            _executor = ProcessPoolExecutor(max_workers=_num_workers, mp_context=get_context('spawn'))
+        return _executor
+
+
+def _get_thread_executor() -> ThreadPoolExecutor:
+    global _thread_executor
+    with _pool_lock:
+        if _thread_executor is None:
+            _thread_executor = ThreadPoolExecutor(max_workers=max(_num_workers, 1), thread_name_prefix='offline')
+        return _thread_executor
+
+
+def submit_offline_estimation(dataset: BatteryDataset | None,
+                              definition: str | None = None,
+                              files: Mapping[str, bytes] | None = None,
+                              function: OfflineEstimator | None = None) -> Future:
+    """Start offline estimation
+
+    Runs in a worker process if any are configured and the definition is provided,
+    and in a background thread otherwise.
+
+    Args:
+        dataset: Data used to fit the initial estimates, ``None`` if no data are required
+        definition: Contents of the Python file which defines ``perform_offline_estimation``
+        files: Any files associated with the definition, as a map of file name to contents
+        function: Offline estimation function already loaded in this process, used in place of the definition
+            when running in a thread
+    Returns:
+        Future which resolves to the initial health and state estimates
+    """
+    if _num_workers > 0 and definition is not None:
+        return _get_executor().submit(_estimate, dataset, definition, files or {})
+
+    if function is not None:
+        return _get_thread_executor().submit(function, dataset)
+    return _get_thread_executor().submit(_estimate, dataset, definition, files or {})
+
+
+def function_source_digest(definition: str, function_name: str) -> str:
+    """Hash the source code of a function and the parts of its file which it uses
+
+    Includes every top-level statement except the functions and classes which neither the function
+    nor those statements use, so that changes to other functions in the same file do not alter the hash.
+    Statements which define no names (e.g., setting a random seed) are included as they may alter the result.
+    Formatting and comments are ignored.
+
+    Args:
+        definition: Contents of a Python file
+        function_name: Name of the function
+    Returns:
+        Hex digest of the source
+    """
+    tree = ast.parse(definition)
+
+    # Find which top-level statements define each name, and which are always included
+    defines: dict[str, list[int]] = {}
+    always: list[int] = []
+    for i, node in enumerate(tree.body):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names = {node.name}
+        else:
+            names = set(n.id for n in ast.walk(node) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store))
+            always.append(i)
+        for name in names:
+            defines.setdefault(name, []).append(i)
+    if function_name not in defines:
+        raise ValueError(f'Function "{function_name}" not found in definition')
+
+    # Gather the function and the other statements, then the functions and classes they use
+    used, to_check = set(), always + defines[function_name]
+    while to_check:
+        i = to_check.pop()
+        if i in used:
+            continue
+        used.add(i)
+        for node in ast.walk(tree.body[i]):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+                to_check.extend(defines.get(node.id, ()))
+
+    hasher = sha256()
+    for text in [ast.unparse(tree.body[i]) for i in sorted(used)]:
+        hasher.update(text.encode() + b'\0')
+    return hasher.hexdigest()
+
+
+def offline_cache_key(name: str, definition: str, files: Mapping[str, bytes],
+                      data_range: tuple[int, float, float] | None, parameters: Mapping[str, Any]) -> str:
+    """Make the key under which the result of offline estimation is stored
+
+    Args:
+        name: Name of the battery
+        definition: Contents of the Python file which defines ``perform_offline_estimation``
+        files: Any files associated with the definition, as a map of file name to contents
+        data_range: Number of rows, first, and last test time of the data given to offline estimation,
+            ``None`` if not given data
+        parameters: Any other settings which affect the result
+    Returns:
+        Hex digest of all inputs
+    """
+    hasher = sha256(function_source_digest(definition, 'perform_offline_estimation').encode())
+    for filename in sorted(files):
+        hasher.update(filename.encode() + b'\0' + sha256(files[filename]).digest())
+    hasher.update(json.dumps([name, data_range, dict(parameters)], sort_keys=True).encode())
+    return hasher.hexdigest()
+
+
+def training_data_range(name: str, start_time: float, window: float | None = None) -> tuple[int, float, float] | None:
+    """Determine which data would be used to build an estimator, if enough are available
+
+    Args:
+        name: Name of the battery
+        start_time: Amount of time required until we can train the estimator
+        window: Span of test time of the most recent data to use (units: s), ``None`` to use all data
+    Returns:
+        Number of rows, first, and last test time of the data, ``None`` if not enough are available
+    """
+    conn = connect()
+
+    # Check whether enough data are available
+    first_time, last_time = conn.execute(f'SELECT MIN(test_time),MAX(test_time) FROM {name}').fetchone()
+    if first_time is None or last_time - first_time < start_time:
+        return None
+
+    if window is not None:
+        first_time = max(first_time, last_time - window)
+    rows, = conn.execute(f'SELECT COUNT(*) FROM {name} WHERE test_time BETWEEN $1 AND $2',
+                         [first_time, last_time]).fetchone()
+    return rows, first_time, last_time
+
+
+def read_training_data(name: str, data_range: tuple[int, float, float]) -> CellDataset:
+    """Read the data used to build an estimator
+
+    Args:
+        name: Name of the battery
+        data_range: Range of data from :meth:`training_data_range`
+    Returns:
+        Data for the battery within the range
+    """
+    _, first_time, last_time = data_range
+    raw_data = connect().execute(f'SELECT * FROM {name} WHERE test_time BETWEEN $1 AND $2 ORDER BY test_time ASC',
+                                 [first_time, last_time]).df()
+    return CellDataset(raw_data=raw_data, metadata=get_metadata(name))
+
+
+def start_offline_estimation(name: str, start_time: float,
+                             definition: str | None = None,
+                             files: Mapping[str, bytes] | None = None,
+                             function: OfflineEstimator | None = None) -> Future | None:
+    """Start offline estimation for a battery once enough data are available, reusing a stored result if possible
+
+    Results are only stored if the definition is provided.
+
+    Args:
+        name: Name of the battery
+        start_time: Amount of time required until we can train the estimator, no data are used if zero
+        definition: Contents of the Python file which defines ``perform_offline_estimation``
+        files: Any files associated with the definition, as a map of file name to contents
+        function: Offline estimation function already loaded in this process (see :meth:`submit_offline_estimation`)
+    Returns:
+        Future which resolves to the initial health and state estimates, ``None`` if not enough data are available
+    """
+    data_range = None
+    if start_time > 0:
+        data_range = training_data_range(name, start_time, _window)
+        if data_range is None:
+            return None
+
+    # Use the stored result if the function has been run with the same data
+    key = None
+    if definition is not None:
+        try:
+            key = offline_cache_key(name, definition, files or {}, data_range,
+                                    {'start_time': start_time, 'window': _window})
+        except (SyntaxError, ValueError):
+            logger.warning(f'Could not find the offline estimation function for {name}. Results will not be stored')
+    if key is not None and (result := get_offline_cache().get(key)) is not None:
+        future = Future()
+        future.set_result(result)
+        return future
+
+    dataset = None if data_range is None else read_training_data(name, data_range)
+    future = submit_offline_estimation(dataset, definition, files, function=function)
+    if key is not None:
+        future.add_done_callback(lambda f: _store_result(key, f))
+    return future
+
+
+def _store_result(key: str, future: Future):
+    """Store the result of offline estimation if it completed successfully"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    try:
+        get_offline_cache().put(key, future.result())
+    except Exception:
+        logger.exception('Failed to store the result of offline estimation')
@@ -1,19 +1,37 @@
 """Functions for managing online estimation"""
 import logging
 import dataclasses
+from concurrent.futures import Future
+from threading import Lock, Thread
 from battdat.data import BatteryDataset, CellDataset
-from typing import Callable
+from typing import Callable, Mapping, Sequence
 
+import numpy as np
+import pyarrow as pa
 from moirae.interface import row_to_inputs
 from moirae.estimators.online import OnlineEstimator
 from moirae.models.base import InputQuantities, HealthVariable, GeneralContainer
 
-from roviweb.db import register_data_source, connect, write_records, get_metadata
-from roviweb.schemas import RecordType
+from roviweb.artifacts import acquire_objects, release_objects, get_artifact_store
+from roviweb.db import register_columnar_source, connect, write_table, table_watermark
+from roviweb.offline import start_offline_estimation, training_data_range, read_training_data
+from roviweb.prognosis import append_estimates
+from roviweb.schemas import RecordType, EstimatorStatus, WritePolicy, OfflineStatus
 
 logger = logging.getLogger(__name__)
 
 
+def to_column_names(state_names: Sequence[str]) -> list[str]:
+    """Convert the names of state variables to names of columns in the estimates table
+
+    Args:
+        state_names: Names of the state variables
+    Returns:
+        Names of the columns
+    """
+    return [name.replace(".", "__").replace("[", "").replace("]", "") for name in state_names]
+
+
 @dataclasses.dataclass
 class EstimatorHolder:
     """Class which holds tools to build an estimator, the estimator, and data about its progress"""
@@ -28,15 +46,126 @@ class EstimatorHolder:
     """Test time at which the states are estimated (units: s)"""
     estimator: OnlineEstimator | None = None
     """Estimator being propagated"""
+    fleet: bool = False
+    """Whether to advance the estimator alongside others which share its model (see :mod:`roviweb.fleet`)"""
+    write_policy: WritePolicy = dataclasses.field(default_factory=WritePolicy)
+    """Conditions under which state estimates are written to the database"""
+    artifact: str | None = None
+    """Digest of the definition and files which created the builder functions (see :mod:`roviweb.artifacts`)"""
+    offline_status: OfflineStatus = 'waiting'
+    """Progress of the offline estimation which provides the initial estimates"""
+    offline_error: str | None = None
+    """Reason offline estimation failed, if it did"""
     _last_inputs: InputQuantities | None = None
     """Inputs from the last step"""
-
-    def step(self, record: RecordType):
-        """Step forward the estimator if possible"""
+    _state_columns: list[str] | None = None
+    """Names of the columns in the estimates table for each state variable"""
+    _synced: bool = False
+    """Whether the estimator has seen all data in the database up to :attr:`last_time`"""
+    _last_written: tuple[float, np.ndarray] | None = None
+    """Test time and mean of the last state written to the database"""
+    _steps_since_write: int = 0
+    """Number of steps since the last state was written"""
+    _unwritten: tuple[float, np.ndarray] | None = None
+    """Test time and mean of the latest state, if it has not been written"""
+    _lock: Lock = dataclasses.field(default_factory=Lock, repr=False, compare=False)
+    """Ensures the estimator is not read while being stepped by another thread"""
+    _offline_job: Future | None = dataclasses.field(default=None, repr=False, compare=False)
+    """Offline estimation in progress"""
+    _queued_rows: int = 0
+    """Number of rows received while the estimator was being built"""
+
+    @property
+    def state_columns(self) -> list[str]:
+        """Names of the columns in the estimates table for each state variable"""
+        if self._state_columns is None:
+            self._state_columns = to_column_names(self.estimator.state_names)
+        return self._state_columns
+
+    def get_status(self) -> EstimatorStatus:
+        """Summarize the current state of the estimator"""
+        if self.estimator is None:
+            return EstimatorStatus(is_ready=False, offline_status=self.offline_status,
+                                   offline_error=self.offline_error, queued_rows=self._queued_rows)
+
+        estimated_state = self.estimator.state
+        return EstimatorStatus(
+            is_ready=True,
+            offline_status='complete',
+            state_names=list(self.estimator.state_names),
+            latest_time=self.last_time,
+            mean=estimated_state.get_mean().tolist(),
+            covariance=estimated_state.get_covariance().tolist(),
+        )
+
+    def select_writes(self,
+                      times: np.ndarray,
+                      means: np.ndarray,
+                      covariances: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """Pick which state estimates to write according to the write policy
+
+        The latest estimate is held until :meth:`pop_unwritten` if it is not selected.
+
+        Args:
+            times: Test time of each estimate (units: s)
+            means: Mean of the state at each time
+            covariances: Covariance of the state at each time. Required if the policy uses a threshold
+        Returns:
+            - Test time of the estimates to be written
+            - Mean of the estimates to be written
+        """
+        policy = self.write_policy
+        if policy.writes_all:
+            self._unwritten = None
+            return times, means
+        if len(times) == 0:
+            return times, means
+
+        if policy.write_threshold is not None:
+            stds = np.sqrt(np.diagonal(covariances, axis1=1, axis2=2))
+        keep = np.zeros(len(times), dtype=bool)
+        for i, (time, mean) in enumerate(zip(times, means)):
+            self._steps_since_write += 1
+            if self._last_written is None:
+                keep[i] = True
+            else:
+                last_time, last_mean = self._last_written
+                keep[i] = (policy.write_every is not None and self._steps_since_write >= policy.write_every) or \
+                    (policy.write_interval is not None and time - last_time >= policy.write_interval) or \
+                    (policy.write_threshold is not None and
+                     np.any(np.abs(mean - last_mean) > policy.write_threshold * stds[i]))
+            if keep[i]:
+                self._last_written = (time, mean)
+                self._steps_since_write = 0
+
+        self._unwritten = None if keep[-1] else (times[-1], means[-1])
+        return times[keep], means[keep]
+
+    def pop_unwritten(self) -> tuple[np.ndarray, np.ndarray]:
+        """Get the latest state estimate if it has not been written, then mark it as written
+
+        Returns:
+            - Test time of the estimate, if not yet written
+            - Mean of the estimate, if not yet written
+        """
+        if self._unwritten is None:
+            return np.empty((0,)), np.empty((0, len(self.state_columns)))
+        time, mean = self._unwritten
+        self._unwritten = None
+        self._last_written = (time, mean)
+        self._steps_since_write = 0
+        return np.array([time]), mean[None, :]
+
+    def step(self, record: RecordType) -> bool:
+        """Step forward the estimator if possible
+
+        Returns:
+            Whether the estimator was stepped
+        """
 
         # Do nothing if the records are before the estimator's timestep
         if record['test_time'] < self.last_time:
-            return
+            return False
 
         # Convert the record to inputs
         inputs, outputs = row_to_inputs(record)
@@ -48,9 +177,116 @@ class EstimatorHolder:
         # Update state
         self._last_inputs = inputs
         self.last_time = record['test_time']
+        return True
+
+    def step_batch(self,
+                   test_time: np.ndarray,
+                   current: np.ndarray,
+                   voltage: np.ndarray,
+                   temperature: np.ndarray | None = None,
+                   return_covariance: bool = False) -> tuple[np.ndarray, ...]:
+        """Step forward the estimator through a block of data
+
+        Rows with a test time before that of any previous row are skipped, as in :meth:`step`.
+
+        Args:
+            test_time: Test time of each row (units: s)
+            current: Current of each row (units: A)
+            voltage: Voltage of each row (units: V)
+            temperature: Temperature of each row (units: C), if measured
+            return_covariance: Whether to return the covariance of the state after each step
+        Returns:
+            - Test time of each row used to step the estimator
+            - Mean of the state after each step
+            - (optional) Covariance of the state after each step
+        """
+
+        # Determine which rows to use
+        test_time = np.asarray(test_time, dtype=float)
+        prior_max = np.maximum.accumulate(np.concatenate([[self.last_time], test_time]))[:-1]
+        use = test_time >= prior_max
+        test_time = test_time[use]
+        current = np.asarray(current)[use]
+        voltage = np.asarray(voltage)[use]
+        if temperature is not None:
+            temperature = np.asarray(temperature)[use]
+
+        # Make the output arrays
+        num_rows = len(test_time)
+        num_states = len(self.estimator.state_names)
+        means = np.empty((num_rows, num_states))
+        covariances = np.empty((num_rows, num_states, num_states)) if return_covariance else None
+        if num_rows == 0:
+            return (test_time, means) + ((covariances,) if return_covariance else ())
+
+        for i in range(num_rows):
+            # Make new containers for each row, as the estimator may keep those from the previous step
+            row = {'test_time': test_time[i], 'current': current[i], 'voltage': voltage[i]}
+            if temperature is not None:
+                row['temperature'] = temperature[i]
+            inputs, outputs = row_to_inputs(row)
+
+            # Step if we have the previous step
+            if i > 0 or self._last_inputs is not None:
+                self.estimator.step(inputs, outputs)
+
+            state = self.estimator.state
+            means[i, :] = state.get_mean()
+            if return_covariance:
+                covariances[i, :, :] = state.get_covariance()
+
+        # Update state
+        self._last_inputs = inputs
+        self.last_time = test_time[-1]
+        return (test_time, means) + ((covariances,) if return_covariance else ())
 
 
 estimators: dict[str, EstimatorHolder] = {}  # Just hold in memory now
+_builder_variables = ('make_estimator', 'perform_offline_estimation')
+
+
+def make_holder(definition: str, files: Mapping[str, bytes] = None, start_time: float = 0., fleet: bool = False,
+                write_policy: WritePolicy | None = None, build: bool = True) -> EstimatorHolder:
+    """Create the holder for an estimator from the Python script which defines it
+
+    Args:
+        definition: Contents of a Python file which builds the model
+        files: Any files associated with the definition, as a map of file name to contents
+        start_time: Amount of time required until we can train the estimator
+        fleet: Whether to step the estimator alongside others which share the same model
+        write_policy: Conditions under which state estimates are written to the database
+        build: Whether to build the estimator now if no data are required
+    Returns:
+        Holder, with an estimator already built if no data are required and ``build`` is set
+    """
+
+    # Execute the definition, or reuse the functions from an earlier execution
+    digest, (estimator_maker, offline_estimator) = acquire_objects(definition, files or {}, _builder_variables)
+    holder = EstimatorHolder(
+        estimator_builder=estimator_maker,
+        offline_estimator=offline_estimator,
+        start_time=start_time,
+        last_time=-1,
+        fleet=fleet,
+        write_policy=write_policy or WritePolicy(),
+        artifact=digest,
+    )
+
+    # Make the estimator if no data are required
+    if build and start_time <= 0:
+        asoh, state = holder.offline_estimator(None)
+        holder.estimator = holder.estimator_builder(asoh, state)
+    return holder
+
+
+def release_holder(holder: EstimatorHolder):
+    """Mark that an estimator is no longer in use, freeing the functions which built it if not used by others
+
+    Args:
+        holder: Holder being removed
+    """
+    if holder.artifact is not None:
+        release_objects(holder.artifact, _builder_variables)
 
 
 def list_estimators() -> dict[str, EstimatorHolder]:
@@ -65,23 +301,63 @@ def list_estimators() -> dict[str, EstimatorHolder]:
 def register_estimator(name: str, estimator: EstimatorHolder):
     """Add a new estimators to those being tracked by the web service
 
+    Starts building the estimator if it requires no data.
+
     Args:
         name: Name of the associated dataset
         estimator: Estimator object
     """
-    estimators[name] = estimator
+    previous, estimators[name] = estimators.get(name), estimator
+    if previous is not None and previous is not estimator:
+        release_holder(previous)
+    if estimator.estimator is None and estimator.start_time <= 0:
+        with estimator._lock:
+            build_estimator(name, estimator)
+
 
+def has_estimator(name: str) -> bool:
+    """Whether an estimator is registered for a battery
 
-def update_estimator(name: str, missing_ok: bool = True) -> EstimatorHolder | None:
+    Args:
+        name: Name of the associated dataset
+    """
+    from roviweb.workers import is_remote
+    return name in estimators or is_remote(name)
+
+
+def list_estimator_status() -> dict[str, EstimatorStatus]:
+    """Get the current state of every estimator
+
+    Returns:
+        Map of name to the status of its estimator
+    """
+    from roviweb.workers import list_remote_status
+    output = dict((name, holder.get_status()) for name, holder in list(estimators.items()))
+    output.update(list_remote_status())
+    return output
+
+
+def update_estimator(name: str, missing_ok: bool = True,
+                     new_data: Mapping[str, np.ndarray] | None = None) -> EstimatorHolder | None:
     """Update an estimator with the latest data, record in DB
 
+    The estimator is updated using only the data provided if it has already
+    seen all data which precede them, and will read data from the database otherwise.
+
     Args:
         name: Name of the associated dataset
         missing_ok: Whether to error if there is no estimator available
+        new_data: Data which were just written to the database, as a map of column name to values
     Returns:
-        The latest copy of the estimator
+        The latest copy of the estimator, ``None`` if the estimator is held by a worker process
     """
 
+    # Hand off to the worker processes if they are in use
+    from roviweb.workers import is_remote, update_remote
+    if is_remote(name):
+        update_remote(name, missing_ok=missing_ok, new_data=new_data)
+        return None
+
     # Pull the estimator
     missing = name not in estimators
     if missing and not missing_ok:
@@ -90,52 +366,182 @@ def update_estimator(name: str, missing_ok: bool = True) -> EstimatorHolder | No
         return None
     holder = estimators[name]
 
-    # Build an estimator if none yet available
-    if holder.estimator is None and not build_estimator(name, holder):
-        return None
+    with holder._lock:
+        # Build an estimator if none yet available, counting the rows which must wait for it
+        if holder.estimator is None and not build_estimator(name, holder):
+            if holder._offline_job is not None and new_data is not None:
+                holder._queued_rows += len(new_data['test_time'])
+            return None
+
+        # Read the data from the database if the estimator has not seen all previous data
+        if new_data is None or not holder._synced:
+            new_data = read_rows_after(name, holder.last_time)
+
+        # Leave estimators in the fleet to be stepped alongside others
+        if holder.fleet:
+            from roviweb.fleet import get_fleet_engine
+            get_fleet_engine().submit(name, holder, new_data)
+            holder._synced = True
+            holder._queued_rows = 0
+        else:
+            # Update using the most recent data
+            holder._synced = False  # In case of a failure part way through
+            outputs = holder.step_batch(
+                test_time=new_data['test_time'],
+                current=new_data['current'],
+                voltage=new_data['voltage'],
+                temperature=new_data.get('temperature'),
+                return_covariance=holder.write_policy.write_threshold is not None
+            )
+            holder._synced = True
+            holder._queued_rows = 0
+            write_estimates(name, holder.state_columns, *holder.select_writes(*outputs))
+
+    # Step the fleet now if it is not on a timer, after releasing the estimator so the engine can lock it
+    if holder.fleet:
+        from roviweb.fleet import get_fleet_engine, is_fleet_running
+        if not is_fleet_running():
+            get_fleet_engine().advance()
+    return holder
+
+
+def flush_estimates(name: str):
+    """Write the latest state estimate for a battery if it was held back by the write policy
+
+    Args:
+        name: Name of the associated dataset
+    """
+    from roviweb.workers import is_remote, flush_remote
+    if is_remote(name):
+        flush_remote(name)
+        return
+
+    holder = estimators.get(name)
+    if holder is None or holder.estimator is None:
+        return
+    if holder.fleet:
+        from roviweb.fleet import get_fleet_engine
+        get_fleet_engine().advance()
+    with holder._lock:
+        write_estimates(name, holder.state_columns, *holder.pop_unwritten())
+
 
-    # Update using the most recent data
+def read_rows_after(name: str, last_time: float) -> dict[str, np.ndarray]:
+    """Read all data after a certain time
+
+    Args:
+        name: Name of the associated dataset
+        last_time: Test time of the last row already used (units: s)
+    Returns:
+        Map of column name to values, sorted by test time
+    """
     conn = connect()
-    new_data = conn.execute(f'SELECT * FROM {name} WHERE test_time >= $1 ORDER BY test_time ASC',
-                            [holder.last_time]).df()
-    new_records = []
-    for _, record in new_data.iterrows():
-        holder.step(record)
-        holder.last_time = record['test_time']
-        state_record = {'test_time': record['test_time']}
-        for vname, val in zip(holder.estimator.state_names, holder.estimator.state.get_mean()):
-            state_record[vname.replace(".", "__").replace("[", "").replace("]", "")] = val
-        new_records.append(state_record)
-
-    # Store the results in a database
+    return conn.execute(f'SELECT * FROM {name} WHERE test_time > $1 ORDER BY test_time ASC',
+                        [last_time]).fetchnumpy()
+
+
+def write_estimates(name: str, state_columns: list[str], times: np.ndarray, means: np.ndarray):
+    """Store the state estimates in the database
+
+    Args:
+        name: Name of the associated dataset
+        state_columns: Names of the column for each state variable
+        times: Test time of each estimate (units: s)
+        means: Mean of the state at each time
+    """
+    if len(times) == 0:
+        return
+
     db_name = f'{name}_estimates'
-    state_db_map = register_data_source(db_name, new_records[0])
-    write_records(db_name, state_db_map, new_records)
+    state_table = pa.table({
+        'test_time': times,
+        **dict((col, means[:, i]) for i, col in enumerate(state_columns))
+    })
+    state_db_map = register_columnar_source(db_name, state_table.schema)
+    write_table(db_name, state_db_map, state_table)
+    append_estimates(name, {'test_time': times, **dict(zip(state_columns, means.T))})
 
 
 def build_estimator(name: str, holder: EstimatorHolder) -> bool:
     """Build a new estimator given what data are available in the database
 
+    Starts offline estimation in the background once enough data are available (see :mod:`roviweb.offline`).
+    The estimator is built and stepped through the rows received meanwhile as soon as offline estimation completes.
+    Call while holding the lock of the holder.
+
     Args:
         name: Name of the associated dataset
         holder: Toolset for building the estimator
     Returns:
-        Whether the estimator was built
+        Whether the estimator is ready
     """
-
-    conn = connect()
-
-    # Check whether enough data are available
-    first_time, last_time = conn.execute(f'SELECT MIN(test_time),MAX(test_time) FROM {name}').fetchone()
-    if last_time - first_time < holder.start_time:
+    if holder.estimator is not None:
+        return True
+    if holder.offline_status == 'failed':
         return False
 
-    # Pull the data and metadata
-    raw_data = conn.execute(f'SELECT * FROM {name} ORDER BY test_time ASC').df()
-    metadata = get_metadata(name)
-    dataset = CellDataset(raw_data=raw_data, metadata=metadata)
+    # Start offline estimation if enough data are available
+    if holder._offline_job is None:
+        # Provide the definition to run offline estimation in another process and to store its results
+        definition, files = None, None
+        if holder.artifact is not None and get_artifact_store().has(holder.artifact):
+            definition, files = get_artifact_store().get(holder.artifact)
+        holder._offline_job = start_offline_estimation(name, holder.start_time, definition, files,
+                                                       function=holder.offline_estimator)
+        if holder._offline_job is None:
+            return False
+        holder.offline_status = 'running'
+        if not holder._offline_job.done():
+            holder._offline_job.add_done_callback(
+                lambda _: Thread(target=_complete_build, args=(name, holder), daemon=True).start()
+            )
+            return False
+
+    job = holder._offline_job
+    if not job.done():
+        return False
 
     # Run offline estimation to get initial parameter guesses
-    init_asoh, init_state = holder.offline_estimator(dataset)
-    holder.estimator = holder.estimator_builder(init_asoh, init_state)
+    holder._offline_job = None
+    try:
+        init_asoh, init_state = job.result()
+        holder.estimator = holder.estimator_builder(init_asoh, init_state)
+    except Exception as e:
+        logger.exception(f'Failed to build the estimator for {name}')
+        holder.offline_status = 'failed'
+        holder.offline_error = f'{type(e).__name__}: {e}'
+        return False
+    holder.offline_status = 'complete'
     return True
+
+
+def _complete_build(name: str, holder: EstimatorHolder):
+    """Build an estimator once offline estimation finishes, then step it through the rows received meanwhile"""
+    try:
+        if estimators.get(name) is not holder:
+            return
+        with holder._lock:
+            if not build_estimator(name, holder):
+                return
+        (_, rows), _ = table_watermark(name)
+        if rows > 0:
+            update_estimator(name)
+    except Exception:
+        logger.exception(f'Failed to update the estimator for {name} after it was built')
+
+
+def load_training_data(name: str, start_time: float, window: float | None = None) -> CellDataset | None:
+    """Read the data used to build an estimator if enough are available
+
+    Args:
+        name: Name of the associated dataset
+        start_time: Amount of time required until we can train the estimator
+        window: Span of test time of the most recent data to read (units: s), ``None`` to read all data
+    Returns:
+        Data for the battery, ``None`` if not enough are available
+    """
+
+    data_range = training_data_range(name, start_time, window)
+    if data_range is None:
+        return None
+    return read_training_data(name, data_range)
@@ -0,0 +1,152 @@
+"""Render figures in a pool of processes so that drawing does not block the web service
+
+The drawing functions receive only the data to be plotted, as the database is read by the web service,
+and use the object-oriented interface of matplotlib so that no global state is shared between figures.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
+from multiprocessing import get_context
+from typing import Callable
+import asyncio
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+
+from roviweb.utils import terminate_executor
+
+logger = logging.getLogger(__name__)
+
+_executor: ProcessPoolExecutor | None = None
+_max_workers: int = 2
+_max_concurrent: int = 4
+_timeout: float = 30.
+_semaphores: dict[asyncio.AbstractEventLoop, asyncio.Semaphore] = {}
+
+
+def _to_svg(fig: Figure) -> bytes:
+    """Save a figure as an SVG"""
+    fig.tight_layout()
+    io = StringIO()
+    fig.savefig(io, format='svg', dpi=320)
+    return io.getvalue().encode()
+
+
+def draw_history(since_pres: np.ndarray, data: dict[str, np.ndarray], resolution: float | None) -> bytes:
+    """Plot the voltage and current over time
+
+    Args:
+        since_pres: Time of each point relative to the latest measurement (units: hr)
+        data: Values of voltage and current, and their ranges within each bucket if summarized
+        resolution: Width of the buckets (units: s), ``None`` if the data are not summarized
+    Returns:
+        SVG of the figure
+    """
+    fig = Figure(figsize=(3.5, 4.))
+    axs = fig.subplots(2, 1, sharex=True)
+    for ax, col, label in zip(axs, ['voltage', 'current'], ['Voltage (V)', 'Current (A)']):
+        ax.plot(since_pres, data[col])
+        if resolution is not None:
+            ax.fill_between(since_pres, data[f'{col}_min'], data[f'{col}_max'], alpha=0.3, lw=0)
+        ax.set_ylabel(label)
+
+    axs[1].set_xlabel('Time (hr)')
+    return _to_svg(fig)
+
+
+def draw_forecast(asoh_est: pd.DataFrame, forecast: pd.DataFrame | None) -> bytes:
+    """Plot the history of health estimates and their forecast
+
+    Args:
+        asoh_est: Health estimates over time
+        forecast: Forecast of the health parameters, if available
+    Returns:
+        SVG of the figure
+    """
+    n_asoh = len(asoh_est.columns) - 1
+    fig = Figure(figsize=(6.5, 2 * n_asoh // 2))
+    axs = fig.subplots(n_asoh // 2 + n_asoh % 2, 2, sharex=True, squeeze=False)
+    for ax, col in zip(axs.flatten(), asoh_est.columns[1:]):
+        ax.plot(asoh_est['test_time'] / 3600 / 24, asoh_est[col], color='blue')
+        ax.set_title(col, fontsize=8, loc='left')
+
+        if forecast is not None and col in forecast:
+            ax.plot(forecast['test_time'] / 3600 / 24, forecast[col], color='red')
+
+    for ax in axs[-1, :]:
+        ax.set_xlabel('Time (d)')
+    return _to_svg(fig)
+
+
+def configure_rendering(max_workers: int | None = None, max_concurrent: int | None = None,
+                        timeout: float | None = None):
+    """Set the resources available for rendering figures
+
+    Args:
+        max_workers: Number of processes used to render. Read from the ``ROVIWEB_RENDER_WORKERS``
+            environment variable if not provided, default of 2
+        max_concurrent: Maximum number of figures being rendered or waiting for a process at once.
+            Default is twice the number of processes
+        timeout: Maximum time to render a single figure (units: s). Read from the ``ROVIWEB_RENDER_TIMEOUT``
+            environment variable if not provided, default of 30 s
+    """
+    global _max_workers, _max_concurrent, _timeout
+    close_rendering()
+    _max_workers = max_workers or int(os.environ.get('ROVIWEB_RENDER_WORKERS', 2))
+    _max_concurrent = max_concurrent or 2 * _max_workers
+    _timeout = timeout or float(os.environ.get('ROVIWEB_RENDER_TIMEOUT', 30.))
+    _semaphores.clear()
+
+
+def close_rendering():
+    """Stop the processes used to render figures"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=_max_workers, mp_context=get_context('spawn'))
+    return _executor
+
+
+def _terminate_executor():
+    """Stop the render processes immediately, such as when one has exceeded the timeout"""
+    global _executor
+    executor, _executor = _executor, None
+    if executor is not None:
+        terminate_executor(executor)
+
+
+async def render(function: Callable[..., bytes], *args) -> bytes:
+    """Render a figure in the process pool
+
+    Args:
+        function: Function which draws the figure
+        args: Inputs to the function
+    Returns:
+        Rendered figure
+    Raises:
+        TimeoutError: If rendering exceeds the time limit
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        # Remove semaphores from closed event loops then make one for this loop
+        for closed in [k for k in _semaphores if k.is_closed()]:
+            _semaphores.pop(closed)
+        semaphore = _semaphores[loop] = asyncio.Semaphore(_max_concurrent)
+
+    async with semaphore:
+        future = _get_executor().submit(function, *args)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), _timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f'Rendering with {function.__name__} exceeded {_timeout:.1f} s. Restarting render pool')
+            _terminate_executor()
+            raise TimeoutError(f'Rendering took longer than {_timeout:.1f} s')
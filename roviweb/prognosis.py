@@ -1,11 +1,122 @@
 """Methods used to forecast the performance of the battery in the future"""
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import count
+from threading import Lock
+from typing import Hashable, Iterator, Mapping
+import os
+
 import numpy as np
 import pandas as pd
 
-from roviweb.db import connect
-from roviweb.schemas import ForecasterInfo, LoadSpecification
+from roviweb.artifacts import acquire_objects, release_objects
+from roviweb.cache import get_prognosis_cache
+from roviweb.db import connect, table_columns, table_watermark
+from roviweb.forecast_workers import RemoteForecast, forecast_workers_enabled, make_remote_forecast
+from roviweb.schemas import ForecasterInfo, LoadSpecification, InputWindow, PrognosticsFunction
 
 forecasters: dict[str, ForecasterInfo] = {}  # Just hold in memory now
+_registrations = count()
+_versions: dict[str, int] = {}  # Number of the registration which created the forecaster of each battery
+_latest_times: dict[str, tuple[Hashable, float]] = {}  # Latest estimate time for each battery and table version
+_executor: ThreadPoolExecutor | None = None
+_max_workers: int = 4
+
+
+class InputBuffer:
+    """Most recent state estimates for a battery, held in the order they were written
+
+    Rows are appended to the end of a preallocated array and the array is only rewritten,
+    into a new array, once full. So, a view of the rows in the window at any time is never modified
+    and can be given to forecasters without a copy.
+
+    Args:
+        window: Description of which estimates to hold
+    """
+
+    def __init__(self, window: InputWindow):
+        self.window = window
+        self.columns = ['test_time'] + list(window.columns)
+        self._data = np.empty((2 * (window.rows or 1024), len(self.columns)))
+        self._start = self._end = 0
+        self._lock = Lock()
+
+    def _trimmed_start(self, data: np.ndarray, start: int, end: int) -> int:
+        """Find the first row within the window"""
+        if self.window.rows is not None:
+            start = max(start, end - self.window.rows)
+        if self.window.duration is not None and end > start:
+            times = data[start:end, 0]
+            start += int(np.searchsorted(times, times[-1] - self.window.duration, side='left'))
+        return start
+
+    def append(self, new_data: Mapping[str, np.ndarray]):
+        """Add new estimates
+
+        Args:
+            new_data: Values of ``test_time`` and each column. Missing columns are filled with NaN
+        """
+        times = np.asarray(new_data['test_time'], dtype=float)
+        block = np.full((len(times), len(self.columns)), np.nan)
+        for i, col in enumerate(self.columns):
+            if col in new_data:
+                block[:, i] = new_data[col]
+
+        with self._lock:
+            if self._end + len(block) <= len(self._data):
+                self._data[self._end:self._end + len(block)] = block
+                self._end += len(block)
+            else:
+                # Copy the rows still in the window to a new array with room for as many more
+                rows = np.concatenate([self._data[self._start:self._end], block])
+                rows = rows[self._trimmed_start(rows, 0, len(rows)):]
+                data = np.empty((max(len(self._data), 2 * len(rows)), len(self.columns)))
+                data[:len(rows)] = rows
+                self._data, self._end = data, len(rows)
+                self._start = 0
+            self._start = self._trimmed_start(self._data, self._start, self._end)
+
+    def view(self) -> pd.DataFrame:
+        """Get the estimates in the window, ordered by test time
+
+        Returns:
+            Dataframe backed by the buffer, which must not be modified
+        """
+        with self._lock:
+            rows = self._data[self._start:self._end]
+        rows.flags.writeable = False
+        return pd.DataFrame(rows, columns=self.columns, copy=False)
+
+
+input_buffers: dict[str, InputBuffer] = {}
+
+
+def append_estimates(name: str, new_data: Mapping[str, np.ndarray]):
+    """Add newly-written state estimates to the input buffer of a battery's forecaster, if it has one
+
+    Args:
+        name: Name of the battery
+        new_data: Values of ``test_time`` and each state variable
+    """
+    if (buffer := input_buffers.get(name)) is not None:
+        buffer.append(new_data)
+
+
+def _fill_buffer(name: str, buffer: InputBuffer):
+    """Load the estimates already in the database into a new input buffer"""
+    table = f'{name}_estimates'
+    watermark, _ = table_watermark(table)
+    if watermark[1] <= 0:
+        return
+
+    # Read the estimates within the window, skipping columns not yet in the table
+    conn = connect()
+    known = table_columns(table) or {}
+    columns = [c for c in buffer.columns if c in known]
+    limit = '' if buffer.window.rows is None else f' LIMIT {buffer.window.rows}'
+    where = '' if buffer.window.duration is None else \
+        f' WHERE test_time >= (SELECT MAX(test_time) FROM {table}) - {buffer.window.duration}'
+    data = conn.execute(f'SELECT {", ".join(columns)} FROM {table}{where} ORDER BY test_time DESC{limit}').fetchnumpy()
+    buffer.append(dict((k, np.ma.filled(np.ma.asarray(v, dtype=float)[::-1], np.nan)) for k, v in data.items()))
 
 
 # TODO (wardlt): Flesh this out
@@ -32,14 +143,165 @@ def perform_prognosis(name: str, load_scenario: pd.DataFrame) -> pd.DataFrame:
 
     # Load the estimator then execute
     forecaster = forecasters[name]
+    input_data = read_prognosis_inputs(name, forecaster)
+    return forecaster.function(input_data, load_scenario)
+
+
+def read_prognosis_inputs(name: str, forecaster: ForecasterInfo) -> pd.DataFrame:
+    """Gather the state estimates used as inputs to a forecaster
+
+    Args:
+        name: Name of the cell
+        forecaster: Forecaster which will use the inputs
+    Returns:
+        Estimates ordered by test time
+    """
+    # Pull the required data from memory if possible, or from the database otherwise
+    if forecaster.input_window is not None:
+        return input_buffers[name].view()
 
-    # Pull the required data
     query = forecaster.sql_query.replace('$TABLE_NAME$', f'{name}_estimates')
     conn = connect()
     input_data = conn.query(query).df()
-    input_data = input_data.loc[reversed(input_data.index)]  # Dataframe is returned backwards
+    return input_data.loc[reversed(input_data.index)]  # Dataframe is returned backwards
+
+
+def configure_prognosis_pool(max_workers: int | None = None):
+    """Set the number of workers used to run forecasts in batches
+
+    Args:
+        max_workers: Number of workers. Read from the ``ROVIWEB_PROGNOSIS_WORKERS``
+            environment variable if not provided, default of 4
+    """
+    global _max_workers
+    close_prognosis_pool()
+    _max_workers = max_workers or int(os.environ.get('ROVIWEB_PROGNOSIS_WORKERS', 4))
+
+
+def close_prognosis_pool():
+    """Stop the workers used to run forecasts"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=_max_workers, thread_name_prefix='prognosis')
+    return _executor
+
+
+def _combine_forecasts(scenarios: list[pd.DataFrame], forecasts: list[pd.DataFrame]) -> dict[str, np.ndarray]:
+    """Join the forecasts for each scenario into a single set of columns, labeled by scenario index"""
+    frames = []
+    for i, (scenario, forecast) in enumerate(zip(scenarios, forecasts)):
+        frame = scenario.drop(columns=[c for c in scenario.columns if c in forecast.columns])
+        frame = pd.concat([frame.reset_index(drop=True), forecast.reset_index(drop=True)], axis=1)
+        frame.insert(0, 'scenario', i)
+        frames.append(frame)
+    combined = pd.concat(frames, ignore_index=True)
+    return dict((c, combined[c].to_numpy()) for c in combined.columns)
 
-    return forecaster.function(input_data, load_scenario)
+
+def _run_stacked(forecaster: ForecasterInfo, input_data: pd.DataFrame,
+                 scenarios: list[pd.DataFrame]) -> dict[str, np.ndarray]:
+    """Run every scenario in a single call to a vectorized forecaster"""
+    stacked = pd.concat([s.assign(scenario=i) for i, s in enumerate(scenarios)], ignore_index=True)
+    forecast = forecaster.function(input_data, stacked)
+    return _combine_forecasts(
+        scenarios, [forecast[forecast['scenario'] == i].drop(columns=['scenario']) for i in range(len(scenarios))]
+    )
+
+
+def perform_batch_prognosis(names: list[str], loads: list[LoadSpecification]) \
+        -> Iterator[tuple[str, dict[str, np.ndarray] | Exception]]:
+    """Forecast the health of many cells under many load scenarios
+
+    The inputs for each cell are read once. Forecasters which accept many scenarios at once
+    (see :attr:`~roviweb.schemas.ForecasterInfo.vectorized`) are called once per cell,
+    and the others once per scenario, with calls spread over a pool of workers.
+
+    Args:
+        names: Names of the cells to evaluate
+        loads: Specifications of each load scenario
+    Yields:
+        Name of a cell and either the forecasts for all scenarios or the error which prevented them.
+        Forecasts include the index of the load specification for each row as ``scenario``
+    """
+    scenarios = [make_load_scenario(load) for load in loads]
+    executor = _get_executor()
+
+    # Start the forecasts for every cell
+    jobs: list[tuple[str, Future | list[Future] | Exception]] = []
+    for name in names:
+        try:
+            forecaster = forecasters[name]
+            input_data = read_prognosis_inputs(name, forecaster)
+        except KeyError:
+            jobs.append((name, KeyError(f'No forecaster for {name}')))
+            continue
+        except Exception as e:
+            jobs.append((name, e))
+            continue
+
+        if forecaster.vectorized:
+            jobs.append((name, executor.submit(_run_stacked, forecaster, input_data, scenarios)))
+        else:
+            jobs.append((name, [executor.submit(forecaster.function, input_data, s) for s in scenarios]))
+
+    # Return them in order
+    for name, job in jobs:
+        try:
+            if isinstance(job, Future):
+                job = job.result()
+            elif isinstance(job, list):
+                job = _combine_forecasts(scenarios, [f.result() for f in job])
+        except Exception as e:
+            job = e
+        yield name, job
+
+
+def _latest_estimate_time(name: str) -> float:
+    """Get the latest test time of the state estimates for a battery, ``NaN`` if there are none
+
+    Args:
+        name: Name of the battery
+    Returns:
+        Latest test time (units: s)
+    """
+    table = f'{name}_estimates'
+    watermark, _ = table_watermark(table)
+    if (known := _latest_times.get(name)) is not None and known[0] == watermark:
+        return known[1]
+
+    latest = np.nan
+    if watermark[1] > 0:
+        latest, = connect().execute(f'SELECT MAX(test_time) FROM {table}').fetchone()
+    _latest_times[name] = (watermark, latest)
+    return latest
+
+
+def get_prognosis(name: str, load_spec: LoadSpecification) -> pd.DataFrame:
+    """Get a forecast for a cell, reusing an earlier forecast if the state estimates have not changed
+
+    Identical requests made while a forecast is being computed wait for the same forecast.
+
+    Args:
+        name: Name of the cell to evaluate
+        load_spec: Specification of the anticipated load
+    Returns:
+        Dataframe containing the values of the aSOH parameters for each point in the load scenario
+    """
+    version = forecaster_version(name)
+    if version is None:
+        raise KeyError(f'No forecaster for {name}')
+    key = (name, version, tuple(load_spec.model_dump().items()))
+    forecast = get_prognosis_cache().get_or_compute(
+        key, _latest_estimate_time(name), lambda: perform_prognosis(name, make_load_scenario(load_spec))
+    )
+    return forecast.copy()
 
 
 def list_forecasters() -> dict[str, ForecasterInfo]:
@@ -51,6 +313,36 @@ def list_forecasters() -> dict[str, ForecasterInfo]:
     return forecasters.copy()
 
 
+def forecaster_version(name: str) -> tuple[str | None, int] | None:
+    """Identify the forecaster of a battery, which changes whenever a forecaster is registered
+
+    Args:
+        name: Name of the associated dataset
+    Returns:
+        Digest of the definition of the forecaster and the number of its registration, ``None`` if it has none
+    """
+    if name not in forecasters:
+        return None
+    return forecasters[name].artifact, _versions[name]
+
+
+def load_forecast_function(name: str, definition: str, files: dict[str, bytes]) -> PrognosticsFunction:
+    """Load the function which runs a forecaster
+
+    Args:
+        name: Name of the associated dataset
+        definition: Contents of a Python file which defines a function named "forecast"
+        files: Files needed by the definition, as a map of file name to contents
+    Returns:
+        Function run in the worker processes if they are in use,
+        or one loaded in this process and shared with other forecasters from the same files otherwise
+    """
+    if forecast_workers_enabled():
+        return make_remote_forecast(name, definition, files)
+    _, (function,) = acquire_objects(definition, files, ('forecast',))
+    return function
+
+
 def register_forecaster(name: str, forecaster: ForecasterInfo):
     """Add a new estimators to those being tracked by the web service
 
@@ -58,4 +350,25 @@ def register_forecaster(name: str, forecaster: ForecasterInfo):
         name: Name of the associated dataset
         forecaster: Forecaster description object
     """
-    forecasters[name] = forecaster
+    if forecaster.input_window is not None:
+        buffer = InputBuffer(forecaster.input_window)
+        _fill_buffer(name, buffer)
+        input_buffers[name] = buffer
+    else:
+        input_buffers.pop(name, None)
+    _versions[name] = next(_registrations)
+    previous, forecasters[name] = forecasters.get(name), forecaster
+    if previous is not None and previous is not forecaster:
+        release_forecaster(previous)
+    get_prognosis_cache().invalidate(lambda key: key[0] == name)
+
+
+def release_forecaster(forecaster: ForecasterInfo):
+    """Mark that a forecaster is no longer in use, freeing its function if not used by others
+
+    Args:
+        forecaster: Forecaster being removed
+    """
+    # Functions run by the worker processes are not held in this process
+    if forecaster.artifact is not None and not isinstance(forecaster.function, RemoteForecast):
+        release_objects(forecaster.artifact, ('forecast',))
@@ -1,10 +1,10 @@
 """Data models for interacting with web service"""
 import numpy as np
-from typing import Callable
+from typing import Callable, Literal
 
 import pandas as pd
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator, field_validator
 
 
 class TableStats(BaseModel):
@@ -25,17 +25,48 @@ class BatteryStats(BaseModel):
     """Whether a dataset for the cell has been uploaded"""
     has_estimator: bool
     """Whether an estimator is available for the cell"""
+    has_forecaster: bool = False
+    """Whether a forecaster is available for the cell"""
 
     # About the dataaset
     data_stats: TableStats | None
     """Description of the table"""
 
 
+class IngestStats(BaseModel):
+    """Progress of data being streamed for a certain battery"""
+
+    connections: int = 0
+    """Number of sockets currently streaming data"""
+    queue_depth: int = 0
+    """Number of batches waiting to be written"""
+    batches_written: int = 0
+    """Number of batches written to the database"""
+    records_written: int = 0
+    """Number of records written to the database"""
+    stalls: int = 0
+    """Number of times receipt of data paused because the queue was full"""
+    dropped: int = 0
+    """Number of records discarded because the queue was full"""
+    failures: int = 0
+    """Number of batches which failed to be written"""
+
+
+OfflineStatus = Literal['waiting', 'running', 'failed', 'complete']
+"""Progress of the offline estimation used to build an estimator"""
+
+
 class EstimatorStatus(BaseModel):
     """Condition and status of a state estimator"""
 
     is_ready: bool
     """Whether we have acquired enough data to start estimation"""
+    offline_status: OfflineStatus = 'waiting'
+    """Progress of the offline estimation which provides the initial estimates"""
+    offline_error: str | None = None
+    """Reason offline estimation failed, if it did"""
+    queued_rows: int = 0
+    """Number of rows received while the estimator was being built, which will be used once it is ready"""
     state_names: list[str] = ()
     """Names of each of the state"""
     latest_time: float = np.nan
@@ -45,21 +76,79 @@ class EstimatorStatus(BaseModel):
     covariance: list[list[float]] = ((),)
     """Covariance of the estimated states"""
 
+    @field_validator('latest_time', mode='before')
+    @classmethod
+    def _read_missing_time(cls, value):
+        # NaN is written as null in JSON, such as in the status gathered from other workers
+        return np.nan if value is None else value
+
 
 PrognosticsFunction = Callable[[pd.DataFrame, pd.DataFrame], pd.DataFrame]
 """Interface for functions which predict future aSOH given past estimates"""
 
 
+class InputWindow(BaseModel):
+    """Recent state estimates used as inputs to a forecaster
+
+    The estimates are held in memory as they are written rather than read from the database for each forecast.
+    """
+
+    columns: list[str] = Field(min_length=1)
+    """Names of the columns from the estimates table, not including ``test_time``"""
+    rows: int | None = Field(None, ge=1)
+    """Maximum number of the most recent estimates to provide"""
+    duration: float | None = Field(None, gt=0)
+    """Maximum span of test time before the latest estimate to provide (units: s)"""
+
+    @model_validator(mode='after')
+    def _check_bounded(self):
+        if self.rows is None and self.duration is None:
+            raise ValueError('Input window must limit either the number of rows or the duration')
+        return self
+
+
 class ForecasterInfo(BaseModel):
     """Information about how to run the prognosis models"""
 
     function: PrognosticsFunction = Field(repr=False)
     """Function to be invoked for inferring prognosis"""
-    sql_query: str = Field(pattern=r'(?:from|FROM) \$TABLE_NAME\$')
+    sql_query: str | None = Field(None, pattern=r'(?:from|FROM) \$TABLE_NAME\$')
     """Query used against the time series database to gather inference inputs"""
+    input_window: InputWindow | None = None
+    """Recent estimates used as inputs, which are used in place of :attr:`sql_query` if provided"""
+    vectorized: bool = False
+    """Whether the function accepts many load scenarios at once. If so, the load scenario includes
+    a column, ``scenario``, which identifies each scenario and must be included in the outputs"""
+    artifact: str | None = None
+    """Digest of the definition and files which created the function (see :mod:`roviweb.artifacts`)"""
     output_names: list[str] | None = None
     """Names of the columns output by the estimator"""
 
+    @model_validator(mode='after')
+    def _check_inputs(self):
+        if self.sql_query is None and self.input_window is None:
+            raise ValueError('Either a query or an input window must be provided')
+        return self
+
+
+class WritePolicy(BaseModel):
+    """Conditions under which state estimates are written to the database
+
+    An estimate is written if any condition is met, and every estimate is written if none are set.
+    """
+
+    write_every: int | None = Field(None, ge=1)
+    """Write after this many steps of the estimator"""
+    write_interval: float | None = Field(None, gt=0)
+    """Write once this much test time has passed since the last write (units: s)"""
+    write_threshold: float | None = Field(None, gt=0)
+    """Write when the mean of any state moves by more than this many standard deviations since the last write"""
+
+    @property
+    def writes_all(self) -> bool:
+        """Whether every estimate is written"""
+        return self.write_every is None and self.write_interval is None and self.write_threshold is None
+
 
 RecordType = dict[str, int | float | str]
 """Accepted format for DB records"""
@@ -75,3 +164,102 @@ class LoadSpecification(BaseModel):
     """How much time to forecast ahead (units: timesteps)"""
     resolution: float = Field(1, gt=0)
     """Resolution at which to produce forecasts (units: timesteps)"""
+
+
+class RenderCacheStats(BaseModel):
+    """Size and effectiveness of the cache of rendered figures"""
+
+    max_bytes: int
+    """Maximum total size of the figures held"""
+    max_entries: int
+    """Maximum number of figures held"""
+    entries: int = 0
+    """Number of figures held"""
+    bytes: int = 0
+    """Total size of the figures held"""
+    hits: int = 0
+    """Number of requests answered using a stored figure"""
+    misses: int = 0
+    """Number of requests which required rendering a figure"""
+    evictions: int = 0
+    """Number of figures removed to stay within limits"""
+    not_modified: int = 0
+    """Number of requests answered with "not modified" because the client already had the latest figure"""
+
+
+class BatchPrognosisRequest(BaseModel):
+    """Request for forecasts of many cells under many load scenarios"""
+
+    names: list[str] = Field(min_length=1)
+    """Names of the cells to evaluate"""
+    loads: list[LoadSpecification] = Field(min_length=1)
+    """Load scenarios to evaluate for each cell"""
+
+
+class PrognosisCacheStats(BaseModel):
+    """Size and effectiveness of the cache of forecasts"""
+
+    max_entries: int
+    """Maximum number of forecasts held"""
+    ttl: float
+    """Time after which a forecast is recomputed (units: s)"""
+    tolerance: float
+    """How far new estimates may advance past those used in a forecast before it is recomputed (units: s)"""
+    entries: int = 0
+    """Number of forecasts held"""
+    hits: int = 0
+    """Number of requests answered using a stored forecast"""
+    misses: int = 0
+    """Number of requests which required computing a forecast"""
+    coalesced: int = 0
+    """Number of requests which waited for an identical forecast already being computed"""
+    expirations: int = 0
+    """Number of forecasts removed because they were too old"""
+    invalidations: int = 0
+    """Number of forecasts removed because newer state estimates are available"""
+    evictions: int = 0
+    """Number of forecasts removed to stay within limits"""
+
+
+class OfflineCacheStats(BaseModel):
+    """Size and effectiveness of the stored results of offline estimation"""
+
+    max_bytes: int
+    """Maximum total size of the results held"""
+    entries: int = 0
+    """Number of results held"""
+    bytes: int = 0
+    """Total size of the results held"""
+    hits: int = 0
+    """Number of estimators built using a stored result"""
+    misses: int = 0
+    """Number of estimators which required running offline estimation"""
+    evictions: int = 0
+    """Number of results removed to stay within limits"""
+
+
+class SeriesData(BaseModel):
+    """Time series reduced to a number of points suitable for plotting"""
+
+    name: str
+    """Name of the table from which the data were read"""
+    resolution: float | None
+    """Width of the buckets the data were summarized over (units: s), ``None`` if raw data were read"""
+    method: str
+    """Technique used to select points"""
+    columns: dict[str, list[float | None]]
+    """Values of each column, including ``test_time``, with ``None`` for missing values. Summarized data include
+    the minimum and maximum of each column over each bucket as ``{column}_min`` and ``{column}_max``"""
+
+
+class ArtifactInfo(BaseModel):
+    """Description of a definition and its associated files held by the web service"""
+
+    digest: str
+    """Hash of the definition and files"""
+    definition_size: int
+    """Size of the definition (units: B)"""
+    files: dict[str, int]
+    """Names and sizes of each associated file (units: B)"""
+    references: int = 0
+    """Number of estimators or forecasters using the definition"""
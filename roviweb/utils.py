@@ -1,8 +1,14 @@
 """Utilities used in multiple modules"""
+from concurrent.futures import ProcessPoolExecutor
 from typing import Sequence
 from contextlib import chdir
 from pathlib import Path
 
+import numpy as np
+import pyarrow as pa
+
+from roviweb.schemas import RecordType
+
 
 def load_variable(text: str, variable_name: str | Sequence[str], working_dir: Path | None = None):
     """Executing a Python file and retrieving a single variable
@@ -26,3 +32,41 @@ def load_variable(text: str, variable_name: str | Sequence[str], working_dir: Pa
             return spec_ns[variable_name]
         else:
             return [spec_ns[s] for s in variable_name]
+
+
+def terminate_executor(executor: ProcessPoolExecutor):
+    """Stop the processes of a pool immediately rather than wait for their tasks to finish
+
+    Tasks which have not started are cancelled and those in progress fail with a ``BrokenProcessPool``.
+
+    Args:
+        executor: Pool to be stopped
+    """
+    # The pool holds no public reference to its processes, and clears it on shutdown.
+    #  Fall back to letting running tasks finish if the pool no longer stores its processes there
+    processes = list((getattr(executor, '_processes', None) or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+
+
+def records_to_columns(records: Sequence[RecordType]) -> dict[str, np.ndarray]:
+    """Convert a list of records to a map of column name to values
+
+    Args:
+        records: Records which all share the same keys
+    Returns:
+        Map of column name to array of values
+    """
+    return dict((key, np.array([record[key] for record in records])) for key in records[0])
+
+
+def table_to_columns(table: pa.Table) -> dict[str, np.ndarray]:
+    """Convert an Arrow table to a map of column name to values
+
+    Args:
+        table: Table to be converted
+    Returns:
+        Map of column name to array of values
+    """
+    return dict((name, column.to_numpy()) for name, column in zip(table.column_names, table.columns))
@@ -0,0 +1,446 @@
+"""Pool of processes which each hold the online estimators for a subset of batteries
+
+Each worker is a separate process holding the estimators for the batteries assigned to it,
+so that estimators for different batteries are stepped in parallel.
+The web service reads data from and writes estimates to the database,
+as DuckDB permits only one process to write, sends new rows to the worker which owns each battery,
+and keeps the latest state of each estimator for the status pages.
+Estimators are moved between workers as they are added or removed so that each worker holds a similar number.
+Workers step each estimator on its own, so those registered to join the fleet (see :mod:`roviweb.fleet`) do not.
+"""
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from multiprocessing import get_context
+from threading import Lock, Thread
+from typing import Mapping, Any
+import logging
+import os
+
+import numpy as np
+
+from roviweb.db import table_watermark
+from roviweb.offline import start_offline_estimation
+from roviweb.online import (EstimatorHolder, make_holder, read_rows_after,
+                            write_estimates, to_column_names, register_estimator, estimators, release_holder)
+from roviweb.schemas import EstimatorStatus, WritePolicy
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class EstimatorSpec:
+    """Everything needed to recreate an estimator in another process"""
+
+    definition: str
+    """Contents of a Python file which builds the model"""
+    files: dict[str, bytes] = field(default_factory=dict)
+    """Any files associated with the definition, as a map of file name to contents"""
+    start_time: float = 0.
+    """Amount of time required until we can train the estimator (units: s)"""
+    fleet: bool = False
+    """Whether to step the estimator alongside others which share the same model. Not used by worker processes"""
+    write_policy: WritePolicy = field(default_factory=WritePolicy)
+    """Conditions under which state estimates are written to the database"""
+
+    def make_holder(self, build: bool = True) -> EstimatorHolder:
+        """Create a holder for the estimator
+
+        Args:
+            build: Whether to build the estimator if no data are required
+        """
+        return make_holder(self.definition, self.files, self.start_time, fleet=self.fleet,
+                           write_policy=self.write_policy, build=build)
+
+
+_moved_attributes = ('estimator', 'last_time', '_last_inputs', '_last_written', '_steps_since_write', '_unwritten')
+"""Attributes of a holder which are copied when moving an estimator between processes or saving a checkpoint"""
+
+
+def save_state(holder: EstimatorHolder) -> dict[str, Any]:
+    """Get the parts of a holder which change as the estimator is stepped"""
+    return dict((attr, getattr(holder, attr)) for attr in _moved_attributes)
+
+
+def restore_state(holder: EstimatorHolder, saved_state: dict[str, Any]):
+    """Restore the parts of a holder which change as the estimator is stepped"""
+    for attr, value in saved_state.items():
+        setattr(holder, attr, value)
+
+
+# Functions which run in the worker processes
+_local_holders: dict[str, EstimatorHolder] = {}
+
+
+def _worker_load(name: str, spec: EstimatorSpec, saved_state: dict[str, Any] | None = None) -> EstimatorStatus:
+    """Create the holder for an estimator, restoring the state of the estimator if provided"""
+    holder = spec.make_holder(build=False)
+    if saved_state is not None:
+        restore_state(holder, saved_state)
+    _worker_drop(name)
+    _local_holders[name] = holder
+    return holder.get_status()
+
+
+def _worker_build(name: str, init_asoh, init_state) -> EstimatorStatus:
+    """Build an estimator from the initial estimates produced by offline estimation"""
+    holder = _local_holders[name]
+    holder.estimator = holder.estimator_builder(init_asoh, init_state)
+    return holder.get_status()
+
+
+def _worker_step(name: str, new_data: Mapping[str, np.ndarray]) -> tuple[np.ndarray, np.ndarray, EstimatorStatus]:
+    """Step an estimator through new data, returning the estimates to be written"""
+    holder = _local_holders[name]
+    outputs = holder.step_batch(
+        test_time=new_data['test_time'],
+        current=new_data['current'],
+        voltage=new_data['voltage'],
+        temperature=new_data.get('temperature'),
+        return_covariance=holder.write_policy.write_threshold is not None
+    )
+    return *holder.select_writes(*outputs), holder.get_status()
+
+
+def _worker_flush(name: str) -> tuple[np.ndarray, np.ndarray]:
+    """Get the latest estimate if it has not yet been written"""
+    return _local_holders[name].pop_unwritten()
+
+
+def _worker_save(name: str) -> dict[str, Any]:
+    """Get the state of an estimator, leaving it in this worker"""
+    return save_state(_local_holders[name])
+
+
+def _worker_export(name: str) -> dict[str, Any]:
+    """Remove an estimator from this worker and return its state"""
+    holder = _local_holders.pop(name)
+    release_holder(holder)
+    return save_state(holder)
+
+
+def _worker_drop(name: str):
+    """Remove an estimator from this worker"""
+    if (holder := _local_holders.pop(name, None)) is not None:
+        release_holder(holder)
+
+
+# Functions which run in the web service
+@dataclass
+class _Placement:
+    """Which worker holds an estimator and the latest state of the estimator"""
+
+    worker: int
+    """Index of the worker holding the estimator"""
+    spec: EstimatorSpec
+    """Description of the estimator"""
+    status: EstimatorStatus
+    """Latest state of the estimator"""
+    synced: bool = False
+    """Whether the estimator has seen all data in the database up to its latest time"""
+    offline_job: Future | None = None
+    """Offline estimation in progress, which runs in the web service rather than the worker"""
+    lock: Lock = field(default_factory=Lock)
+    """Ensures only one operation is performed on the estimator at a time"""
+
+
+_workers: list[ProcessPoolExecutor] = []
+_placements: dict[str, _Placement] = {}
+_pool_lock = Lock()  # Guards the list of workers and placements
+_rebalance_lock = Lock()  # Ensures only one thread is moving estimators
+
+
+def configure_workers(num_workers: int | None = None):
+    """Start the worker processes which hold the online estimators
+
+    Estimators registered while no workers are running are held in the web service process.
+
+    Args:
+        num_workers: Number of worker processes. Read from the ``ROVIWEB_ESTIMATOR_WORKERS``
+            environment variable if not provided, default of zero
+    """
+    close_workers()
+    if num_workers is None:
+        num_workers = int(os.environ.get('ROVIWEB_ESTIMATOR_WORKERS', 0))
+    ctx = get_context('spawn')  # Avoid copying the database connection and threads into the workers
+    with _pool_lock:
+        _workers.extend(ProcessPoolExecutor(max_workers=1, mp_context=ctx) for _ in range(num_workers))
+
+
+def close_workers():
+    """Move all estimators into the web service process then stop the workers"""
+    with _rebalance_lock, _pool_lock:
+        for name, placement in list(_placements.items()):
+            with placement.lock:
+                try:
+                    saved_state = _workers[placement.worker].submit(_worker_export, name).result()
+                    holder = placement.spec.make_holder(build=False)
+                    restore_state(holder, saved_state)
+                    holder._synced = placement.synced
+                    register_estimator(name, holder)
+                except Exception:
+                    logger.exception(f'Failed to retrieve the estimator for {name}')
+        _placements.clear()
+
+        for worker in _workers:
+            worker.shutdown(wait=True)
+        _workers.clear()
+
+
+def workers_enabled() -> bool:
+    """Whether new estimators are held by worker processes"""
+    return len(_workers) > 0
+
+
+def is_remote(name: str) -> bool:
+    """Whether the estimator for a battery is held by a worker process
+
+    Args:
+        name: Name of the battery
+    """
+    return name in _placements
+
+
+def list_remote_status() -> dict[str, EstimatorStatus]:
+    """Get the latest state of each estimator held by the workers
+
+    Returns:
+        Map of battery name to the status of its estimator
+    """
+    return dict((name, placement.status) for name, placement in list(_placements.items()))
+
+
+def place_estimator(name: str, spec: EstimatorSpec, saved_state: dict[str, Any] | None = None) -> EstimatorStatus:
+    """Create an estimator in the worker holding the fewest estimators
+
+    Replaces any estimator already associated with the battery.
+
+    Args:
+        name: Name of the battery
+        spec: Description of the estimator
+        saved_state: State of the estimator from :meth:`save_remote_state` or a checkpoint, if resuming
+    Returns:
+        Status of the new estimator
+    """
+    if not workers_enabled():
+        raise ValueError('No worker processes are running')
+    if spec.fleet:
+        logger.warning(f'The estimator for {name} will be stepped on its own, as workers do not use the fleet engine')
+
+    # Remove the previous estimator
+    _drop_placement(name)
+    if (previous := estimators.pop(name, None)) is not None:
+        release_holder(previous)
+
+    # Create the new one in the least-loaded worker, holding the lock until the worker has it
+    placement = _Placement(worker=-1, spec=spec, status=EstimatorStatus(is_ready=False))
+    with placement.lock:
+        with _pool_lock:
+            placement.worker = int(np.argmin(_count_placements()))
+            _placements[name] = placement
+            worker = _workers[placement.worker]
+        try:
+            placement.status = worker.submit(_worker_load, name, spec, saved_state).result()
+        except BaseException:
+            with _pool_lock:
+                _placements.pop(name, None)
+            raise
+
+        # Start building the estimator if it requires no data
+        if spec.start_time <= 0:
+            _build_remote(name, placement)
+
+    rebalance()
+    return placement.status
+
+
+def save_remote_state(name: str) -> tuple[EstimatorSpec, dict[str, Any]] | None:
+    """Copy the state of an estimator held by a worker
+
+    Args:
+        name: Name of the battery
+    Returns:
+        - Description of the estimator
+        - Attributes of the holder which change as the estimator is stepped
+        ``None`` if no worker holds an estimator for the battery
+    """
+    placement = _placements.get(name)
+    if placement is None:
+        return None
+    with placement.lock:
+        return placement.spec, _workers[placement.worker].submit(_worker_save, name).result()
+
+
+def remove_estimator(name: str):
+    """Remove the estimator for a battery from the workers
+
+    Args:
+        name: Name of the battery
+    """
+    if _drop_placement(name):
+        rebalance()
+
+
+def _drop_placement(name: str) -> bool:
+    """Remove an estimator from its worker, returning whether one was found"""
+    with _pool_lock:
+        placement = _placements.pop(name, None)
+    if placement is None:
+        return False
+    with placement.lock:
+        _workers[placement.worker].submit(_worker_drop, name).result()
+    return True
+
+
+def _count_placements() -> list[int]:
+    """Count the number of estimators held by each worker. Requires the pool lock"""
+    counts = [0] * len(_workers)
+    for placement in _placements.values():
+        counts[placement.worker] += 1
+    return counts
+
+
+def rebalance():
+    """Move estimators between workers until each holds a similar number"""
+    with _rebalance_lock:
+        while True:
+            with _pool_lock:
+                if not workers_enabled():
+                    return
+                counts = _count_placements()
+                busiest, idlest = int(np.argmax(counts)), int(np.argmin(counts))
+                if counts[busiest] - counts[idlest] <= 1:
+                    return
+                name, placement = next((n, p) for n, p in _placements.items() if p.worker == busiest)
+
+            # Move the estimator along with its state
+            with placement.lock:
+                # Skip estimators which were removed or moved while waiting for the lock
+                with _pool_lock:
+                    if _placements.get(name) is not placement or placement.worker != busiest:
+                        continue
+
+                saved_state = _workers[busiest].submit(_worker_export, name).result()
+                try:
+                    status = _workers[idlest].submit(_worker_load, name, placement.spec, saved_state).result()
+                except Exception:
+                    logger.exception(f'Failed to move the estimator for {name} to worker {idlest}. Returning it')
+                    _workers[busiest].submit(_worker_load, name, placement.spec, saved_state).result()
+                    return
+                if status.is_ready:  # Otherwise, keep the progress of offline estimation
+                    placement.status = status
+                placement.worker = idlest
+            logger.info(f'Moved estimator for {name} from worker {busiest} to {idlest}')
+
+
+def update_remote(name: str, missing_ok: bool = True, new_data: Mapping[str, np.ndarray] | None = None):
+    """Update an estimator held by a worker with the latest data, record in DB
+
+    Args:
+        name: Name of the associated dataset
+        missing_ok: Whether to error if there is no estimator available
+        new_data: Data which were just written to the database, as a map of column name to values
+    """
+
+    placement = _placements.get(name)
+    if placement is None:
+        if not missing_ok:
+            raise ValueError(f'No estimator associated with: {name}')
+        return
+
+    with placement.lock:
+        worker = _workers[placement.worker]
+
+        # Build an estimator if none yet available, counting the rows which must wait for it
+        if not _build_remote(name, placement):
+            if placement.offline_job is not None and new_data is not None:
+                placement.status.queued_rows += len(new_data['test_time'])
+            return
+
+        # Read the data from the database if the estimator has not seen all previous data
+        if new_data is None or not placement.synced:
+            new_data = read_rows_after(name, placement.status.latest_time)
+
+        # Step the estimator in the worker, then store the results
+        placement.synced = False
+        times, means, placement.status = worker.submit(_worker_step, name, dict(new_data)).result()
+        placement.synced = True
+        write_estimates(name, to_column_names(placement.status.state_names), times, means)
+
+
+def _build_remote(name: str, placement: _Placement) -> bool:
+    """Build an estimator held by a worker once enough data are available. Requires the lock of the placement
+
+    Offline estimation runs in the background (see :meth:`roviweb.online.build_estimator`)
+    and the worker builds the estimator from its results.
+
+    Args:
+        name: Name of the associated dataset
+        placement: Placement of the estimator
+    Returns:
+        Whether the estimator is ready
+    """
+    status = placement.status
+    if status.is_ready:
+        return True
+    if status.offline_status == 'failed':
+        return False
+
+    # Start offline estimation if enough data are available
+    if placement.offline_job is None:
+        spec = placement.spec
+        placement.offline_job = start_offline_estimation(name, spec.start_time, spec.definition, spec.files)
+        if placement.offline_job is None:
+            return False
+        status.offline_status = 'running'
+        if not placement.offline_job.done():
+            placement.offline_job.add_done_callback(
+                lambda _: Thread(target=_complete_remote_build, args=(name, placement), daemon=True).start()
+            )
+            return False
+
+    job = placement.offline_job
+    if not job.done():
+        return False
+
+    # Build the estimator in the worker
+    placement.offline_job = None
+    try:
+        init_asoh, init_state = job.result()
+        placement.status = _workers[placement.worker].submit(_worker_build, name, init_asoh, init_state).result()
+    except Exception as e:
+        logger.exception(f'Failed to build the estimator for {name}')
+        status.offline_status = 'failed'
+        status.offline_error = f'{type(e).__name__}: {e}'
+        return False
+    return True
+
+
+def _complete_remote_build(name: str, placement: _Placement):
+    """Build an estimator once offline estimation finishes, then step it through the rows received meanwhile"""
+    try:
+        if _placements.get(name) is not placement:
+            return
+        with placement.lock:
+            if not _build_remote(name, placement):
+                return
+        (_, rows), _ = table_watermark(name)
+        if rows > 0:
+            update_remote(name)
+    except Exception:
+        logger.exception(f'Failed to update the estimator for {name} after it was built')
+
+
+def flush_remote(name: str):
+    """Write the latest state estimate for a battery held by a worker if it was held back by the write policy
+
+    Args:
+        name: Name of the associated dataset
+    """
+    placement = _placements.get(name)
+    if placement is None:
+        return
+    with placement.lock:
+        if not placement.status.is_ready:
+            return
+        times, means = _workers[placement.worker].submit(_worker_flush, name).result()
+        write_estimates(name, to_column_names(placement.status.state_names), times, means)
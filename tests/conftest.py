@@ -1,5 +1,6 @@
 from shutil import copyfileobj
 from pathlib import Path
+from time import monotonic, sleep
 
 import requests
 from battdat.data import BatteryDataset
@@ -7,9 +8,13 @@ from pytest import fixture
 from fastapi.testclient import TestClient
 
 from roviweb.api import app
-from roviweb.online import estimators
-from roviweb.prognosis import forecasters
-from roviweb.db import connect, list_batteries
+from roviweb.artifacts import configure_artifact_store
+from roviweb.checkpoints import configure_checkpoints
+from roviweb.online import estimators, release_holder, list_estimator_status
+from roviweb.cache import get_prognosis_cache, configure_offline_cache, get_offline_cache
+from roviweb.prognosis import forecasters, input_buffers, release_forecaster
+from roviweb.db import connect, list_batteries, reload_catalog, rollup_table, ROLLUP_RESOLUTIONS
+from roviweb.workers import _placements
 
 _file_path = Path(__file__).parent / 'files'
 
@@ -39,16 +44,34 @@ def example_dataset(example_h5):
     return BatteryDataset.from_hdf(example_h5)
 
 
+@fixture(autouse=True, scope='session')
+def data_dir(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp('data')
+    configure_artifact_store(data_dir)
+    configure_checkpoints(data_dir)
+    configure_offline_cache(data_dir)
+
+
 @fixture(autouse=True)
 def reset_status():
     conn = connect()
     for name in list_batteries():
         conn.execute(f'DROP TABLE IF EXISTS {name}')
         conn.execute(f'DROP TABLE IF EXISTS {name}_estimates')
+        for resolution in ROLLUP_RESOLUTIONS:
+            conn.execute(f'DROP TABLE IF EXISTS {rollup_table(name, resolution)}')
 
     conn.execute('DELETE FROM battery_metadata')
+    reload_catalog()
+    for holder in estimators.values():
+        release_holder(holder)
     estimators.clear()
+    for forecaster in forecasters.values():
+        release_forecaster(forecaster)
     forecasters.clear()
+    input_buffers.clear()
+    get_prognosis_cache().clear()
+    get_offline_cache().clear()
 
 
 @fixture()
@@ -57,9 +80,46 @@ def est_file_path():
 
 
 @fixture()
-def upload_estimator(est_file_path, client):
-    """Register the online estimator"""
+def fake_estimator() -> str:
+    """Definition of an estimator which needs no model"""
+    return (_file_path / 'diagnosis' / 'fake-estimator.py').read_text()
+
+
+@fixture()
+def fake_forecaster() -> str:
+    """Definition of a forecaster which needs no model, and requires a file named ``scale.txt``"""
+    return (_file_path / 'prognosis' / 'fake-forecaster.py').read_text()
+
+
+@fixture()
+def wait_for_estimator():
+    """Function which waits until an estimator is built, or fails to build, and has stepped through a certain time"""
+
+    def _wait(name: str, test_time: float | None = None, timeout: float = 60.):
+        start = monotonic()
+        while True:
+            status = list_estimator_status().get(name)
+            if status is not None and (status.offline_status == 'failed' or (
+                    status.is_ready and (test_time is None or status.latest_time >= test_time))):
+                break
+            assert monotonic() - start < timeout, f'Estimator for {name} was not ready in time'
+            sleep(0.05)
+
+        # Estimates are written while holding the lock
+        holder = estimators.get(name)
+        with holder._lock if holder is not None else _placements[name].lock:
+            pass
+
+    return _wait
+
+
+@fixture()
+def upload_estimator(est_file_path, client, wait_for_estimator):
+    """Register the online estimator and wait until it is built"""
     with open(est_file_path.parent / 'initial-asoh.json', 'rb') as rb:
-        return client.post('/online/register',
-                           data={'name': 'module', 'definition': est_file_path.read_text(), 'start_time': 1.},
-                           files=[('files', ('initial-asoh.json', rb))])
+        reply = client.post('/online/register',
+                            data={'name': 'module', 'definition': est_file_path.read_text(), 'start_time': 1.},
+                            files=[('files', ('initial-asoh.json', rb))])
+    if reply.status_code == 200:
+        wait_for_estimator('module')
+    return reply
@@ -0,0 +1,20 @@
+"""Estimator which needs no model, used to test how estimators are managed"""
+from time import sleep
+from types import SimpleNamespace
+
+import numpy as np
+from moirae.estimators.online.filters.distributions import MultivariateGaussian
+
+DELAY = 0.  # Time taken by offline estimation, which fails if negative
+
+
+def perform_offline_estimation(dataset):
+    if DELAY < 0:
+        raise ValueError('Fit did not converge')
+    sleep(DELAY)
+    return 1., 2.
+
+
+def make_estimator(asoh, state):
+    return SimpleNamespace(asoh=asoh, state_names=('state',),
+                           state=MultivariateGaussian(mean=np.array([state]), covariance=np.eye(1)))
@@ -0,0 +1,19 @@
+"""Forecaster which needs no model, used to test how forecasters are managed
+
+Requires ``scale.txt`` holding a number which scales the latest value of ``a``.
+Takes one hundredth of the final test time of the load to run.
+"""
+import os
+from pathlib import Path
+from time import sleep
+
+import pandas as pd
+
+scale = float(Path('scale.txt').read_text())
+load_id = int.from_bytes(os.urandom(4), 'little')
+
+
+def forecast(inputs, load):
+    sleep(load['test_time'].iloc[-1] / 100)
+    return pd.DataFrame({'test_time': load['test_time'], 'q': inputs['a'].iloc[-1] * scale,
+                         'pid': os.getpid(), 'load_id': load_id})
@@ -0,0 +1,110 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+from pytest import raises
+
+from roviweb.artifacts import ArtifactStore, bundle_digest, acquire_objects, release_objects, count_references
+from roviweb.prognosis import list_forecasters
+
+_window = {'window_columns': ['a'], 'window_rows': 4}
+
+
+def test_digest(fake_forecaster):
+    digest = bundle_digest(fake_forecaster, {'scale.txt': b'2'})
+    assert len(digest) == 64
+    assert bundle_digest(fake_forecaster, {'scale.txt': b'2'}) == digest
+    assert bundle_digest(fake_forecaster, {'scale.txt': b'3'}) != digest
+    assert bundle_digest(fake_forecaster, {'other.txt': b'2'}) != digest
+    assert bundle_digest(fake_forecaster + '\n', {'scale.txt': b'2'}) != digest
+
+
+def test_store(tmp_path, fake_forecaster):
+    store = ArtifactStore(tmp_path)
+    digest = store.put(fake_forecaster, {'scale.txt': b'2'})
+    assert store.has(digest)
+    assert store.put(fake_forecaster, {'scale.txt': b'2'}) == digest
+    assert len(list(tmp_path.iterdir())) == 1  # Stored once
+
+    definition, files = store.get(digest)
+    assert definition == fake_forecaster
+    assert files == {'scale.txt': b'2'}
+    assert store.describe(digest).files == {'scale.txt': 1}
+
+    with raises(KeyError):
+        store.get('0' * 64)
+    with raises(ValueError, match='valid digest'):
+        store.get('../' + digest)
+    with raises(ValueError, match='directories'):
+        store.put(fake_forecaster, {'../scale.txt': b'2'})
+
+
+def test_shared_objects(fake_forecaster):
+    files = {'scale.txt': b'2'}
+    digest, (first,) = acquire_objects(fake_forecaster, files, ('forecast',))
+    _, (second,) = acquire_objects(fake_forecaster, files, ('forecast',))
+    assert first is second
+    assert count_references(digest) == 2
+
+    release_objects(digest, ('forecast',))
+    assert count_references(digest) == 1
+    release_objects(digest, ('forecast',))
+    assert count_references(digest) == 0
+
+    # Executed again once no longer held
+    _, (third,) = acquire_objects(fake_forecaster, files, ('forecast',))
+    assert third is not first
+    release_objects(digest, ('forecast',))
+
+
+def test_concurrent_loading(fake_forecaster):
+    files = {'scale.txt': b'2'}
+    slow = 'from time import sleep\nsleep(1.)\nvalue = object()\n'
+    digest, _ = acquire_objects(fake_forecaster, files, ('forecast',))
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(acquire_objects, slow, {}, ('value',))
+        sleep(0.1)
+        second = pool.submit(acquire_objects, slow, {}, ('value',))
+
+        # Objects which are already loaded are available while another definition executes
+        acquire_objects(fake_forecaster, files, ('forecast',))
+        release_objects(digest, ('forecast',))
+        assert count_references(digest) == 1
+        assert not first.done()
+
+        # A definition is executed once even if requested by several users
+        slow_digest, (value,) = first.result()
+        assert second.result()[1][0] is value
+    assert count_references(slow_digest) == 2
+
+    for name, variable in [(digest, 'forecast'), (slow_digest, 'value'), (slow_digest, 'value')]:
+        release_objects(name, (variable,))
+    assert count_references(digest) == count_references(slow_digest) == 0
+
+
+def test_register_by_digest(client, fake_forecaster):
+    # Upload the definition once
+    reply = client.post('/artifacts', data={'definition': fake_forecaster}, files=[('files', ('scale.txt', b'2'))])
+    assert reply.status_code == 200, reply.text
+    digest = reply.json()['digest']
+    assert digest == bundle_digest(fake_forecaster, {'scale.txt': b'2'})
+    assert client.get(f'/artifacts/{digest}').json()['references'] == 0
+
+    # Use it for two batteries without uploading it again
+    for name in ['a', 'b']:
+        reply = client.post('/prognosis/register', data={'name': name, 'artifact': digest, **_window})
+        assert reply.status_code == 200, reply.text
+    forecasters = list_forecasters()
+    assert forecasters['a'].function is forecasters['b'].function
+    assert forecasters['a'].artifact == digest
+    assert client.get(f'/artifacts/{digest}').json()['references'] == 2
+
+    # Replacing a forecaster releases its reference
+    reply = client.post('/prognosis/register', data={'name': 'a', 'definition': fake_forecaster, **_window},
+                        files=[('files', ('scale.txt', b'3'))])
+    assert reply.status_code == 200, reply.text
+    assert client.get(f'/artifacts/{digest}').json()['references'] == 1
+
+    # Unknown digests and missing definitions are rejected
+    assert client.get(f'/artifacts/{"0" * 64}').status_code == 404
+    assert client.post('/prognosis/register', data={'name': 'a', 'artifact': '0' * 64, **_window}).status_code == 404
+    assert client.post('/prognosis/register', data={'name': 'a', **_window}).status_code == 422
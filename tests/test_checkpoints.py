@@ -0,0 +1,81 @@
+import msgpack
+import numpy as np
+from moirae.estimators.online.filters.distributions import MultivariateGaussian
+
+from roviweb.checkpoints import configure_checkpoints, save_checkpoints, restore_checkpoints
+from roviweb.db import connect
+from roviweb.online import estimators
+
+
+def test_save_restore(client, tmp_path, fake_estimator, wait_for_estimator):
+    configure_checkpoints(tmp_path)
+    reply = client.post('/online/register', data={'name': 'cell', 'definition': fake_estimator})
+    assert reply.status_code == 200, reply.text
+    assert (tmp_path / 'checkpoints' / 'cell.pkl').is_file()  # Written at registration
+    wait_for_estimator('cell')
+
+    # Advance the estimator, then save it
+    holder = estimators['cell']
+    holder.estimator.state = MultivariateGaussian(mean=np.array([3.]), covariance=np.eye(1))
+    holder.last_time = 10.
+    holder._last_inputs = {'time': 10.}
+    assert save_checkpoints() == 1
+
+    # Restore it after losing the estimators
+    estimators.clear()
+    assert restore_checkpoints() == ['cell']
+    restored = estimators['cell']
+    assert restored is not holder
+    assert restored.artifact == holder.artifact
+    assert restored.estimator.state.get_mean().tolist() == [3.]
+    assert restored.last_time == 10.
+    assert restored._last_inputs == {'time': 10.}
+
+    # Remove checkpoints once an estimator is no longer registered
+    estimators.clear()
+    assert save_checkpoints() == 0
+    assert not (tmp_path / 'checkpoints' / 'cell.pkl').exists()
+
+
+def test_resume(client, example_dataset, upload_estimator, tmp_path):
+    configure_checkpoints(tmp_path)
+    example_dataset.metadata.name = 'module'
+    client.post("/db/register", content=example_dataset.metadata.model_dump_json())
+    raw_data = example_dataset.tables['raw_data']
+
+    # Step the estimator through a few rows then save it
+    with client.websocket_connect("/db/upload/module") as websocket:
+        for i in range(4):
+            websocket.send_bytes(msgpack.packb(raw_data.iloc[i].to_dict()))
+    save_checkpoints()
+
+    # Write more data while the estimator is lost, then restore it
+    estimators.clear()
+    client.post('/db/upload/module', data=raw_data.iloc[4:8].to_json(orient='records'))
+    assert restore_checkpoints() == ['module']
+
+    # The restored estimator should only step through the new rows, writing one estimate per row
+    assert estimators['module'].last_time == raw_data['test_time'].iloc[7]
+    conn = connect()
+    est_times = conn.execute('SELECT test_time FROM module_estimates ORDER BY test_time').fetchnumpy()['test_time']
+    assert np.allclose(est_times, raw_data['test_time'].iloc[:8])
+
+
+def test_no_duplicate_estimates(client, example_dataset, upload_estimator, tmp_path):
+    configure_checkpoints(tmp_path)
+    example_dataset.metadata.name = 'module'
+    client.post("/db/register", content=example_dataset.metadata.model_dump_json())
+    raw_data = example_dataset.tables['raw_data']
+
+    # Save a checkpoint, then keep writing estimates before the estimator is lost
+    client.post('/db/upload/module', data=raw_data.iloc[:4].to_json(orient='records'))
+    save_checkpoints()
+    client.post('/db/upload/module', data=raw_data.iloc[4:8].to_json(orient='records'))
+    estimators.clear()
+
+    # Restoring replaces the estimates written after the checkpoint
+    assert restore_checkpoints() == ['module']
+    conn = connect()
+    est_times = conn.execute('SELECT test_time FROM module_estimates ORDER BY test_time').fetchnumpy()['test_time']
+    assert len(np.unique(est_times)) == len(est_times)
+    assert np.allclose(est_times, raw_data['test_time'].iloc[:8])
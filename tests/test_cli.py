@@ -1,9 +1,15 @@
 from functools import partial
 from urllib import parse
 
+import httpx
+import numpy as np
+import pandas as pd
+from battdat.data import CellDataset
+from battdat.schemas import BatteryMetadata
+from httpx_ws.transport import ASGIWebSocketTransport
 from pytest import raises, fixture, mark
 
-from roviweb.cli import main
+from roviweb.cli import main, iter_raw_data
 
 
 @fixture(autouse=True)
@@ -19,12 +25,18 @@ def mock_web_service(mocker, client):
             partial(_call_test, method)
         )
 
-    # Wrap the websocket function
-    def _call_ws(url):
-        path = parse.urlparse(url)
-        return client.websocket_connect(path.path)
+    # Send requests and websockets from the asynchronous client directly to the application
+    mocker.patch('roviweb.cli.make_client', lambda url, max_connections=1: httpx.AsyncClient(
+        transport=ASGIWebSocketTransport(app=client.app), base_url='http://testserver'
+    ))
+
 
-    mocker.patch('roviweb.cli.connect_ws', _call_ws)
+@fixture()
+def small_h5(tmp_path):
+    raw_data = pd.DataFrame({'test_time': np.arange(10.), 'current': np.zeros(10), 'voltage': np.full(10, 3.5)})
+    path = tmp_path / 'small.h5'
+    CellDataset(raw_data=raw_data, metadata=BatteryMetadata(name='small')).to_hdf(path)
+    return path
 
 
 def test_help(capsys):
@@ -69,6 +81,35 @@ def test_upload(file_path, capsys, example_h5, clock_factor, est_file_path):
     assert f'  {name}: 4' in capsys.readouterr().out
 
 
+def test_read_chunks(small_h5):
+    chunks = list(iter_raw_data(small_h5, 4))
+    assert [c.num_rows for c in chunks] == [4, 4, 2]
+    assert np.allclose(np.concatenate([c['test_time'] for c in chunks]), np.arange(10.))
+    assert [c.num_rows for c in iter_raw_data(small_h5, 4, max_rows=5)] == [4, 1]
+
+
+@mark.parametrize('upload_format', ['arrow', 'json'])
+def test_upload_chunks(small_h5, capsys, upload_format):
+    main(['upload', 'small', '--chunk-size', '3', '--in-flight', '2', '--upload-format', upload_format, str(small_h5)])
+    assert 'Uploaded 10 rows for small' in capsys.readouterr().out
+
+    main(['status'])
+    assert '  small: 10' in capsys.readouterr().out
+
+
+def test_replay(small_h5, capsys):
+    main(['upload', 'small', '--clock-factor', '20', '--copies', '2', '--source', 'other', str(small_h5),
+          '--chunk-size', '4', '--max-frame-rows', '4', str(small_h5)])
+    out = capsys.readouterr().out
+    assert 'Replayed 40 rows' in out
+    assert 'to 4 batteries' in out
+
+    main(['status'])
+    out = capsys.readouterr().out
+    for name in ['small_0', 'small_1', 'other_0', 'other_1']:
+        assert f'  {name}: 10' in out
+
+
 def test_register_prognosis(file_path, capsys):
     main([
              'prognosis', 'register', 'module',
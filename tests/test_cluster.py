@@ -0,0 +1,148 @@
+from http.server import BaseHTTPRequestHandler
+from io import BytesIO
+from socketserver import UnixStreamServer
+from subprocess import Popen
+from threading import Thread
+from time import monotonic, sleep
+import fcntl
+import os
+import sys
+
+import msgpack
+from pytest import fixture, raises
+
+from roviweb.cluster import configure_cluster, close_cluster, owner_of, split_by_owner, worker_index, socket_path, \
+    FORWARDED_HEADER
+from roviweb.db import list_batteries
+
+
+@fixture()
+def other_worker(tmp_path):
+    """Launch a web service which serves as worker 0 of 2, leaving worker 1 for this process"""
+    env = dict(os.environ, ROVIWEB_WORKERS='2', ROVIWEB_DATA_DIR=str(tmp_path),
+               ROVIWEB_DB_PATH=str(tmp_path / 'duck.db'), ROVIWEB_RENDER_WORKERS='1', ROVIWEB_OFFLINE_WORKERS='0')
+    process = Popen([sys.executable, '-m', 'uvicorn', 'roviweb.api:app', '--uds', str(tmp_path / 'public.sock')],
+                    env=env, cwd=tmp_path)
+    try:
+        # Wait for it to start listening to other workers
+        start = monotonic()
+        while not (tmp_path / 'cluster' / '0.sock').exists():
+            assert process.poll() is None, 'Worker failed to start'
+            assert monotonic() - start < 60, 'Worker took too long to start'
+            sleep(0.1)
+
+        configure_cluster(2, tmp_path)
+        assert worker_index() == 1
+        yield
+    finally:
+        configure_cluster(1)
+        process.terminate()
+        process.wait()
+
+
+def test_ownership(tmp_path):
+    try:
+        # Indices are claimed in order
+        configure_cluster(3, tmp_path)
+        assert worker_index() == 0
+        assert socket_path(0) == tmp_path / 'cluster' / '0.sock'
+
+        # Batteries are spread between workers and always given to the same one
+        names = [f'cell{i}' for i in range(32)]
+        groups = split_by_owner(names)
+        assert set(groups) == {0, 1, 2}
+        assert all(owner_of(name) == i for i, group in groups.items() for name in group)
+        assert sorted(sum(groups.values(), [])) == sorted(names)
+
+        # Workers skip indices held by others, and fail if none remain
+        with (tmp_path / 'cluster' / '1.lock').open('w') as held:
+            fcntl.flock(held, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            configure_cluster(2, tmp_path)
+            assert worker_index() == 0
+            close_cluster()
+            with (tmp_path / 'cluster' / '0.lock').open('w') as other, raises(RuntimeError, match='taken'):
+                fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                configure_cluster(2, tmp_path)
+    finally:
+        configure_cluster(1)
+    assert owner_of('cell0') == worker_index() == 0
+
+
+def test_unreachable(tmp_path, client):
+    try:
+        # Claim worker 0 of 2 without starting worker 1
+        configure_cluster(2, tmp_path)
+        remote, local = (next(f'cell{i}' for i in range(32) if owner_of(f'cell{i}') == w) for w in (1, 0))
+
+        # Systems of the missing worker receive an error, in the order requested
+        reply = client.post('/prognosis/batch', json={'names': [remote, local, remote], 'loads': [{'ahead_time': 4}]})
+        assert reply.status_code == 200, reply.text
+        messages = list(msgpack.Unpacker(BytesIO(reply.content)))
+        assert [m['name'] for m in messages] == [remote, local, remote]
+        assert 'worker 1' in messages[0]['error']
+        assert local in messages[1]['error']
+    finally:
+        configure_cluster(1)
+
+
+def test_unhealthy_worker(tmp_path, client):
+    class _Failing(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(500)
+            self.send_header('content-length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    try:
+        # Claim worker 0 of 2, and make a worker 1 which fails every request
+        configure_cluster(2, tmp_path)
+        server = UnixStreamServer(str(socket_path(1)), _Failing)
+        Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            local = next(f'cell{i}' for i in range(32) if owner_of(f'cell{i}') == 0)
+            reply = client.post('/db/register', json={'name': local})
+            assert reply.status_code == 200, reply.text
+
+            # Requests about all batteries still give those of the healthy workers
+            reply = client.get('/db/stats')
+            assert reply.status_code == 200, reply.text
+            assert set(reply.json()) == {local}
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        configure_cluster(1)
+
+
+def test_forwarding(other_worker, client):
+    remote, local = (next(f'cell{i}' for i in range(32) if owner_of(f'cell{i}') == w) for w in (0, 1))
+
+    # Each battery is registered by its owner
+    for name in [remote, local]:
+        reply = client.post('/db/register', json={'name': name})
+        assert reply.status_code == 200, reply.text
+    assert list(list_batteries()) == [local]
+
+    # Data sent to any worker are written by the owner
+    records = [{'test_time': float(t), 'voltage': 3.5, 'received': 0.} for t in range(4)]
+    assert client.post(f'/db/upload/{remote}', json=records).json() == 4
+    with client.websocket_connect(f'/db/upload/{remote}') as websocket:
+        for t in range(4, 8):
+            websocket.send_bytes(msgpack.packb({'test_time': float(t), 'voltage': 3.5}))
+    assert not list_batteries()[local].has_data
+
+    # Clients cannot claim to be another worker
+    reply = client.post(f'/db/upload/{remote}', json=records, headers={FORWARDED_HEADER: '0'})
+    assert reply.status_code == 200, reply.text
+    assert list(list_batteries()) == [local]
+
+    # Requests about a battery are answered by its owner, and those about all batteries by every worker
+    start = monotonic()
+    while len(client.get(f'/series/{remote}').json()['columns']['test_time']) < 8:
+        assert monotonic() - start < 10, 'Streamed data were not written'
+        sleep(0.1)
+    stats = client.get('/db/stats').json()
+    assert set(stats) == {remote, local}
+    assert stats[remote]['data_stats']['rows'] == 12
@@ -0,0 +1,119 @@
+"""Test the database utilities"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+
+from roviweb.db import connect, configure_database, register_data_source, write_records, list_batteries, \
+    reload_catalog, has_battery, register_columnar_source, write_table, read_history, select_resolution, \
+    rollup_table, table_columns, table_watermark, delete_rows_after, ROLLUP_RESOLUTIONS, _rollup_select
+
+
+def test_connect():
+    # The same thread gets the same cursor
+    assert connect() is connect()
+
+    # Other threads get their own cursors to the same database
+    with ThreadPoolExecutor(1) as ex:
+        other = ex.submit(connect).result()
+    assert other is not connect()
+    assert other.execute('SELECT COUNT(*) FROM battery_metadata').fetchone() is not None
+
+
+def test_configure(tmp_path):
+    try:
+        configure_database(tmp_path / 'test.db', threads=1, memory_limit='256MB')
+        conn = connect()
+        assert conn.execute("SELECT current_setting('threads')").fetchone()[0] == 1
+        assert tmp_path.joinpath('test.db').is_file()
+        assert conn.execute('SELECT COUNT(*) FROM battery_metadata').fetchone()[0] == 0
+    finally:
+        configure_database()
+
+
+def test_catalog():
+    assert not has_battery('module')
+
+    # Make a table and write to it
+    type_map = register_data_source('module', {'a': 1, 'b': 1.})
+    assert type_map == {'a': 'INTEGER', 'b': 'FLOAT'}
+    write_records('module', type_map, [{'a': 1, 'b': 1.}] * 4)
+    assert has_battery('module')
+
+    stats = list_batteries()
+    assert stats['module'].data_stats.rows == 4
+    assert stats['module'].data_stats.columns == type_map
+    assert table_columns('module') == type_map
+    assert table_columns('missing') is None
+
+    # Make sure the catalog matches what is read from the database
+    reload_catalog()
+    assert list_batteries() == stats
+
+    # Types are taken from the existing table
+    assert register_data_source('module', {'b': 'not a float'}) == {'b': 'FLOAT'}
+
+
+def test_delete_rows():
+    type_map = register_data_source('module_estimates', {'test_time': 1.})
+    write_records('module_estimates', type_map, [{'test_time': float(i)} for i in range(4)])
+    before, _ = table_watermark('module_estimates')
+    assert before[1] == 4
+
+    # The watermark must differ after removing and then appending the same number of rows
+    assert delete_rows_after('module_estimates', 1.) == 2
+    write_records('module_estimates', type_map, [{'test_time': 5.}, {'test_time': 6.}])
+    after, _ = table_watermark('module_estimates')
+    assert after[1] == 4
+    assert after != before
+
+
+def test_rollups():
+    times = np.arange(0., 400.)
+    data = pa.table({'test_time': times, 'voltage': np.sin(times / 10)})
+    type_map = register_columnar_source('module', data.schema)
+
+    # Write the data in several pieces, which split buckets
+    write_table('module', type_map, data.slice(0, 77))
+    write_records('module', type_map, data.slice(77, 100).to_pylist())
+    write_table('module', type_map, data.slice(177))
+
+    # The rollups should match those computed from all data at once
+    conn = connect()
+    for resolution in ROLLUP_RESOLUTIONS:
+        expected = conn.execute(_rollup_select('module', resolution, ['voltage']) + ' ORDER BY bucket').fetchnumpy()
+        actual = conn.execute(f'SELECT * FROM {rollup_table("module", resolution)} ORDER BY bucket').fetchnumpy()
+        for key, values in expected.items():
+            assert np.allclose(actual[key], values), (resolution, key)
+
+    # Read at the coarsest resolution with enough points
+    assert select_resolution(24 * 3600, 800) == 60
+    assert select_resolution(3600, 800) is None
+    resolution, history = read_history('module', ['voltage'], 0, 400, 30)
+    assert resolution == 10
+    assert len(history['test_time']) == 40
+    assert np.all(history['voltage_min'] <= history['voltage'])
+    resolution, history = read_history('module', ['voltage'], 0, 400, 1000)
+    assert resolution is None
+    assert len(history['test_time']) == 400
+
+
+def test_partial_columns():
+    times = np.arange(0., 20.)
+    data = pa.table({'test_time': times, 'voltage': np.full(20, 3.5), 'current': np.ones(20)})
+    type_map = register_columnar_source('module', data.schema)
+    write_table('module', type_map, data.slice(0, 10))
+
+    # Write batches which hold only some of the columns
+    partial = data.select(['test_time', 'voltage']).slice(10)
+    write_table('module', register_columnar_source('module', partial.schema), partial.slice(0, 5))
+    records = partial.slice(5).to_pylist()
+    write_records('module', register_data_source('module', records[0]), records)
+    assert list_batteries()['module'].data_stats.rows == 20
+
+    # The rollups include only the values which were provided
+    conn = connect()
+    voltage_count, current_count = conn.execute(
+        f'SELECT sum(voltage_count), sum(current_count) FROM {rollup_table("module", 10.)}'
+    ).fetchone()
+    assert (voltage_count, current_count) == (20, 10)
@@ -0,0 +1,40 @@
+"""Test reducing time series to fewer points"""
+import numpy as np
+
+from roviweb.downsample import lttb, min_max, downsample
+
+
+def test_lttb():
+    x = np.arange(1000.)
+    y = np.sin(x / 50)
+    y[500] = 10.  # A spike which must be preserved
+
+    selected = lttb(x, y, 50)
+    assert len(selected) == 50
+    assert selected[0] == 0 and selected[-1] == 999
+    assert np.all(np.diff(selected) > 0)
+    assert 500 in selected
+
+    # No reduction if there are already few enough points
+    assert len(lttb(x[:10], y[:10], 50)) == 10
+
+
+def test_min_max():
+    y = np.sin(np.arange(1000.) / 50)
+    y[10] = np.nan
+    y[500] = -10.
+
+    selected = min_max(y, 50)
+    assert len(selected) <= 50
+    assert 500 in selected
+    assert np.nanargmax(y[:40]) in selected
+    assert 10 not in selected
+
+
+def test_downsample():
+    x = np.arange(1000.)
+    data = {'test_time': x, 'a': np.sin(x / 50), 'b': np.cos(x / 10)}
+    reduced = downsample(data, ['a', 'b'], 50)
+    assert set(reduced) == {'test_time', 'a', 'b'}
+    assert 50 <= len(reduced['test_time']) <= 100
+    assert np.allclose(reduced['b'], np.cos(reduced['test_time'] / 10))
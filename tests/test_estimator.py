@@ -1,8 +1,13 @@
 from typing import Callable
 
 from pytest import raises
+import numpy as np
 import msgpack
 
+from roviweb.db import connect, register_data_source
+from roviweb.fleet import FleetEngine
+from roviweb.online import EstimatorHolder
+from roviweb.schemas import WritePolicy
 from roviweb.utils import load_variable
 
 
@@ -41,3 +46,209 @@ def test_several_steps(client, example_dataset, est_file_path, upload_estimator)
     # Check the table status
     datasets = client.get('/db/status').json()
     assert len(datasets) == 1
+
+
+def test_incremental_feed(client, example_dataset, upload_estimator):
+    example_dataset.metadata.name = 'module'
+    client.post("/db/register", content=example_dataset.metadata.model_dump_json())
+    raw_data = example_dataset.tables['raw_data']
+
+    # Upload a few rows in bulk, which the estimator reads from the database
+    client.post('/db/upload/module', data=raw_data.head(8).to_json(orient='records'))
+
+    # Stream a few more, which are supplied directly to the estimator
+    with client.websocket_connect("/db/upload/module") as websocket:
+        for i in range(8, 12):
+            websocket.send_bytes(msgpack.packb(raw_data.iloc[i].to_dict()))
+
+    # There should be one estimate for every row
+    conn = connect()
+    raw_times = conn.execute('SELECT test_time FROM module ORDER BY test_time').fetchnumpy()['test_time']
+    est_times = conn.execute('SELECT test_time FROM module_estimates ORDER BY test_time').fetchnumpy()['test_time']
+    assert np.allclose(raw_times, est_times)
+
+
+def test_step_batch(est_file_path, example_dataset):
+    # Make two copies of the same estimator
+    make_estimator, offline_estimator = load_variable(
+        est_file_path.read_text(),
+        variable_name=('make_estimator', 'perform_offline_estimation'),
+        working_dir=est_file_path.parent)
+    holders = []
+    for _ in range(2):
+        holder = EstimatorHolder(offline_estimator=offline_estimator, estimator_builder=make_estimator,
+                                 start_time=0, last_time=-1)
+        holder.estimator = make_estimator(*offline_estimator(None))
+        holders.append(holder)
+
+    # Step one row-by-row and the other in a single batch
+    raw_data = example_dataset.tables['raw_data'].head(16)
+    row_means = []
+    for _, row in raw_data.iterrows():
+        holders[0].step(row)
+        row_means.append(holders[0].estimator.state.get_mean())
+    times, means, covs = holders[1].step_batch(
+        raw_data['test_time'].values, raw_data['current'].values, raw_data['voltage'].values, return_covariance=True
+    )
+
+    assert np.allclose(times, raw_data['test_time'])
+    assert means.shape == (16, len(holders[1].estimator.state_names))
+    assert covs.shape == (16, means.shape[1], means.shape[1])
+    assert holders[0].last_time == holders[1].last_time
+    assert np.allclose(holders[0].estimator.state.get_mean(), means[-1])
+    assert np.allclose(row_means, means)
+
+
+def test_fleet(est_file_path, example_dataset):
+    make_estimator, offline_estimator = load_variable(
+        est_file_path.read_text(),
+        variable_name=('make_estimator', 'perform_offline_estimation'),
+        working_dir=est_file_path.parent)
+
+    def _make_holder(fleet: bool) -> EstimatorHolder:
+        holder = EstimatorHolder(offline_estimator=offline_estimator, estimator_builder=make_estimator,
+                                 start_time=0, last_time=-1, fleet=fleet)
+        holder.estimator = make_estimator(*offline_estimator(None))
+        return holder
+
+    # Step two batteries in the fleet, giving them different data
+    raw_data = example_dataset.tables['raw_data']
+    engine = FleetEngine()
+    fleet = {'fleet_a': _make_holder(True), 'fleet_b': _make_holder(True)}
+    for name in fleet:
+        register_data_source(name, {'test_time': 0.})  # So the tables are removed after the test
+    data = {'fleet_a': raw_data.iloc[:16], 'fleet_b': raw_data.iloc[16:28]}
+    for name, holder in fleet.items():
+        engine.submit(name, holder, dict((c, data[name][c].values) for c in data[name].columns))
+    assert engine.num_pending == 28
+    engine.advance()
+    assert engine.num_pending == 0
+
+    # Compare to stepping each on its own
+    conn = connect()
+    for name, holder in fleet.items():
+        reference = _make_holder(False)
+        reference.step_batch(data[name]['test_time'].values, data[name]['current'].values, data[name]['voltage'].values)
+        assert holder.last_time == reference.last_time
+        assert np.allclose(holder.estimator.state.get_mean(), reference.estimator.state.get_mean())
+
+        est_times = conn.execute(f'SELECT test_time FROM {name}_estimates').fetchnumpy()['test_time']
+        assert np.allclose(np.sort(est_times), data[name]['test_time'])
+
+
+def test_fleet_failures(est_file_path, example_dataset, monkeypatch):
+    make_estimator, offline_estimator = load_variable(
+        est_file_path.read_text(),
+        variable_name=('make_estimator', 'perform_offline_estimation'),
+        working_dir=est_file_path.parent)
+
+    def _make_holder(fleet: bool) -> EstimatorHolder:
+        holder = EstimatorHolder(offline_estimator=offline_estimator, estimator_builder=make_estimator,
+                                 start_time=0, last_time=-1, fleet=fleet)
+        holder.estimator = make_estimator(*offline_estimator(None))
+        return holder
+
+    def _fail(*args, **kwargs):
+        raise RuntimeError('Fails on purpose')
+
+    # Make one estimator which always fails, and make every group step fail
+    raw_data = example_dataset.tables['raw_data'].head(16)
+    engine = FleetEngine()
+    fleet = {'fleet_a': _make_holder(True), 'fleet_b': _make_holder(True), 'fleet_bad': _make_holder(True)}
+    monkeypatch.setattr(fleet['fleet_bad'], 'step', _fail)
+    monkeypatch.setattr(FleetEngine, '_step_group', staticmethod(_fail))
+    for name, holder in fleet.items():
+        register_data_source(name, {'test_time': 0.})
+        engine.submit(name, holder, dict((c, raw_data[c].values) for c in raw_data.columns))
+    engine.advance()
+    assert engine.num_pending == 0
+
+    # The others must still be stepped and written
+    conn = connect()
+    reference = _make_holder(False)
+    reference.step_batch(raw_data['test_time'].values, raw_data['current'].values, raw_data['voltage'].values)
+    for name in ['fleet_a', 'fleet_b']:
+        assert fleet[name].last_time == reference.last_time
+        assert np.allclose(fleet[name].estimator.state.get_mean(), reference.estimator.state.get_mean())
+        est_times = conn.execute(f'SELECT test_time FROM {name}_estimates').fetchnumpy()['test_time']
+        assert np.allclose(np.sort(est_times), raw_data['test_time'])
+    assert fleet['fleet_bad'].last_time == -1
+
+
+def test_fleet_different_health(est_file_path, example_dataset):
+    make_estimator, offline_estimator = load_variable(
+        est_file_path.read_text(),
+        variable_name=('make_estimator', 'perform_offline_estimation'),
+        working_dir=est_file_path.parent)
+
+    def _make_holder(fleet: bool, ocv_shift: float) -> EstimatorHolder:
+        holder = EstimatorHolder(offline_estimator=offline_estimator, estimator_builder=make_estimator,
+                                 start_time=0, last_time=-1, fleet=fleet)
+        asoh, state = offline_estimator(None)
+        asoh.ocv.ocv_ref.base_values = asoh.ocv.ocv_ref.base_values + ocv_shift  # Not estimated by the filter
+        holder.estimator = make_estimator(asoh, state)
+        return holder
+
+    # Step two batteries with different health parameters through the same data
+    raw_data = example_dataset.tables['raw_data'].head(16)
+    engine = FleetEngine()
+    shifts = {'fleet_a': 0., 'fleet_b': 0.05}
+    fleet = dict((name, _make_holder(True, shift)) for name, shift in shifts.items())
+    for name, holder in fleet.items():
+        register_data_source(name, {'test_time': 0.})
+        engine.submit(name, holder, dict((c, raw_data[c].values) for c in raw_data.columns))
+    engine.advance()
+
+    # Each must match stepping it on its own
+    for name, holder in fleet.items():
+        reference = _make_holder(False, shifts[name])
+        reference.step_batch(raw_data['test_time'].values, raw_data['current'].values, raw_data['voltage'].values)
+        assert np.allclose(holder.estimator.state.get_mean(), reference.estimator.state.get_mean())
+    assert not np.allclose(fleet['fleet_a'].estimator.state.get_mean(), fleet['fleet_b'].estimator.state.get_mean())
+
+
+def test_write_policy():
+    times = np.arange(10.)
+    means = times[:, None]
+
+    # Write every few steps, holding the last estimate until flushed
+    holder = EstimatorHolder(offline_estimator=None, estimator_builder=None, start_time=0, last_time=-1,
+                             write_policy=WritePolicy(write_every=4), _state_columns=['x'])
+    written, _ = holder.select_writes(times, means)
+    assert written.tolist() == [0, 4, 8]
+    written, written_means = holder.pop_unwritten()
+    assert written.tolist() == [9] and written_means.shape == (1, 1)
+    assert len(holder.pop_unwritten()[0]) == 0
+
+    # Write only when the state moves by more than a few standard deviations
+    holder = EstimatorHolder(offline_estimator=None, estimator_builder=None, start_time=0, last_time=-1,
+                             write_policy=WritePolicy(write_threshold=2.5), _state_columns=['x'])
+    written, _ = holder.select_writes(times, means, np.ones((10, 1, 1)))
+    assert written.tolist() == [0, 3, 6, 9]
+    assert len(holder.pop_unwritten()[0]) == 0
+
+
+def test_decimated_stream(client, example_dataset, est_file_path, wait_for_estimator):
+    with open(est_file_path.parent / 'initial-asoh.json', 'rb') as rb:
+        result = client.post('/online/register?write_every=5',
+                             data={'name': 'module', 'definition': est_file_path.read_text()},
+                             files=[('files', ('initial-asoh.json', rb))])
+    assert result.status_code == 200, result.text
+    wait_for_estimator('module')
+
+    example_dataset.metadata.name = 'module'
+    client.post("/db/register", content=example_dataset.metadata.model_dump_json())
+    raw_data = example_dataset.tables['raw_data']
+    with client.websocket_connect("/db/upload/module") as websocket:
+        for i in range(12):
+            websocket.send_bytes(msgpack.packb(raw_data.iloc[i].to_dict()))
+
+    # Every fifth estimate is written, along with the last once the connection closes
+    est_times = connect().execute('SELECT test_time FROM module_estimates ORDER BY test_time').fetchnumpy()['test_time']
+    assert np.allclose(est_times, raw_data['test_time'].iloc[[0, 5, 10, 11]])
+
+    # The last estimate is also written after a bulk upload
+    reply = client.post('/db/upload/module', json=raw_data.iloc[12:19].to_dict(orient='records'))
+    assert reply.status_code == 200, reply.text
+    est_times = connect().execute('SELECT test_time FROM module_estimates ORDER BY test_time').fetchnumpy()['test_time']
+    assert np.allclose(est_times, raw_data['test_time'].iloc[[0, 5, 10, 11, 16, 18]])
@@ -0,0 +1,78 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+import os
+
+import numpy as np
+import pyarrow as pa
+from pytest import fixture
+
+from roviweb.artifacts import get_artifact_store
+from roviweb.db import register_columnar_source, write_table
+from roviweb.forecast_workers import configure_forecast_workers, close_forecast_workers, RemoteForecast
+from roviweb.online import write_estimates
+from roviweb.prognosis import list_forecasters
+
+
+@fixture()
+def forecast_workers():
+    configure_forecast_workers(1, timeout=5)
+    try:
+        yield
+    finally:
+        configure_forecast_workers(0)
+        close_forecast_workers()
+
+
+def register(client, definition: str, name: str = 'cell'):
+    return client.post('/prognosis/register',
+                       data={'name': name, 'definition': definition, 'window_columns': ['a'], 'window_rows': 4},
+                       files=[('files', ('scale.txt', b'2'))])
+
+
+def test_remote(forecast_workers, client, fake_forecaster):
+    raw = pa.table({'test_time': [0.]})
+    write_table('cell', register_columnar_source('cell', raw.schema), raw)
+    write_estimates('cell', ['a'], np.arange(4.), np.arange(4.)[:, None])
+    reply = register(client, fake_forecaster)
+    assert reply.status_code == 200, reply.text
+    assert isinstance(list_forecasters()['cell'].function, RemoteForecast)
+
+    # The forecast runs in a worker which loads the model once
+    first = client.get('/prognosis/cell/run', params={'ahead_time': 2}).json()
+    assert first['q'] == [6., 6.]
+    assert first['pid'][0] != os.getpid()
+    second = client.get('/prognosis/cell/run', params={'ahead_time': 3}).json()
+    assert second['load_id'][0] == first['load_id'][0]
+
+    # Forecasts which take too long fail, then the workers are replaced
+    reply = client.get('/prognosis/cell/run', params={'ahead_time': 1000})
+    assert reply.status_code == 503
+    third = client.get('/prognosis/cell/run', params={'ahead_time': 4}).json()
+    assert third['q'] == [6.] * 4
+    assert third['pid'][0] != first['pid'][0]
+
+    # Forecasts waiting behind one which takes too long are run again once the workers are replaced
+    with ThreadPoolExecutor(2) as pool:
+        slow = pool.submit(client.get, '/prognosis/cell/run', params={'ahead_time': 1000})
+        sleep(0.5)
+        fast = pool.submit(client.get, '/prognosis/cell/run', params={'ahead_time': 5})
+        assert slow.result().status_code == 503
+        reply = fast.result()
+        assert reply.status_code == 200, reply.text
+        assert reply.json()['pid'][0] != third['pid'][0]
+
+
+def test_shared_bundle(forecast_workers, client, fake_forecaster):
+    for name in ['cell', 'other']:
+        raw = pa.table({'test_time': [0.]})
+        write_table(name, register_columnar_source(name, raw.schema), raw)
+        write_estimates(name, ['a'], np.arange(4.), np.arange(4.)[:, None])
+        reply = register(client, fake_forecaster, name)
+        assert reply.status_code == 200, reply.text
+
+    # Both use the files in the artifact store and the function loaded once by the worker
+    specs = [list_forecasters()[name].function.spec for name in ['cell', 'other']]
+    assert specs[0].digest == specs[1].digest
+    assert specs[0].directory == get_artifact_store().path(specs[0].digest).absolute() / 'files'
+    replies = [client.get(f'/prognosis/{name}/run', params={'ahead_time': 2}).json() for name in ['cell', 'other']]
+    assert replies[0]['load_id'] == replies[1]['load_id']
@@ -0,0 +1,134 @@
+from time import sleep, monotonic
+
+import numpy as np
+import pyarrow as pa
+from battdat.schemas import BatteryMetadata
+from pytest import fixture, raises
+
+from roviweb.cache import OfflineResultCache
+from roviweb.db import register_battery, register_columnar_source, write_table
+from roviweb.offline import configure_offline_estimation, function_source_digest
+from roviweb.online import estimators, load_training_data, build_estimator
+
+
+@fixture()
+def offline_workers():
+    configure_offline_estimation(1)
+    try:
+        yield
+    finally:
+        configure_offline_estimation(0)
+
+
+def test_window():
+    register_battery(BatteryMetadata(name='cell'))
+    raw = pa.table({'test_time': np.arange(100.), 'current': np.zeros(100), 'voltage': np.full(100, 3.5)})
+    write_table('cell', register_columnar_source('cell', raw.schema), raw)
+
+    assert load_training_data('cell', 200.) is None
+    assert len(load_training_data('cell', 10.).tables['raw_data']) == 100
+    dataset = load_training_data('cell', 10., window=20.)
+    assert np.allclose(dataset.tables['raw_data']['test_time'], np.arange(79., 100.))
+
+
+def test_background(offline_workers, client, fake_estimator):
+    # Registration returns before offline estimation completes
+    definition = fake_estimator.replace('DELAY = 0.', 'DELAY = 2.')
+    reply = client.post('/online/register', data={'name': 'cell', 'definition': definition})
+    assert reply.status_code == 200, reply.text
+    status = client.get('/online/status').json()['cell']
+    assert not status['is_ready']
+    assert status['offline_status'] == 'running'
+
+    # The estimator is built once it completes, without further requests
+    holder = estimators['cell']
+    start = monotonic()
+    while holder.estimator is None and monotonic() - start < 60:
+        sleep(0.1)
+    assert holder.offline_status == 'complete'
+    assert holder.estimator.asoh == 1.
+
+
+def test_failure(client, fake_estimator, wait_for_estimator):
+    definition = fake_estimator.replace('DELAY = 0.', 'DELAY = -1.')
+    reply = client.post('/online/register', data={'name': 'cell', 'definition': definition})
+    assert reply.status_code == 200, reply.text
+    wait_for_estimator('cell')
+    status = client.get('/online/status').json()['cell']
+    assert status['offline_status'] == 'failed'
+    assert 'did not converge' in status['offline_error']
+
+
+def test_source_digest():
+    helper = 'def helper(x):\n    return x * SCALE\n'
+    definition = ('import numpy as np\nSCALE = 2\nnp.random.seed(1)\n' + helper +
+                  'def perform_offline_estimation(dataset):\n    return helper(1), 2.\n'
+                  'def make_estimator(asoh, state):\n    return asoh\n')
+    digest = function_source_digest(definition, 'perform_offline_estimation')
+
+    # Unrelated changes and formatting do not matter
+    tweaked = definition.replace('return asoh', 'return state')
+    assert function_source_digest(tweaked, 'perform_offline_estimation') == digest
+    tweaked = definition.replace('return helper(1), 2.', 'return helper( 1 ), 2.  # Comment')
+    assert function_source_digest(tweaked, 'perform_offline_estimation') == digest
+
+    # Changes to the function or anything it uses do
+    for old, new in [('2.', '3.'), ('x * SCALE', 'x / SCALE'), ('SCALE = 2', 'SCALE = 3'), ('numpy', 'scipy'),
+                     ('seed(1)', 'seed(2)')]:
+        assert function_source_digest(definition.replace(old, new), 'perform_offline_estimation') != digest
+
+    with raises(ValueError, match='not found'):
+        function_source_digest(definition, 'not_found')
+
+
+def test_result_cache(tmp_path):
+    cache = OfflineResultCache(tmp_path, max_bytes=1024)
+    assert cache.get('a') is None
+    cache.put('a', (1., 2.))
+    assert cache.get('a') == (1., 2.)
+    assert cache.stats.hits == 1 and cache.stats.misses == 1
+
+    # Results persist on disk
+    assert OfflineResultCache(tmp_path, max_bytes=1024).get('a') == (1., 2.)
+
+    # The least-recently-used result is removed when too large
+    cache.put('b', b'0' * 600)
+    sleep(0.01)
+    cache.get('a')
+    cache.put('c', b'0' * 600)
+    assert cache.get('b') is None
+    assert cache.get('a') == (1., 2.)
+    assert cache.stats.evictions == 1
+    assert cache.stats.bytes <= 1024
+
+
+def test_reuse(client, fake_estimator, wait_for_estimator):
+    register_battery(BatteryMetadata(name='cell'))
+    raw = pa.table({'test_time': np.arange(100.), 'current': np.zeros(100), 'voltage': np.full(100, 3.5)})
+    write_table('cell', register_columnar_source('cell', raw.schema), raw)
+
+    start = client.get('/online/offline-cache').json()
+
+    def _register_and_build(definition: str) -> tuple[int, int]:
+        reply = client.post('/online/register', params={'required_time': 10.},
+                            data={'name': 'cell', 'definition': definition})
+        assert reply.status_code == 200, reply.text
+        holder = estimators['cell']
+        with holder._lock:
+            build_estimator('cell', holder)
+        wait_for_estimator('cell')
+        assert holder.offline_status == 'complete'
+        stats = client.get('/online/offline-cache').json()
+        return stats['hits'] - start['hits'], stats['misses'] - start['misses']
+
+    definition = fake_estimator
+    assert _register_and_build(definition) == (0, 1)
+
+    # Changes to how the online estimator is built reuse the offline estimates
+    assert _register_and_build(definition.replace('asoh=asoh', 'asoh=asoh, extra=True')) == (1, 1)
+    assert estimators['cell'].estimator.extra
+
+    # New data do not
+    new_rows = pa.table({'test_time': np.arange(100., 110.), 'current': np.zeros(10), 'voltage': np.full(10, 3.5)})
+    write_table('cell', register_columnar_source('cell', raw.schema), new_rows)
+    assert _register_and_build(definition) == (1, 2)
@@ -0,0 +1,41 @@
+"""Test rendering figures in the process pool"""
+import asyncio
+import time
+
+import numpy as np
+from pytest import fixture, raises
+
+from roviweb import plots
+
+
+def _slow_figure(delay: float) -> bytes:
+    time.sleep(delay)
+    return b''
+
+
+@fixture()
+def pool():
+    plots.configure_rendering(max_workers=1, timeout=10.)
+    yield
+    plots.close_rendering()
+
+
+def test_render(pool):
+    since_pres = np.linspace(-1, 0, 8)
+    data = {'voltage': np.full(8, 3.5), 'current': np.ones(8)}
+    svg = asyncio.run(plots.render(plots.draw_history, since_pres, data, None))
+    assert svg.startswith(b'<?xml')
+
+    # Summarized data include the range of each bucket
+    data.update({'voltage_min': data['voltage'] - 0.1, 'voltage_max': data['voltage'] + 0.1,
+                 'current_min': data['current'] - 0.1, 'current_max': data['current'] + 0.1})
+    assert asyncio.run(plots.render(plots.draw_history, since_pres, data, 10.)).startswith(b'<?xml')
+
+
+def test_timeout(pool):
+    plots.configure_rendering(max_workers=1, timeout=5.)
+    with raises(TimeoutError):
+        asyncio.run(plots.render(_slow_figure, 60.))
+
+    # The pool is replaced after a timeout
+    assert asyncio.run(plots.render(_slow_figure, 0.)) == b''
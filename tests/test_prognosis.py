@@ -1,14 +1,23 @@
 """Test forecasting ASOH values"""
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
+from io import BytesIO
 from pathlib import Path
+from time import sleep
 
+import msgpack
 import pandas as pd
+import pyarrow as pa
 import numpy as np
 from pytest import fixture
 
+from roviweb.cache import get_prognosis_cache, configure_prognosis_cache
+from roviweb.db import register_columnar_source, write_table
 from roviweb.utils import load_variable
-from roviweb.schemas import PrognosticsFunction, ForecasterInfo, LoadSpecification
-from roviweb.prognosis import register_forecaster, list_forecasters
+from roviweb.online import write_estimates
+from roviweb.schemas import PrognosticsFunction, ForecasterInfo, LoadSpecification, InputWindow
+from roviweb.prognosis import (register_forecaster, list_forecasters, get_prognosis, perform_prognosis, InputBuffer,
+                               forecaster_version)
 
 _my_query = 'SELECT test_time,q_t__base_values FROM $TABLE_NAME$ ORDER BY test_time DESC LIMIT 10000'
 
@@ -39,9 +48,17 @@ def test_register(forecast_fun):
         function=forecast_fun,
         sql_query=_my_query,
     )
+    assert forecaster_version('cell') is None
     register_forecaster('cell', info)
     assert 'cell' in list_forecasters()
 
+    # The version includes the digest of the definition and changes each time a forecaster is registered
+    first = forecaster_version('cell')
+    register_forecaster('cell', info.model_copy(update={'artifact': 'abc'}))
+    second = forecaster_version('cell')
+    assert first[0] is None and second[0] == 'abc'
+    assert second[1] != first[1]
+
 
 def upload_forecaster(path: Path, client):
     to_upload = path.parent.glob('*.pkl')
@@ -81,3 +98,121 @@ def test_run(forecast_fun, example_dataset, upload_estimator, client):
     reply = client.get('/dashboard/module/img/forecast.svg', params=LoadSpecification(ahead_time=10000).model_dump())
     assert reply.status_code == 200, reply.text
     Path(__file__).parent.joinpath('views/forecast.svg').write_text(reply.text)
+
+
+def test_prognosis_cache():
+    configure_prognosis_cache(tolerance=10.)
+    calls = []
+
+    def _forecast(inputs: pd.DataFrame, load: pd.DataFrame) -> pd.DataFrame:
+        calls.append(len(inputs))
+        sleep(0.1)
+        return pd.DataFrame({'q_t__base_values': np.full(len(load), inputs['q_t__base_values'].iloc[-1])})
+
+    def _write_estimates(times):
+        table = pa.table({'test_time': np.array(times, dtype=float), 'q_t__base_values': np.ones(len(times))})
+        write_table('cell_estimates', register_columnar_source('cell_estimates', table.schema), table)
+
+    raw = pa.table({'test_time': [0., 1.]})
+    write_table('cell', register_columnar_source('cell', raw.schema), raw)
+    register_forecaster('cell', ForecasterInfo(function=_forecast, sql_query=_my_query))
+    _write_estimates([0., 1.])
+
+    # Concurrent identical requests share one computation
+    load = LoadSpecification(ahead_time=10)
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lambda _: get_prognosis('cell', load), range(4)))
+    assert calls == [2]
+    assert all(len(r) == 10 for r in results)
+    assert get_prognosis_cache().stats.coalesced == 3
+
+    # Small advances in the estimates are within tolerance, larger ones are not
+    _write_estimates([5.])
+    get_prognosis('cell', load)
+    assert calls == [2]
+    _write_estimates([20.])
+    get_prognosis('cell', load)
+    assert calls == [2, 4]
+    assert get_prognosis_cache().stats.invalidations == 1
+
+    # Different loads and new forecasters are computed separately
+    get_prognosis('cell', LoadSpecification(ahead_time=20))
+    assert len(calls) == 3
+    register_forecaster('cell', ForecasterInfo(function=_forecast, sql_query=_my_query))
+    get_prognosis('cell', load)
+    assert len(calls) == 4
+
+
+def test_input_buffer():
+    buffer = InputBuffer(InputWindow(columns=['a'], rows=4))
+    assert len(buffer.view()) == 0
+
+    # Only the most recent rows are kept, in order
+    buffer.append({'test_time': np.arange(3.), 'a': np.arange(3.), 'b': np.zeros(3)})
+    buffer.append({'test_time': np.arange(3., 6.), 'a': np.arange(3., 6.)})
+    view = buffer.view()
+    assert view.columns.tolist() == ['test_time', 'a']
+    assert view['test_time'].tolist() == [2., 3., 4., 5.]
+
+    # Views are unchanged by later writes, including those which fill the buffer
+    for start in range(6, 30, 2):
+        buffer.append({'test_time': np.arange(start, start + 2.)})
+        assert view['test_time'].tolist() == [2., 3., 4., 5.]
+    assert buffer.view()['test_time'].tolist() == [26., 27., 28., 29.]
+    assert buffer.view()['a'].isna().all()
+
+    # Windows may also be limited by time
+    buffer = InputBuffer(InputWindow(columns=['a'], duration=10.))
+    for start in range(0, 5000, 100):
+        buffer.append({'test_time': np.arange(start, start + 100.), 'a': np.ones(100)})
+    assert buffer.view()['test_time'].tolist() == list(range(4989, 5000))
+
+
+def test_input_window():
+    def _forecast(inputs: pd.DataFrame, load: pd.DataFrame) -> pd.DataFrame:
+        return pd.DataFrame({'last': [inputs['test_time'].iloc[-1]] * len(load), 'rows': len(inputs)})
+
+    raw = pa.table({'test_time': [0.]})
+    write_table('cell', register_columnar_source('cell', raw.schema), raw)
+    write_estimates('cell', ['a', 'b'], np.arange(8.), np.ones((8, 2)))
+
+    # Estimates in the database are loaded at registration, and new ones added as they are written
+    register_forecaster('cell', ForecasterInfo(function=_forecast, input_window=InputWindow(columns=['b'], rows=5)))
+    load = pd.DataFrame({'test_time': np.arange(2.)})
+    assert perform_prognosis('cell', load).iloc[0].tolist() == [7., 5.]
+    write_estimates('cell', ['a', 'b'], np.arange(8., 10.), np.ones((2, 2)))
+    assert perform_prognosis('cell', load).iloc[0].tolist() == [9., 5.]
+
+
+def test_batch(client):
+    calls = {'scalar': 0, 'vector': 0}
+
+    def _scalar(inputs: pd.DataFrame, load: pd.DataFrame) -> pd.DataFrame:
+        calls['scalar'] += 1
+        return pd.DataFrame({'test_time': load['test_time'], 'q': inputs['a'].iloc[-1]})
+
+    def _vector(inputs: pd.DataFrame, load: pd.DataFrame) -> pd.DataFrame:
+        calls['vector'] += 1
+        return pd.DataFrame({'test_time': load['test_time'], 'scenario': load['scenario'], 'q': -1.})
+
+    for name, function, vectorized in [('cell', _scalar, False), ('other', _vector, True)]:
+        raw = pa.table({'test_time': [0.]})
+        write_table(name, register_columnar_source(name, raw.schema), raw)
+        write_estimates(name, ['a'], np.arange(4.), np.arange(4.)[:, None])
+        register_forecaster(name, ForecasterInfo(function=function, vectorized=vectorized,
+                                                 input_window=InputWindow(columns=['a'], rows=2)))
+
+    loads = [LoadSpecification(ahead_time=4), LoadSpecification(ahead_time=8, resolution=2)]
+    reply = client.post('/prognosis/batch', json={'names': ['cell', 'other', 'missing'],
+                                                  'loads': [x.model_dump() for x in loads]})
+    assert reply.status_code == 200, reply.text
+    messages = list(msgpack.Unpacker(BytesIO(reply.content)))
+    assert [m['name'] for m in messages] == ['cell', 'other', 'missing']
+    assert calls == {'scalar': 2, 'vector': 1}
+
+    for message, value in zip(messages[:2], [3., -1.]):
+        columns = message['columns']
+        assert columns['scenario'] == [0] * 4 + [1] * 4
+        assert columns['test_time'] == [0., 1., 2., 3., 0., 2., 4., 6.]
+        assert columns['q'] == [value] * 8
+    assert 'missing' in messages[2]['error']
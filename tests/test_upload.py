@@ -1,6 +1,13 @@
-from roviweb.db import get_metadata
+from pytest import mark
+import numpy as np
+import asyncio
+import pandas as pd
 import msgpack
 
+from roviweb.cli import encode_chunk
+from roviweb.db import get_metadata, register_data_source, list_batteries
+from roviweb.ingest import open_pipeline
+
 
 def test_upload(client):
     # Send a single row of data
@@ -14,6 +21,56 @@ def test_upload(client):
     assert stats['module']['data_stats']['columns'] == {'a': 'INTEGER', 'b': 'FLOAT', 'received': 'FLOAT'}
 
 
+def test_upload_batched(client):
+    # Send more rows than fit in a single batch
+    with client.websocket_connect("/db/upload/module?batch_size=4&batch_time=1000") as websocket:
+        for i in range(10):
+            websocket.send_bytes(msgpack.packb({'a': i, 'b': 1.}))
+
+    stats = client.get('/db/stats').json()
+    assert stats['module']['data_stats']['rows'] == 10
+
+    # Check the status of the ingest pipeline
+    ingest = client.get('/db/ingest').json()['module']
+    assert ingest['records_written'] >= 10
+    assert ingest['connections'] == 0
+    assert ingest['queue_depth'] == 0
+
+
+def test_upload_frames(client):
+    start = client.get('/db/ingest').json().get('module', {}).get('batches_written', 0)
+
+    # Send several rows per message
+    with client.websocket_connect("/db/upload/module") as websocket:
+        websocket.send_bytes(msgpack.packb([{'a': i, 'b': 1.} for i in range(3)]))
+        websocket.send_bytes(msgpack.packb([]))
+        websocket.send_bytes(msgpack.packb({'a': 3, 'b': 1.}))
+
+    stats = client.get('/db/stats').json()
+    assert stats['module']['data_stats']['rows'] == 4
+    assert client.get('/db/ingest').json()['module']['batches_written'] - start == 2  # One per non-empty message
+
+
+def test_reconnect():
+    type_map = register_data_source('module', {'a': 1})
+
+    async def _reconnect():
+        # Close the only connection, then open another while its data are being written
+        first = open_pipeline('module')
+        pipeline = await first.__aenter__()
+        await pipeline.put(type_map, [{'a': 0}])
+        closing = asyncio.create_task(first.__aexit__(None, None, None))
+        await asyncio.sleep(0)
+
+        # The new connection must be able to write after the first has finished
+        async with open_pipeline('module') as second:
+            await closing
+            await second.put(type_map, [{'a': 1}])
+
+    asyncio.run(asyncio.wait_for(_reconnect(), 5))
+    assert list_batteries()['module'].data_stats.rows == 2
+
+
 def test_upload_bulk(client):
     records = [{'a': 1, 'b': 1}]
 
@@ -21,6 +78,64 @@ def test_upload_bulk(client):
     assert client.post('/db/upload/module', json=records).json() == 1
 
 
+@mark.parametrize('upload_format', ['arrow', 'parquet', 'msgpack'])
+def test_upload_columnar(client, upload_format):
+    data = pd.DataFrame({'a': [1, 2, 3], 'b': [1., 2., 3.], 'c': ['x', 'y', 'z']})
+    content, content_type = encode_chunk(data, upload_format)
+    reply = client.post('/db/upload/module/columnar', content=content, headers={'content-type': content_type})
+    assert reply.status_code == 200, reply.text
+    assert reply.json() == 3
+
+    stats = client.get('/db/stats').json()
+    assert stats['module']['data_stats']['rows'] == 3
+    assert stats['module']['data_stats']['columns'] == {'a': 'INTEGER', 'b': 'FLOAT', 'c': 'VARCHAR'}
+
+    # Make sure the wrong type is rejected
+    reply = client.post('/db/upload/module/columnar', content=content, headers={'content-type': 'text/plain'})
+    assert reply.status_code == 415
+
+    # Make sure malformed data are rejected
+    reply = client.post('/db/upload/module/columnar', content=content[:-8] + b'not data',
+                        headers={'content-type': content_type})
+    assert reply.status_code == 400, reply.text
+
+    # Make sure columns which do not match the table are rejected
+    for bad_data in [pd.DataFrame({'a': [4], 'd': [1.]}), pd.DataFrame({'a': ['not a number']})]:
+        content, content_type = encode_chunk(bad_data, upload_format)
+        reply = client.post('/db/upload/module/columnar', content=content, headers={'content-type': content_type})
+        assert reply.status_code == 400, reply.text
+    assert client.get('/db/stats').json()['module']['data_stats']['rows'] == 3
+
+
+def test_series(client):
+    times = np.arange(0., 5000.)
+    data = pd.DataFrame({'test_time': times, 'voltage': np.sin(times / 100), 'current': np.cos(times / 100)})
+    content, content_type = encode_chunk(data, 'arrow')
+    client.post('/db/upload/module/columnar', content=content, headers={'content-type': content_type})
+
+    # Raw data are reduced to the requested number of points
+    reply = client.get('/series/module', params={'columns': ['voltage'], 'points': 100, 'end': 900})
+    assert reply.status_code == 200, reply.text
+    series = reply.json()
+    assert series['resolution'] is None
+    assert set(series['columns']) == {'test_time', 'voltage'}
+    assert len(series['columns']['test_time']) == 100
+    assert series['columns']['test_time'][-1] == 900
+
+    # Long windows are read from the rollups and include the range of each bucket
+    reply = client.get('/series/module', params={'points': 50, 'method': 'minmax'},
+                       headers={'accept': 'application/msgpack'})
+    assert reply.headers['content-type'] == 'application/msgpack'
+    series = msgpack.unpackb(reply.content)
+    assert series['resolution'] == 60
+    assert {'voltage_min', 'current_max'}.issubset(series['columns'])
+    assert len(series['columns']['test_time']) <= 100
+
+    # Unknown tables and columns are rejected
+    assert client.get('/series/missing').status_code == 404
+    assert client.get('/series/module', params={'columns': ['missing']}).status_code == 400
+
+
 def test_upload_metadata(client, example_dataset):
     res = client.post('/db/register', content=example_dataset.metadata.model_dump_json())
     assert res.status_code == 200
@@ -23,11 +23,13 @@ def add_data(client, example_dataset):
 
 
 @fixture()
-def add_estimator(est_file_path, client, add_data):
+def add_estimator(est_file_path, client, add_data, example_dataset, wait_for_estimator):
     with open(est_file_path.parent / 'initial-asoh.json', 'rb') as rb:
-        return client.post('/online/register',
-                           data={'name': add_data, 'definition': est_file_path.read_text()},
-                           files=[('files', ('initial-asoh.json', rb))])
+        reply = client.post('/online/register',
+                            data={'name': add_data, 'definition': est_file_path.read_text()},
+                            files=[('files', ('initial-asoh.json', rb))])
+    wait_for_estimator(add_data, example_dataset.tables['raw_data']['test_time'].iloc[15])
+    return reply
 
 
 def test_home(client):
@@ -64,3 +66,28 @@ def test_history_figure(client, add_data):
     res = client.get(f'/dashboard/{add_data}/img/history.svg')
     assert res.status_code == 200
     _views_dir.joinpath('history.svg').write_text(res.text)
+
+
+def test_figure_cache(client, add_data, example_dataset):
+    stats = client.get('/dashboard/render-cache').json()
+    url = f'/dashboard/{add_data}/img/history.svg'
+
+    # The second request is served from the cache
+    first = client.get(url)
+    assert first.status_code == 200
+    second = client.get(url)
+    assert second.headers['etag'] == first.headers['etag']
+    assert second.content == first.content
+    assert client.get('/dashboard/render-cache').json()['hits'] == stats['hits'] + 1
+
+    # Clients with the latest version receive no content
+    res = client.get(url, headers={'If-None-Match': first.headers['etag']})
+    assert res.status_code == 304
+
+    # Adding data changes the figure
+    row = example_dataset.tables['raw_data'].iloc[16]
+    with client.websocket_connect(f"/db/upload/{add_data}") as websocket:
+        websocket.send_bytes(msgpack.packb(row.to_dict()))
+    res = client.get(url, headers={'If-None-Match': first.headers['etag']})
+    assert res.status_code == 200
+    assert res.headers['etag'] != first.headers['etag']
@@ -0,0 +1,97 @@
+import numpy as np
+import msgpack
+from pytest import fixture
+
+from roviweb.db import connect
+from roviweb.online import estimators
+from roviweb.workers import (configure_workers, close_workers, list_remote_status, is_remote, remove_estimator,
+                             save_remote_state, _placements, _workers, _worker_load)
+
+
+@fixture()
+def workers():
+    configure_workers(2)
+    try:
+        yield
+    finally:
+        close_workers()
+
+
+def test_stream(workers, client, example_dataset, upload_estimator):
+    assert upload_estimator.status_code == 200, upload_estimator.text
+    assert is_remote('module') and 'module' not in estimators
+
+    # Stream data through the worker
+    example_dataset.metadata.name = 'module'
+    client.post("/db/register", content=example_dataset.metadata.model_dump_json())
+    raw_data = example_dataset.tables['raw_data']
+    with client.websocket_connect("/db/upload/module") as websocket:
+        for i in range(8):
+            websocket.send_bytes(msgpack.packb(raw_data.iloc[i].to_dict()))
+
+    # The status should come from the worker
+    state = client.get('/online/status').json()
+    assert state['module']['latest_time'] == raw_data['test_time'].iloc[7]
+    assert client.get('/db/status').json()['module']['has_estimator']
+
+    # The estimates are written by the web service
+    est_times = connect().execute('SELECT test_time FROM module_estimates').fetchnumpy()['test_time']
+    assert np.allclose(np.sort(est_times), raw_data['test_time'].iloc[:8])
+
+    # Closing the workers returns the estimator to this process
+    close_workers()
+    assert 'module' in estimators
+    assert estimators['module'].last_time == raw_data['test_time'].iloc[7]
+
+
+def test_rebalance(workers, client, est_file_path, wait_for_estimator):
+    definition = est_file_path.read_text()
+    asoh = (est_file_path.parent / 'initial-asoh.json').read_bytes()
+    for name in ['a', 'b', 'c', 'd']:
+        result = client.post('/online/register', data={'name': name, 'definition': definition},
+                             files=[('files', ('initial-asoh.json', asoh))])
+        assert result.status_code == 200, result.text
+        wait_for_estimator(name)
+    assert len(list_remote_status()) == 4
+
+    # Estimators should be spread evenly
+    counts = np.bincount([p.worker for p in _placements.values()], minlength=2)
+    assert counts.tolist() == [2, 2]
+
+    # Removing estimators from one worker should move another to it
+    remove_estimator('a')
+    remove_estimator('c')
+    counts = np.bincount([p.worker for p in _placements.values()], minlength=2)
+    assert counts.tolist() == [1, 1]
+
+
+def test_failed_move(workers, client, fake_estimator, mocker, wait_for_estimator):
+    for name in ['a', 'b', 'c']:
+        result = client.post('/online/register', data={'name': name, 'definition': fake_estimator})
+        assert result.status_code == 200, result.text
+        wait_for_estimator(name)
+    idle = next(i for i in range(2) if sum(p.worker == i for p in _placements.values()) == 1)
+    busy = 1 - idle
+
+    # Make the idle worker refuse estimators, then trigger a move to it
+    submit = _workers[idle].submit
+
+    def _refuse_load(fn, *args):
+        if fn is _worker_load:
+            raise RuntimeError('Worker failed')
+        return submit(fn, *args)
+
+    mocker.patch.object(_workers[idle], 'submit', side_effect=_refuse_load)
+    remove_estimator(next(n for n, p in _placements.items() if p.worker == idle))
+
+    # The estimators stay with the original worker, which still holds their state
+    assert len(_placements) == 2
+    for name, placement in _placements.items():
+        assert placement.worker == busy
+        assert save_remote_state(name) is not None
+
+
+def test_fleet_warning(workers, client, fake_estimator, caplog):
+    result = client.post('/online/register', params={'fleet': True}, data={'name': 'a', 'definition': fake_estimator})
+    assert result.status_code == 200, result.text
+    assert 'stepped on its own' in caplog.text